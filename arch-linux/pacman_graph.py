@@ -7,19 +7,62 @@ with a focus on the size of the packages.
 """
 
 import argparse
-from collections import defaultdict
-from functools import partial
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import nullcontext
+from fractions import Fraction
+from functools import lru_cache, partial, wraps
+from itertools import accumulate, chain, islice
+import gc
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import marshal
+import math
+import mmap
 import os
+import re
+import shlex
+import socket
+import socketserver
+import stat
 import subprocess
 import sys
+import tempfile
 import threading
+import time
+import tracemalloc
+from xml.sax.saxutils import quoteattr
 from tqdm import tqdm
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import scipy.sparse as scipy_sparse
+except ImportError:
+    scipy_sparse = None
+
 TYPING = False
 
 if TYPING:
+    from concurrent.futures import Future
     from typing import (
+        Any,
         Callable,
+        ContextManager,
+        Deque,
         Dict,
         FrozenSet,
         IO,
@@ -27,11 +70,15 @@ if TYPING:
         Iterator,
         List,
         Optional,
+        Sequence,
         Set,
         Tuple,
+        TypeVar,
     )
     from typing_extensions import Literal
 
+    T = TypeVar("T")
+
 _units = {
     "B": 1,
     "KiB": 1024,
@@ -41,6 +88,39 @@ _units = {
 }
 
 
+# Matches a whole `pacman -Qi` record, picking out the fields the fast parser needs.
+# These always come in the same order, with non-empty lines in between.
+# Values start in column 18, and Optional Deps continue onto further lines indented to match.
+_QI_RECORD_KEYS = (
+    "Name",
+    "Provides",
+    "Depends On",
+    "Optional Deps",
+    "Installed Size",
+    "Install Reason",
+)
+_QI_RECORD = re.compile(
+    r"Name +: (.*)\n(?:.+\n)*?"
+    r"Provides +: (.*)\n"
+    r"Depends On +: (.*)\n"
+    r"Optional Deps +: (.*(?:\n {18}.*)*)\n(?:.+\n)*?"
+    r"Installed Size +: (.*)\n(?:.+\n)*?"
+    r"Install Reason +: (.*)"
+)
+# Fallback for records which don't match the above, e.g. from other pacman versions.
+_QI_FIELD = re.compile(
+    r"^(Name|Depends On|Optional Deps|Provides|Installed Size|Install Reason) *: "
+    r"(.*(?:\n {18}.*)*)",
+    re.MULTILINE,
+)
+_VERSION_REQUIREMENT = re.compile(r"[<>=]\S*")
+
+# How many packages to parse between progress bar updates
+_PROGRESS_INTERVAL = 256
+# How many pacman database entries to read per thread pool task
+_DESC_CHUNK_SIZE = 64
+
+
 class DebuggedStream:
     """
     Context manager that records the last few lines of a stream, and prints them if an exception
@@ -48,12 +128,12 @@ class DebuggedStream:
     """
 
     stream: "Iterable[str]"
-    debug_last_few_lines: "List[str]"
+    debug_last_few_lines: "Deque[str]"
     num_lines: int
 
     def __init__(self, stream: "Iterable[str]", num_lines: int = 10):
         self.stream = stream
-        self.debug_last_few_lines = []
+        self.debug_last_few_lines = deque(maxlen=num_lines)
         self.num_lines = num_lines
 
     def __enter__(self) -> "DebuggedStream":
@@ -69,16 +149,236 @@ class DebuggedStream:
         return False
 
     def _recording_generator(self) -> "Iterator[str]":
+        record = self.debug_last_few_lines.append
         for line in self.stream:
-            self.debug_last_few_lines.append(line)
-            if len(self.debug_last_few_lines) > 10:
-                self.debug_last_few_lines.pop(0)
+            record(line)
             yield line
 
     def __iter__(self) -> "Iterator[str]":
         return self._recording_generator()
 
 
+class PhaseStats:
+    """
+    Totals for one phase of a profiled run, over every time it was entered.
+    """
+
+    __slots__ = ("calls", "wall_time", "cpu_time", "peak_memory", "memory_delta")
+
+    calls: int
+    wall_time: float
+    cpu_time: float
+    peak_memory: int
+    memory_delta: int
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = 0
+        self.memory_delta = 0
+
+
+class PhaseProfiler:
+    """
+    Records the wall time, CPU time and peak memory of the phases of a run, along with
+    counters of events such as retained set cache hits, for `--profile`.
+
+    Phases are entered with `with profiler(name):` and are identified by their path of
+    enclosing phase names, as in timer.py's `Timer`. Memory is measured with
+    `tracemalloc` if `trace_memory` is set, which slows everything else down. Peak
+    memory is the most memory traced at any point during a phase.
+
+    Code which may run under a profiler uses `profile_phase`, `profiled` and
+    `count_event`, which do nothing until a profiler has been started.
+    """
+
+    __slots__ = (
+        "trace_memory",
+        "phases",
+        "counters",
+        "stack",
+        "start_times",
+    )
+
+    trace_memory: bool
+    phases: "Dict[Tuple[str, ...], PhaseStats]"
+    counters: "Dict[str, int]"
+    stack: "List[List[Any]]"
+    start_times: "Tuple[float, float]"
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.counters = defaultdict(int)
+        self.stack = []
+        self.start_times = (0.0, 0.0)
+
+    def start(self):
+        """
+        Start profiling, making this the profiler used by `profile_phase` and friends.
+        """
+        global _profiler
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start_times = (time.perf_counter(), time.process_time())
+        _profiler = self
+
+    def stop(self):
+        """
+        Stop profiling. Any phases still open are closed.
+        """
+        global _profiler
+        while self.stack:
+            self.__exit__(None, None, None)
+        if self.trace_memory:
+            tracemalloc.stop()
+        if _profiler is self:
+            _profiler = None
+
+    def _traced_memory(self) -> "Tuple[int, int]":
+        if self.trace_memory and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()
+        return 0, 0
+
+    def __call__(self, name: str) -> "PhaseProfiler":
+        path = (self.stack[-1][0] if self.stack else ()) + (name,)
+        if path not in self.phases:
+            self.phases[path] = PhaseStats()
+        current, peak = self._traced_memory()
+        if self.stack:
+            # The peak is reset for the new phase, so keep the enclosing phase's peak
+            self.stack[-1][4] = max(self.stack[-1][4], peak)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.stack.append(
+            [path, time.perf_counter(), time.process_time(), current, current]
+        )
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback) -> "Literal[False]":
+        end_time = time.perf_counter()
+        end_cpu_time = time.process_time()
+        current, peak = self._traced_memory()
+        path, start_time, start_cpu_time, start_memory, peak_so_far = self.stack.pop()
+        peak = max(peak, peak_so_far)
+
+        stats = self.phases[path]
+        stats.calls += 1
+        stats.wall_time += end_time - start_time
+        stats.cpu_time += end_cpu_time - start_cpu_time
+        stats.peak_memory = max(stats.peak_memory, peak)
+        stats.memory_delta += current - start_memory
+
+        if self.stack:
+            self.stack[-1][4] = max(self.stack[-1][4], peak)
+        return False
+
+    def count(self, name: str, count: int = 1):
+        """
+        Add to a named counter.
+        """
+        self.counters[name] += count
+
+    def report(self) -> "Dict[str, Any]":
+        """
+        Summarise the run so far as JSON-serialisable data. Phases are listed in the
+        order they were first entered, so each comes after the phase enclosing it.
+        """
+        wall_start, cpu_start = self.start_times
+        _, peak = self._traced_memory()
+        return {
+            "wall_time": time.perf_counter() - wall_start,
+            "cpu_time": time.process_time() - cpu_start,
+            "peak_memory": (
+                max([peak] + [stats.peak_memory for stats in self.phases.values()])
+                if self.trace_memory
+                else None
+            ),
+            "phases": [
+                {
+                    "path": list(path),
+                    "calls": stats.calls,
+                    "wall_time": stats.wall_time,
+                    "cpu_time": stats.cpu_time,
+                    "peak_memory": stats.peak_memory if self.trace_memory else None,
+                    "memory_delta": stats.memory_delta if self.trace_memory else None,
+                }
+                for path, stats in self.phases.items()
+            ],
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def write_summary(self, file: "IO[str]"):
+        """
+        Print a readable summary of the run so far, with phases indented under the
+        phase enclosing them.
+        """
+        for path, stats in self.phases.items():
+            label = "  " * (len(path) - 1) + path[-1]
+            if stats.calls > 1:
+                label += f" (x{stats.calls})"
+            line = f"{label:<40} {stats.wall_time:9.3f} s {stats.cpu_time:9.3f} s CPU"
+            if self.trace_memory:
+                line += f"  peak {format_size(stats.peak_memory)}"
+            print(line, file=file)
+        for name, count in sorted(self.counters.items()):
+            print(f"{name:<40} {count:9}", file=file)
+
+
+_profiler: "Optional[PhaseProfiler]" = None
+
+
+def profile_phase(name: str) -> "ContextManager[object]":
+    """
+    Time a phase with the running profiler, if any.
+    """
+    if _profiler is None:
+        return nullcontext()
+    return _profiler(name)
+
+
+def profiled(name: str) -> "Callable[[Callable[..., T]], Callable[..., T]]":
+    """
+    Decorate a function so that each call is timed as a phase by the running profiler,
+    if any.
+    """
+
+    def decorate(func: "Callable[..., T]") -> "Callable[..., T]":
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def stop_profiling():
+    """
+    Stop the running profiler, if any, without reporting. Used in worker processes,
+    which would otherwise carry on profiling into a copy of their parent's profiler.
+    """
+    global _profiler
+    _profiler = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def count_event(name: str, count: int = 1):
+    """
+    Add to a named counter of the running profiler, if any.
+    """
+    if _profiler is not None:
+        _profiler.count(name, count)
+
+
 def parse_size(size: str) -> int:
     """
     Parse a size string from the pacman database, and return the size in bytes.
@@ -137,6 +437,36 @@ class PacmanPackage:
             ")"
         )
 
+    @staticmethod
+    def from_pacman_desc(
+        fields: "Dict[str, List[str]]", path: str = "desc"
+    ) -> "Tuple[PacmanPackage, List[str]]":
+        """
+        Build a package from the fields of its pacman local database `desc` file.
+        Returns the package and the names it provides, with version requirements stripped.
+        """
+        try:
+            (name,) = fields["NAME"]
+        except (KeyError, ValueError):
+            raise ValueError(f"No single package name in {path}") from None
+        package = PacmanPackage(name)
+
+        size = fields.get("SIZE")
+        package.size = int(size[0]) if size else 0
+        # A missing reason means the package was explicitly installed
+        package.explicit_install = fields.get("REASON", ["0"]) == ["0"]
+
+        strip = PacmanPackage.strip_version_requirements
+        package.dependencies = {
+            strip(dependency) for dependency in fields.get("DEPENDS", ())
+        }
+        for dependency in fields.get("OPTDEPENDS", ()):
+            if ":" in dependency:
+                dependency = dependency[: dependency.index(":")].strip()
+            package.optional_dependencies.add(strip(dependency))
+
+        return package, [strip(provided) for provided in fields.get("PROVIDES", ())]
+
     @staticmethod
     def strip_version_requirements(name: str) -> str:
         """
@@ -151,6 +481,266 @@ class PacmanPackage:
         return name
 
 
+class RemovalPlan:
+    """
+    The outcome of removing a set of packages: the packages asked to be removed, the
+    packages orphaned as a result, and the total size of both.
+    """
+
+    __slots__ = ("requested", "orphaned", "freed_bytes")
+
+    requested: "List[str]"
+    orphaned: "List[str]"
+    freed_bytes: int
+
+    def __init__(self, requested: "List[str]", orphaned: "List[str]", freed_bytes: int):
+        self.requested = requested
+        self.orphaned = orphaned
+        self.freed_bytes = freed_bytes
+
+    def __repr__(self):
+        return (
+            f"RemovalPlan({self.requested!r}, {self.orphaned!r}, {self.freed_bytes!r})"
+        )
+
+
+class RetainedSetCache:
+    """
+    Cache of the retained sets found by the recursive retained set computation, keyed by
+    package name, optionally bounded by number of entries and by estimated memory use.
+    The least recently used entries are evicted once a limit is exceeded.
+
+    Memory use is estimated from the size of each set and a fixed overhead per entry;
+    package names are shared with the installed set, so are not counted. Equal sets are
+    not deduplicated: a retained set includes its own package, so two packages only
+    retain the same set when they are in the same dependency cycle, which is too rare
+    to pay for a table of distinct sets.
+    """
+
+    __slots__ = (
+        "max_entries",
+        "max_bytes",
+        "entries",
+        "estimated_bytes",
+        "hits",
+        "misses",
+        "evictions",
+    )
+
+    ENTRY_OVERHEAD = 100
+
+    max_entries: "Optional[int]"
+    max_bytes: "Optional[int]"
+    entries: "OrderedDict[str, FrozenSet[str]]"
+    estimated_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(
+        self, max_entries: "Optional[int]" = None, max_bytes: "Optional[int]" = None
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.estimated_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def set_limits(
+        self, max_entries: "Optional[int]" = None, max_bytes: "Optional[int]" = None
+    ):
+        """
+        Change the limits of the cache, evicting entries if it is now over them.
+        None means unlimited.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, package: str) -> bool:
+        return package in self.entries
+
+    def get(self, package: str) -> "Optional[FrozenSet[str]]":
+        """
+        Look up the retained set of a package, counting a hit or miss and marking the
+        entry as recently used.
+        """
+        retained_set = self.entries.get(package)
+        if retained_set is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(package)
+        return retained_set
+
+    def __setitem__(self, package: str, retained_set: "FrozenSet[str]"):
+        self.pop(package)
+        self.entries[package] = retained_set
+        self.estimated_bytes += self._estimate_bytes(retained_set)
+        self._evict()
+
+    def pop(
+        self, package: str, default: "Optional[FrozenSet[str]]" = None
+    ) -> "Optional[FrozenSet[str]]":
+        """
+        Remove a package's entry, returning its retained set, or the default if there
+        was none.
+        """
+        retained_set = self.entries.pop(package, None)
+        if retained_set is None:
+            return default
+        self.estimated_bytes -= self._estimate_bytes(retained_set)
+        return retained_set
+
+    def items(self) -> "Iterator[Tuple[str, FrozenSet[str]]]":
+        return iter(self.entries.items())
+
+    def discard_containing(self, packages: "Set[str]") -> int:
+        """
+        Remove the entries whose retained sets include any of the given packages, and
+        return how many were removed.
+        """
+        stale = [
+            package
+            for package, retained_set in self.entries.items()
+            if not retained_set.isdisjoint(packages)
+        ]
+        for package in stale:
+            self.pop(package)
+        return len(stale)
+
+    def clear(self):
+        self.entries.clear()
+        self.estimated_bytes = 0
+
+    def _estimate_bytes(self, retained_set: "FrozenSet[str]") -> int:
+        return sys.getsizeof(retained_set) + self.ENTRY_OVERHEAD
+
+    def _evict(self):
+        max_entries = self.max_entries
+        max_bytes = self.max_bytes
+        evicted = 0
+        while self.entries and (
+            (max_entries is not None and len(self.entries) > max_entries)
+            or (max_bytes is not None and self.estimated_bytes > max_bytes)
+        ):
+            _, retained_set = self.entries.popitem(last=False)
+            self.estimated_bytes -= self._estimate_bytes(retained_set)
+            evicted += 1
+        if evicted:
+            self.evictions += evicted
+            count_event("retained sets evicted", evicted)
+
+    def statistics(self) -> "Dict[str, Any]":
+        """
+        Summarise the size and effectiveness of the cache as JSON-serialisable data.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "estimated_bytes": self.estimated_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+        }
+
+
+class SizeIndex:
+    """
+    One kind of size for a list of packages, answering top-K and percentile queries by
+    partial selection rather than by sorting every size. Sizes may be a list, which is
+    searched with `heapq`, or a NumPy array, which is partitioned.
+    Packages of equal size are ranked in the order given.
+    """
+
+    __slots__ = ("names", "sizes")
+
+    names: "Sequence[str]"
+    sizes: "Sequence[int]"
+
+    def __init__(self, names: "Sequence[str]", sizes: "Sequence[int]"):
+        if len(names) != len(sizes):
+            raise ValueError("Expected one size per package")
+        self.names = names
+        self.sizes = sizes
+
+    @staticmethod
+    def from_dict(package_sizes: "Dict[str, int]") -> "SizeIndex":
+        """
+        Index sizes given as a dictionary from package name to size, such as those from
+        `PacmanInstalledSet.compute_all_sizes`.
+        """
+        return SizeIndex(list(package_sizes), list(package_sizes.values()))
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def max_size(self) -> int:
+        """
+        Get the largest size, or 0 if there are no packages.
+        """
+        sizes = self.sizes
+        if not len(sizes):
+            return 0
+        if isinstance(sizes, list):
+            return max(sizes)
+        return int(sizes.max())
+
+    def top_ids(self, count: int) -> "List[int]":
+        """
+        Get the indices of the `count` largest packages, largest first.
+        """
+        sizes = self.sizes
+        count = min(count, len(sizes))
+        if count <= 0:
+            return []
+        if isinstance(sizes, list):
+            return heapq.nlargest(count, range(len(sizes)), key=sizes.__getitem__)
+
+        # Everything larger than the count-th largest size is in, and then as many
+        # packages of exactly that size as fit, by index
+        threshold = numpy.partition(sizes, len(sizes) - count)[len(sizes) - count]
+        above = numpy.flatnonzero(sizes > threshold)
+        equal = numpy.flatnonzero(sizes == threshold)[: count - len(above)]
+        ids = numpy.concatenate((above, equal))
+        return ids[numpy.lexsort((ids, -sizes[ids]))].tolist()
+
+    def top(self, count: int) -> "List[Tuple[str, int]]":
+        """
+        Get the names and sizes of the `count` largest packages, largest first.
+        """
+        names = self.names
+        sizes = self.sizes
+        return [
+            (names[package_id], int(sizes[package_id]))
+            for package_id in self.top_ids(count)
+        ]
+
+    def percentile(self, percentile: float) -> int:
+        """
+        Get the size at a percentile, i.e. the size which that percentage of the
+        packages are smaller than.
+        """
+        sizes = self.sizes
+        if not len(sizes):
+            raise ValueError("No sizes to take a percentile of")
+        rank = min(int(len(sizes) * percentile / 100), len(sizes) - 1)
+        if isinstance(sizes, list):
+            if numpy is None:
+                # Selecting with heapq is slower than sorting, except near the ends
+                return sorted(sizes)[rank]
+            sizes = numpy.array(sizes, dtype=numpy.int64)
+        return int(numpy.partition(sizes, rank)[rank])
+
+
 class PacmanInstalledSet:
     """
     Represents the set of installed packages in the pacman database, with their dependencies.
@@ -162,7 +752,11 @@ class PacmanInstalledSet:
         "aliases",
         "revdep_cache",
         "optional_revdep_cache",
+        "missing_optional_revdeps",
         "retained_set_cache",
+        "graph",
+        "retained_set_engine",
+        "dominator_tree",
     )
 
     packages: "Dict[str, PacmanPackage]"
@@ -170,7 +764,11 @@ class PacmanInstalledSet:
     aliases: "Dict[str, str]"
     revdep_cache: "Optional[Dict[str, Set[str]]]"
     optional_revdep_cache: "Optional[Dict[str, Set[str]]]"
-    retained_set_cache: "Dict[str, FrozenSet[str]]"
+    missing_optional_revdeps: "Dict[str, Set[str]]"
+    retained_set_cache: "RetainedSetCache"
+    graph: "Optional[PackageGraph]"
+    retained_set_engine: "Optional[RetainedSetEngine]"
+    dominator_tree: "Optional[DominatorTree]"
 
     def __init__(self):
         self.packages = {}
@@ -178,7 +776,11 @@ class PacmanInstalledSet:
         self.aliases = {}
         self.revdep_cache = None
         self.optional_revdep_cache = None
-        self.retained_set_cache = {}
+        self.missing_optional_revdeps = {}
+        self.retained_set_cache = RetainedSetCache()
+        self.graph = None
+        self.retained_set_engine = None
+        self.dominator_tree = None
 
     def add_package(self, name: str):
         """
@@ -239,53 +841,239 @@ class PacmanInstalledSet:
             return alias
         return self.aliases.get(alias, alias)
 
+    @profiled("finalise dependency sets")
     def finalise_dependency_sets(self):
         """
-        Resolve all aliases in package dependencies, and remove non-installed optional dependencies.
+        Resolve all aliases in package dependencies, remove non-installed optional dependencies,
+        and build the compact package graph.
         """
         self.revdep_cache = revdep_cache = defaultdict(set)
         self.optional_revdep_cache = optional_revdep_cache = defaultdict(set)
+        self.missing_optional_revdeps = missing_optional_revdeps = defaultdict(set)
+        self.retained_set_engine = None
+        self.dominator_tree = None
 
         for package in self.packages.values():
+            package_name = package.name
             package.dependencies = {
                 self.resolve_alias(name) for name in package.dependencies
             }
-            package.optional_dependencies = {
-                name
-                for name in (
-                    self.resolve_alias(name) for name in package.optional_dependencies
-                )
-                if name in self.packages
-            }
+            optional_dependencies = set()
+            for name in package.optional_dependencies:
+                name = self.resolve_alias(name)
+                if name in self.packages:
+                    optional_dependencies.add(name)
+                else:
+                    # Remembered so the edge can be added if it is installed later
+                    missing_optional_revdeps[name].add(package_name)
+            package.optional_dependencies = optional_dependencies
 
-            package_name = package.name
             for dependency in package.dependencies:
                 revdep_cache[dependency].add(package_name)
             for dependency in package.optional_dependencies:
                 optional_revdep_cache[dependency].add(package_name)
 
+        self.graph = PackageGraph.from_installed_set(self)
+
+    def get_graph(self) -> "PackageGraph":
+        """
+        Get the compact package graph, rebuilding it if the installed set has been
+        modified since it was last built.
+        """
+        if self.graph is None:
+            if self.revdep_cache is None:
+                raise ValueError("Dependency sets not finalised")
+            self.graph = PackageGraph.from_installed_set(self)
+        return self.graph
+
+    def _invalidate(self, packages: "Iterable[str]"):
+        """
+        Forget everything computed about the given packages and all packages which
+        (transitively) depend on them, ahead of a change to their dependencies.
+        Whole-graph structures are dropped, to be rebuilt on next use.
+        """
+        self.graph = None
+        self.retained_set_engine = None
+        self.dominator_tree = None
+
+        # A package (transitively) depends on a changed package exactly when the
+        # changed package is in its retained set, which is cheaper to check than
+        # walking reverse dependencies
+        stale = self.retained_set_cache.discard_containing(set(packages))
+        count_event("retained sets invalidated", stale)
+
+    def _unlink_dependency(self, package: str, dependency: str):
+        revdeps = self.revdep_cache.get(dependency)
+        if revdeps is not None:
+            revdeps.discard(package)
+            if not revdeps:
+                del self.revdep_cache[dependency]
+                self.unknowns.discard(dependency)
+
+    def _link_dependency(self, package: str, dependency: str):
+        if dependency not in self.packages:
+            self.unknowns.add(dependency)
+        self.revdep_cache[dependency].add(package)
+
+    def set_dependencies(self, package: str, dependencies: "Iterable[str]"):
+        """
+        Replace the dependencies of a package in a finalised installed set,
+        updating only the cached results affected by the change.
+        """
+        if self.revdep_cache is None:
+            raise ValueError("Dependency sets not finalised")
+        package_obj = self.packages[package]
+        self._invalidate([package])
+
+        for dependency in package_obj.dependencies:
+            self._unlink_dependency(package, dependency)
+        package_obj.dependencies = {self.resolve_alias(name) for name in dependencies}
+        for dependency in package_obj.dependencies:
+            self._link_dependency(package, dependency)
+
+    def set_optional_dependencies(self, package: str, dependencies: "Iterable[str]"):
+        """
+        Replace the optional dependencies of a package in a finalised installed set.
+        """
+        optional_revdep_cache = self.optional_revdep_cache
+        if optional_revdep_cache is None:
+            raise ValueError("Dependency sets not finalised")
+        package_obj = self.packages[package]
+
+        for dependency in package_obj.optional_dependencies:
+            revdeps = optional_revdep_cache[dependency]
+            revdeps.discard(package)
+            if not revdeps:
+                del optional_revdep_cache[dependency]
+        for revdeps in self.missing_optional_revdeps.values():
+            revdeps.discard(package)
+
+        package_obj.optional_dependencies = set()
+        for dependency in map(self.resolve_alias, dependencies):
+            if dependency in self.packages:
+                package_obj.optional_dependencies.add(dependency)
+                optional_revdep_cache[dependency].add(package)
+            else:
+                self.missing_optional_revdeps.setdefault(dependency, set()).add(package)
+
+    def set_provides(self, package: str, provides: "Iterable[str]"):
+        """
+        Replace the names provided by a package in a finalised installed set.
+        Packages which depended on a newly provided name that was not previously
+        installed are pointed at the package instead.
+        """
+        revdep_cache = self.revdep_cache
+        if revdep_cache is None:
+            raise ValueError("Dependency sets not finalised")
+        provides = set(provides)
+
+        for alias in [
+            alias
+            for alias, target in self.aliases.items()
+            if target == package and alias not in provides
+        ]:
+            del self.aliases[alias]
+
+        for alias in provides:
+            self.aliases[alias] = package
+            if alias in self.unknowns:
+                self._invalidate([alias])
+                self.unknowns.discard(alias)
+                for revdep in revdep_cache.pop(alias, ()):
+                    dependencies = self.packages[revdep].dependencies
+                    dependencies.discard(alias)
+                    dependencies.add(package)
+                    revdep_cache[package].add(revdep)
+            self._link_missing_optional_revdeps(alias, package)
+
+    def _link_missing_optional_revdeps(self, name: str, package: str):
+        for revdep in self.missing_optional_revdeps.pop(name, ()):
+            self.packages[revdep].optional_dependencies.add(package)
+            self.optional_revdep_cache[package].add(revdep)
+
+    def replace_package(self, package: PacmanPackage, provides: "Iterable[str]" = ()):
+        """
+        Install a package into a finalised installed set, or replace the existing package
+        with the same name (e.g. when it is upgraded). The package's dependencies may use
+        aliases and are resolved as in `finalise_dependency_sets`.
+        """
+        if self.revdep_cache is None:
+            raise ValueError("Dependency sets not finalised")
+        name = package.name
+
+        existing = self.packages.get(name)
+        if existing is None:
+            # Anything depending on the name so far depended on an unknown package
+            self._invalidate([name])
+            existing = self.packages[name] = PacmanPackage(name)
+            self.unknowns.discard(name)
+            self._link_missing_optional_revdeps(name, name)
+        else:
+            self._invalidate([name])
+
+        existing.size = package.size
+        existing.explicit_install = package.explicit_install
+        self.set_provides(name, provides)
+        self.set_dependencies(name, package.dependencies)
+        self.set_optional_dependencies(name, package.optional_dependencies)
+
+    def remove_package(self, package: str):
+        """
+        Remove a package from a finalised installed set. Packages which depended on it
+        are left with an unknown dependency in its place.
+        """
+        optional_revdep_cache = self.optional_revdep_cache
+        if optional_revdep_cache is None:
+            raise ValueError("Dependency sets not finalised")
+        if package not in self.packages:
+            raise ValueError(f"Package {package} not installed")
+
+        self.set_dependencies(package, ())
+        self.set_optional_dependencies(package, ())
+        self.set_provides(package, ())
+        del self.packages[package]
+        self.retained_set_cache.pop(package, None)
+
+        if package in self.revdep_cache:
+            self.unknowns.add(package)
+        for revdep in optional_revdep_cache.pop(package, ()):
+            self.packages[revdep].optional_dependencies.discard(package)
+            self.missing_optional_revdeps.setdefault(package, set()).add(revdep)
+
     def __getitem__(self, key: str) -> PacmanPackage:
         if key in self.aliases and key not in self.packages:
             key = self.aliases[key]
         return self.packages[key]
 
+    @profiled("build retained set engine")
+    def build_retained_set_engine(self) -> "RetainedSetEngine":
+        """
+        Precompute the retained set of every package in one pass over the dependency graph.
+        Once built, retained set and size queries are answered from the engine instead of
+        recursing through the dependency graph.
+        """
+        self.retained_set_engine = RetainedSetEngine(self, self.get_graph())
+        return self.retained_set_engine
+
     def compute_retained_set_internal(
         self, package: str, parents: "FrozenSet[str]"
     ) -> "Tuple[FrozenSet[str], FrozenSet[str]]":
         """
         Compute the set of packages retained by a package, including its dependencies.
         """
-        if package in self.retained_set_cache:
-            return self.retained_set_cache[package], frozenset()
-        old_name = package
+        # Only the resolved name is cached, so aliases don't take up entries of their own
         package = self.resolve_alias(package)
-        if package in self.retained_set_cache:
-            self.retained_set_cache[old_name] = self.retained_set_cache[package]
-            return self.retained_set_cache[package], frozenset()
+        cached = self.retained_set_cache.get(package)
+        if cached is not None:
+            count_event("retained set cache hits")
+            return cached, frozenset()
+        count_event("retained set cache misses")
 
         retained_set = {package}
         parents = parents | {package}
-        dependencies = self.packages[package].dependencies
+        # Packages left unknown by a removal have no dependencies of their own
+        package_obj = self.packages.get(package)
+        dependencies = package_obj.dependencies if package_obj is not None else set()
         cycle_set: Set[str] = dependencies & parents
         for dependency in dependencies - cycle_set:
             next_retained_set, next_cycle_set = self.compute_retained_set_internal(
@@ -301,6 +1089,8 @@ class PacmanInstalledSet:
             # If we're not in a dependency cycle, we definitely have the full view
             # So cache the result
             self.retained_set_cache[package] = retained_set
+        else:
+            count_event("retained sets uncacheable (in a cycle)")
 
         return retained_set, frozenset(cycle_set)
 
@@ -309,6 +1099,10 @@ class PacmanInstalledSet:
         Compute the set of packages retained by a set of packages, including their dependencies.
         This is a more efficient version that caches the results for each package.
         """
+        engine = self.retained_set_engine
+        if engine is not None:
+            count_event("retained set engine lookups")
+            return engine.retained_set(packages)
         return set().union(
             *(
                 self.compute_retained_set_internal(package, frozenset())[0]
@@ -320,6 +1114,9 @@ class PacmanInstalledSet:
         """
         Compute the retained size of a set of packages, including their dependencies.
         """
+        engine = self.retained_set_engine
+        if engine is not None:
+            return engine.retained_size(packages)
         return sum(
             self[package].size or 0 for package in self.compute_retained_set(packages)
         )
@@ -333,72 +1130,316 @@ class PacmanInstalledSet:
         if self.revdep_cache is None:
             raise ValueError("Dependency sets not finalised")
 
+        engine = self.retained_set_engine
+        if engine is not None and engine.graph.revdep_matrix is not None:
+            return engine.adjusted_size(packages)
+
         if isinstance(packages, str):
             packages = {packages}
         else:
             packages = set(packages)
 
         packages = set(self.resolve_alias(name) for name in packages)
-        adjusted_size = float(sum(self[package].size or 0 for package in packages))
+        adjusted_size = sum(self[package].size or 0 for package in packages)
 
         retained_set = self.compute_retained_set(frozenset(packages))
 
+        # Summed exactly, as numerators by denominator, so that every way of
+        # computing adjusted sizes rounds the same way
+        numerators: "Dict[int, int]" = defaultdict(int)
         for package in retained_set - packages:
             revdeps = self.revdep_cache[package]
-            weight = sum(
-                1 if revdep in retained_set else 0 for revdep in revdeps
-            ) / len(revdeps)
-            size = self[package].size or 0
-            adjusted_size += size * weight
+            count = sum(1 if revdep in retained_set else 0 for revdep in revdeps)
+            numerators[len(revdeps)] += (self[package].size or 0) * count
+
+        return adjusted_size + floor_fraction_sum(numerators)
+
+    @profiled("build dominator tree")
+    def build_dominator_tree(self) -> "DominatorTree":
+        """
+        Build the dominator tree of the installed set, which answers which packages are
+        uniquely retained by which others.
+        """
+        engine = self.retained_set_engine or self.build_retained_set_engine()
+        self.dominator_tree = DominatorTree(engine.graph, self._root_ids(engine))
+        return self.dominator_tree
+
+    def _root_ids(self, engine: "RetainedSetEngine") -> "List[int]":
+        """
+        Get the IDs of the packages which are needed for their own sake: those installed
+        explicitly, and those nothing depends on (including dependency cycles).
+        """
+        roots = engine.source_nodes()
+        roots.extend(
+            package_id
+            for package_id, package in enumerate(self.packages.values())
+            if package.explicit_install
+        )
+        return roots
+
+    def simulate_removal(self, packages: "Iterable[str]") -> "RemovalPlan":
+        """
+        Work out what removing a set of packages would do, without removing anything.
+        Besides the packages themselves, every package which is then no longer needed is
+        removed too: those not installed explicitly whose reverse dependencies would all
+        be gone. Packages which nothing depended on to begin with are left alone.
+        Only the packages retained by the removed ones are examined.
+        """
+        engine = self.retained_set_engine or self.build_retained_set_engine()
+        graph = engine.graph
+        ids = graph.ids
+        packages = [packages] if isinstance(packages, str) else list(packages)
+        requested = set()
+        for name in packages:
+            package_id = ids.get(self.resolve_alias(name))
+            if package_id is None or package_id >= graph.num_packages:
+                raise ValueError(f"Package {name} not installed")
+            requested.add(package_id)
+
+        region = set(bitset_ids(engine.retained_bitset(packages)))
+        packages_by_id = list(self.packages.values())
+        component_of = engine.component_of
+        source_components: "Dict[int, bool]" = {}
+
+        def is_source_component(component: int) -> bool:
+            is_source = source_components.get(component)
+            if is_source is None:
+                is_source = source_components[component] = all(
+                    component_of[revdep] == component
+                    for member in engine.components[component]
+                    for revdep in graph.reverse_dependencies(member)
+                )
+            return is_source
+
+        # Anything in the region still needed by a package outside it stays installed,
+        # along with everything it depends on
+        kept = set()
+        for package_id in region:
+            if package_id in requested or package_id >= graph.num_packages:
+                continue
+            if (
+                packages_by_id[package_id].explicit_install
+                or not region.issuperset(graph.reverse_dependencies(package_id))
+                or is_source_component(component_of[package_id])
+            ):
+                kept.add(package_id)
+        queue = list(kept)
+        while queue:
+            for dependency in graph.dependencies(queue.pop()):
+                if (
+                    dependency in region
+                    and dependency not in kept
+                    and dependency not in requested
+                ):
+                    kept.add(dependency)
+                    queue.append(dependency)
+
+        names = graph.names
+        orphaned = sorted(
+            names[package_id]
+            for package_id in region
+            if package_id not in kept
+            and package_id not in requested
+            and package_id < graph.num_packages
+        )
+        removed = sorted(names[package_id] for package_id in requested)
+        freed_bytes = sum(graph.sizes[ids[name]] for name in chain(removed, orphaned))
+        return RemovalPlan(removed, orphaned, freed_bytes)
+
+    def apply_removal(self, plan: "RemovalPlan"):
+        """
+        Remove the packages in a removal plan from the installed set, patching the
+        cached dependency information rather than rebuilding it.
+        """
+        for name in chain(plan.requested, plan.orphaned):
+            self.remove_package(name)
 
-        return int(adjusted_size)
+    def plan_removals(
+        self, count: int, candidates: "Optional[Iterable[str]]" = None
+    ) -> "List[Tuple[str, int]]":
+        """
+        Greedily pick up to `count` packages to remove, each time choosing the one which
+        frees the most bytes on top of those already chosen, and return each choice with
+        the number of bytes it frees. By default any installed package can be chosen;
+        a ValueError is raised if any given candidate isn't installed.
+
+        The bytes freed by removing one more package are the size of its subtree in the
+        dominator tree of the packages left over, so each step is a single dominator tree
+        build rather than a simulated removal of every candidate.
+        """
+        engine = self.retained_set_engine or self.build_retained_set_engine()
+        graph = engine.graph
+        if candidates is None:
+            candidate_ids = set(range(graph.num_packages))
+        else:
+            candidate_ids = set()
+            for name in candidates:
+                package_id = graph.ids.get(self.resolve_alias(name))
+                if package_id is None or package_id >= graph.num_packages:
+                    raise ValueError(f"Package {name} not installed")
+                candidate_ids.add(package_id)
+        roots = self._root_ids(engine)
+
+        removed: "Set[int]" = set()
+        choices = []
+        for _ in range(count):
+            tree = DominatorTree(graph, roots, removed)
+            subtree_sizes = tree.subtree_sizes
+            idom = tree.idom
+            best = max(
+                (package_id for package_id in candidate_ids if idom[package_id] >= 0),
+                key=lambda package_id: (subtree_sizes[package_id], -package_id),
+                default=None,
+            )
+            if best is None:
+                break
+            choices.append((graph.names[best], subtree_sizes[best]))
+            removed.update(tree.dominated_ids(best))
+            candidate_ids.discard(best)
+        return choices
 
     def compute_uniquely_retained_size(self, packages: "Iterable[str]") -> int:
         """
-        Compute the size of packages that are only retained by the given set of packages.
+        Compute the size of packages that are only retained by the given set of packages,
+        i.e. that would no longer be needed by any explicitly installed package (or any
+        package that nothing depends on) if the given packages were removed.
         """
+        tree = self.dominator_tree or self.build_dominator_tree()
+        ids = tree.graph.ids
+
         if isinstance(packages, str):
-            packages = {packages}
+            return tree.subtree_sizes[ids[self.resolve_alias(packages)]]
+
+        sizes = tree.graph.sizes
+        return sum(
+            sizes[package_id]
+            for package_id in tree.uniquely_retained_ids(
+                ids[self.resolve_alias(name)] for name in packages
+            )
+        )
+
+    def compute_size(self, kind: str, packages: "Iterable[str]") -> int:
+        """
+        Compute one kind of size for a set of packages, as named in `compute_all_sizes`.
+        """
+        if kind == "own":
+            if isinstance(packages, str):
+                packages = [packages]
+            return sum(
+                self[name].size or 0 for name in set(map(self.resolve_alias, packages))
+            )
+        elif kind == "retained":
+            return self.compute_retained_size(packages)
+        elif kind == "adjusted":
+            return self.compute_adjusted_size(packages)
+        elif kind == "uniquely-retained":
+            return self.compute_uniquely_retained_size(packages)
+        elif kind == "retained-packages":
+            return len(self.compute_retained_set(packages))
         else:
-            packages = set(packages)
+            raise ValueError(f"Unknown size type {kind}")
 
-        packages = set(self.resolve_alias(name) for name in packages)
+    def compute_dependants(self, packages: "Iterable[str]") -> "Set[str]":
+        """
+        Compute the set of packages which (transitively) depend on any of a set of
+        packages, not including the packages themselves unless they are in a cycle.
+        """
+        if self.revdep_cache is None:
+            raise ValueError("Dependency sets not finalised")
+        if isinstance(packages, str):
+            packages = [packages]
 
         revdep_cache = self.revdep_cache
-        if revdep_cache is None:
+        dependants: "Set[str]" = set()
+        queue = [self.resolve_alias(name) for name in packages]
+        while queue:
+            for revdep in revdep_cache.get(queue.pop(), ()):
+                if revdep not in dependants:
+                    dependants.add(revdep)
+                    queue.append(revdep)
+        return dependants
+
+    def find_dependency_path(
+        self, package: str, start: "Optional[str]" = None
+    ) -> "Optional[List[str]]":
+        """
+        Find a shortest chain of dependencies leading to a package, starting from the
+        given package or, by default, from any explicitly installed package.
+        Returns the chain from start to finish, or None if there is no such chain.
+        """
+        if self.revdep_cache is None:
             raise ValueError("Dependency sets not finalised")
+        package = self.resolve_alias(package)
+        if start is not None:
+            start = self.resolve_alias(start)
 
-        uniquely_retained_set = set(packages)
-        queue: "List[str]" = []
-
-        iters = 0
-        old_length = 0
-        while len(uniquely_retained_set) > old_length:
-            iters += 1
-            old_length = len(uniquely_retained_set)
-            queue.extend(uniquely_retained_set)
-            while queue:
-                package = queue.pop()
-                unique_deps = set(
-                    dep
-                    for dep in self.packages[package].dependencies
-                    if uniquely_retained_set.issuperset(revdep_cache[dep])
-                )
-                queue.extend(unique_deps - uniquely_retained_set)
-                uniquely_retained_set |= unique_deps
-
-        if iters > 2:
-            print(
-                f"Uniquely retained set took {iters} iterations to stabilise for {packages}."
-                f"Result: {uniquely_retained_set}",
-                file=sys.stderr,
-            )
+        def is_start(name: str) -> bool:
+            if start is not None:
+                return name == start
+            found = self.packages.get(name)
+            return found is not None and found.explicit_install
 
-        return sum(
-            self.packages[package].size or 0 for package in uniquely_retained_set
-        )
+        revdep_cache = self.revdep_cache
+        parents: "Dict[str, Optional[str]]" = {package: None}
+        queue = deque([package])
+        while queue:
+            name = queue.popleft()
+            if is_start(name):
+                path = [name]
+                while parents[name] is not None:
+                    name = parents[name]
+                    path.append(name)
+                return path
+            for revdep in revdep_cache.get(name, ()):
+                if revdep not in parents:
+                    parents[revdep] = name
+                    queue.append(revdep)
+        return None
+
+    @profiled("compute sizes")
+    def compute_all_sizes(self, kind: str) -> "Dict[str, int]":
+        """
+        Compute one kind of size for every installed package at once.
+        `kind` is one of "own", "retained", "adjusted", "uniquely-retained" or
+        "retained-packages".
+        This shares intermediate results between packages, so it is much faster than
+        computing each package's size separately.
+        """
+        if kind == "own":
+            return {name: package.size or 0 for name, package in self.packages.items()}
+
+        engine = self.retained_set_engine or self.build_retained_set_engine()
+        if kind == "retained":
+            sizes = engine.all_retained_sizes()
+        elif kind == "adjusted":
+            sizes = engine.all_adjusted_sizes()
+        elif kind == "uniquely-retained":
+            tree = self.dominator_tree or self.build_dominator_tree()
+            sizes = tree.subtree_sizes
+        elif kind == "retained-packages":
+            sizes = engine.all_retained_counts()
+        else:
+            raise ValueError(f"Unknown size type {kind}")
+
+        return dict(zip(self.packages, sizes))
+
+    def top_packages(self, kind: str, count: int) -> "List[Tuple[str, int]]":
+        """
+        Find the `count` installed packages with the largest sizes of one kind, as in
+        `compute_all_sizes`, with their sizes, largest first. Retained sizes are only
+        computed for packages which could make the cut.
+        """
+        if kind == "retained":
+            engine = self.retained_set_engine or self.build_retained_set_engine()
+            names = engine.graph.names
+            return [
+                (names[package_id], size)
+                for package_id, size in engine.top_retained(count)
+            ]
+        return SizeIndex.from_dict(self.compute_all_sizes(kind)).top(count)
 
     @staticmethod
+    @profiled("parse pacman -Qi")
     def from_pacman_qi_stream(stream: "Iterable[str]") -> "PacmanInstalledSet":
         """
         Parse the output of `pacman -Qi` from a stream, and return a PacmanInstalledSet object.
@@ -406,6 +1447,7 @@ class PacmanInstalledSet:
         installed_set = PacmanInstalledSet()
         current_package: Optional[str] = None
         key = ""
+        parsed = 0
         with DebuggedStream(stream) as stream_debug:
             t = tqdm(
                 total=float("inf"),
@@ -442,7 +1484,9 @@ class PacmanInstalledSet:
                 if key == "Name":
                     current_package = value.strip()
                     installed_set.add_package(current_package)
-                    t.update()
+                    parsed += 1
+                    if parsed % _PROGRESS_INTERVAL == 0:
+                        t.update(_PROGRESS_INTERVAL)
                 elif key == "Depends On":
                     if current_package is None:
                         raise ValueError("No package name found before dependencies")
@@ -491,6 +1535,109 @@ class PacmanInstalledSet:
         installed_set.finalise_dependency_sets()
         return installed_set
 
+    @staticmethod
+    @profiled("parse pacman -Qi")
+    def from_pacman_qi_buffer(buffer: str) -> "PacmanInstalledSet":
+        """
+        Parse the complete output of `pacman -Qi`, and return a PacmanInstalledSet object.
+        This is much faster than parsing line by line, because it only looks at the fields
+        it needs, and fills in the package objects directly.
+        """
+        records = buffer.split("\n\n")
+
+        # Parsing allocates lots of long-lived objects and no cycles, so don't let the
+        # garbage collector keep rescanning them
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            installed_set = PacmanInstalledSet._parse_qi_records(records)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+        installed_set.finalise_dependency_sets()
+        return installed_set
+
+    @staticmethod
+    def _parse_qi_records(records: "List[str]") -> "PacmanInstalledSet":
+        installed_set = PacmanInstalledSet()
+        packages = installed_set.packages
+        aliases = installed_set.aliases
+        all_dependencies: "Set[str]" = set()
+        strip_versions = partial(_VERSION_REQUIREMENT.sub, "")
+
+        with DebuggedStream(records, num_lines=1) as stream_debug, tqdm(
+            total=len(records),
+            unit="packages",
+            desc="Parsing pacman -Qi",
+            leave=False,
+        ) as t:
+            for parsed, record in enumerate(stream_debug, 1):
+                if parsed % _PROGRESS_INTERVAL == 0:
+                    t.update(_PROGRESS_INTERVAL)
+
+                match = _QI_RECORD.match(record)
+                if match is not None:
+                    fields = zip(_QI_RECORD_KEYS, match.groups())
+                else:
+                    fields = iter(_QI_FIELD.findall(record))
+
+                key, name = next(fields, ("", ""))
+                if not key:
+                    if record.strip():
+                        raise ValueError("Record without any recognised fields")
+                    continue
+                if key != "Name":
+                    raise ValueError("No package name found at start of record")
+                name = name.strip()
+                if name in packages:
+                    raise ValueError(f"Package {name} already added")
+                package = packages[name] = PacmanPackage(name)
+
+                for key, value in fields:
+                    if value == "None":
+                        continue
+                    if key == "Depends On":
+                        dependencies = strip_versions(value).split()
+                        package.dependencies.update(dependencies)
+                        all_dependencies.update(dependencies)
+                    elif key == "Optional Deps":
+                        for line in value.split("\n"):
+                            line = line.strip()
+                            if ":" in line:
+                                line = strip_versions(line[: line.index(":")].strip())
+                            package.optional_dependencies.add(line)
+                    elif key == "Installed Size":
+                        package.size = parse_size(value.strip())
+                    elif key == "Provides":
+                        for provided in strip_versions(value).split():
+                            aliases[provided] = name
+                    elif key == "Install Reason":
+                        if value == "Explicitly installed":
+                            package.explicit_install = True
+                        elif value != "Installed as a dependency for another package":
+                            print(
+                                "WARNING: Unknown install reason:",
+                                value,
+                                file=sys.stderr,
+                            )
+
+        installed_set.unknowns = all_dependencies.difference(packages, aliases)
+        return installed_set
+
+    @staticmethod
+    def from_pacman_qi_file(path: str) -> "PacmanInstalledSet":
+        """
+        Parse a file containing the output of `pacman -Qi`, and return a PacmanInstalledSet
+        object. The file is memory-mapped and decoded in one go.
+        """
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return PacmanInstalledSet.from_pacman_qi_buffer("")
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                buffer = str(mapped, "utf-8")
+        return PacmanInstalledSet.from_pacman_qi_buffer(buffer)
+
     def __repr__(self) -> str:
         return (
             "PacmanInstalledSet("
@@ -499,19 +1646,134 @@ class PacmanInstalledSet:
         )
 
     @staticmethod
-    def retrieve_pacman_packages():
+    @profiled("read local database")
+    def from_pacman_local_db(
+        db_path: str = "/var/lib/pacman/local", max_workers: "Optional[int]" = None
+    ) -> "PacmanInstalledSet":
         """
-        Retrieve the list of installed packages from pacman, and return
-        a PacmanInstalledSet object.
+        Read the pacman local database directly, and return a PacmanInstalledSet object.
+        Each installed package has a directory containing a `desc` file, which is read
+        in parallel. Unlike `pacman -Qi`, this gives exact sizes in bytes.
         """
+        with os.scandir(db_path) as it:
+            desc_paths = [
+                os.path.join(entry.path, "desc")
+                for entry in it
+                if entry.is_dir(follow_symlinks=False)
+            ]
+
+        installed_set = PacmanInstalledSet()
+        packages = installed_set.packages
+        aliases = installed_set.aliases
+        all_dependencies: "Set[str]" = set()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(
+            total=len(desc_paths),
+            unit="packages",
+            desc="Reading pacman database",
+            leave=False,
+        ) as t:
+            # Hand out files in chunks, since one task per file costs more in thread
+            # synchronisation than reading the file does
+            chunks = [
+                desc_paths[i : i + _DESC_CHUNK_SIZE]
+                for i in range(0, len(desc_paths), _DESC_CHUNK_SIZE)
+            ]
+            results = chain.from_iterable(executor.map(_read_pacman_descs, chunks))
+            for parsed, (path, fields) in enumerate(zip(desc_paths, results), 1):
+                if parsed % _PROGRESS_INTERVAL == 0:
+                    t.update(_PROGRESS_INTERVAL)
+
+                package, provides = PacmanPackage.from_pacman_desc(fields, path)
+                name = package.name
+                if name in packages:
+                    raise ValueError(f"Package {name} already added")
+                packages[name] = package
+                all_dependencies |= package.dependencies
+                for provided in provides:
+                    aliases[provided] = name
+
+        installed_set.unknowns = all_dependencies.difference(packages, aliases)
+        installed_set.finalise_dependency_sets()
+        return installed_set
 
-        # Use cache first
+    @profiled("update from local database")
+    def update_from_pacman_local_db(
+        self,
+        changed: "Iterable[str]",
+        db_path: str = "/var/lib/pacman/local",
+        since_mtime_ns: int = 0,
+    ) -> bool:
+        """
+        Bring a finalised installed set up to date with the pacman local database,
+        given the names of packages changed since it was built (as read from the pacman
+        log by `read_pacman_log_changes`). Packages whose database entries are newer than
+        `since_mtime_ns` are reread as well, in case they were missed in the log.
+        Returns False if the installed set could not be reconciled with the database,
+        in which case it should be rebuilt from scratch.
+        """
+        changed = set(changed)
+        entries = {}
+        with os.scandir(db_path) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                name = entry.name.rsplit("-", 2)[0]
+                entries[name] = entry
+                if entry.stat(follow_symlinks=False).st_mtime_ns > since_mtime_ns:
+                    changed.add(name)
+
+        removed = [
+            name for name in changed if name not in entries and name in self.packages
+        ]
+        # Dependencies on a removed package may have been through one of the names it
+        # provided, which another package may now provide instead
+        for name in removed:
+            changed.update(self.revdep_cache.get(name, ()))
+        changed.difference_update(removed)
+        changed.intersection_update(entries)
+
+        desc_paths = [os.path.join(entries[name].path, "desc") for name in changed]
         try:
-            with open("pacman_qi.txt", "r", encoding="utf-8") as file:
-                return PacmanInstalledSet.from_pacman_qi_stream(file)
+            updates = [
+                PacmanPackage.from_pacman_desc(fields, path)
+                for path, fields in zip(desc_paths, _read_pacman_descs(desc_paths))
+            ]
         except FileNotFoundError:
-            pass
+            return False
+
+        # Likewise for names which an upgraded package no longer provides
+        provided_by = defaultdict(set)
+        for alias, target in self.aliases.items():
+            provided_by[target].add(alias)
+        relinked = set()
+        for package, provides in updates:
+            if not provided_by[package.name].issubset(provides):
+                relinked.update(self.revdep_cache.get(package.name, ()))
+        relinked.difference_update(changed, removed)
+        relinked.intersection_update(entries)
+        desc_paths = [os.path.join(entries[name].path, "desc") for name in relinked]
+        try:
+            updates.extend(
+                PacmanPackage.from_pacman_desc(fields, path)
+                for path, fields in zip(desc_paths, _read_pacman_descs(desc_paths))
+            )
+        except FileNotFoundError:
+            return False
+
+        for name in removed:
+            self.remove_package(name)
+        for package, provides in updates:
+            self.replace_package(package, provides)
 
+        return self.packages.keys() == entries.keys()
+
+    @staticmethod
+    @profiled("run pacman -Qi")
+    def run_pacman_qi() -> "PacmanInstalledSet":
+        """
+        Run `pacman -Qi`, and parse its output into a PacmanInstalledSet object.
+        """
         env = dict(os.environ, LC_ALL="C", LANG="C", TERM="dumb")
         for bad_key in "TTY", "ROWS", "COLUMNS":
             env.pop(bad_key, None)
@@ -532,321 +1794,2979 @@ class PacmanInstalledSet:
             stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
             stderr_thread.start()
 
-            return PacmanInstalledSet.from_pacman_qi_stream(proc.stdout)
+            return PacmanInstalledSet.from_pacman_qi_buffer(proc.stdout.read())
+
+    @staticmethod
+    @profiled("load packages")
+    def retrieve_pacman_packages(
+        cache: "Optional[InstalledSetCache]" = None,
+        db_path: str = "/var/lib/pacman/local",
+        log_path: str = "/var/log/pacman.log",
+    ) -> "PacmanInstalledSet":
+        """
+        Retrieve the list of installed packages from pacman, and return
+        a PacmanInstalledSet object.
+        A `pacman -Qi` dump in the current directory takes precedence, followed by the
+        local database at `db_path`, falling back to running `pacman -Qi` itself.
+        If a cache is given, a previously parsed installed set is reused as long as its
+        input has not changed. An installed set cached from the local database is updated
+        in place with the transactions logged to `log_path` since it was stored.
+        """
+
+        # Use a hand-placed dump first
+        try:
+            key = "qi:" + hash_file(PACMAN_QI_DUMP)
+            load = partial(PacmanInstalledSet.from_pacman_qi_file, PACMAN_QI_DUMP)
+            from_db = False
+        except FileNotFoundError:
+            try:
+                key = "db:" + pacman_db_state(db_path)
+                load = partial(PacmanInstalledSet.from_pacman_local_db, db_path)
+                from_db = True
+            except FileNotFoundError:
+                # Let pacman work out where its database is
+                key = None
+                load = PacmanInstalledSet.run_pacman_qi
+                from_db = False
+
+        if cache is None or key is None:
+            return load()
+
+        cached = cache.load_latest()
+        if cached is not None and cached[0] == key:
+            return cached[2]
+
+        # Note where the log ends before reading the database, so that any transaction
+        # which happens in the meantime is replayed next time
+        state = None
+        if from_db:
+            try:
+                log_offset = os.stat(log_path).st_size
+            except FileNotFoundError:
+                log_offset = None
+            state = (log_offset, time.time_ns())
+
+        installed_set = None
+        if (
+            from_db
+            and cached is not None
+            and cached[0].startswith("db:")
+            and cached[1] is not None
+            and cached[1][0] is not None
+        ):
+            cached_log_offset, cached_time = cached[1]
+            try:
+                changed = read_pacman_log_changes(log_path, cached_log_offset)
+            except FileNotFoundError:
+                changed = None
+            if changed is not None:
+                installed_set = cached[2]
+                if not installed_set.update_from_pacman_local_db(
+                    changed, db_path, cached_time
+                ):
+                    installed_set = None
 
+        if installed_set is None:
+            installed_set = load()
+        cache.store(key, installed_set, state)
+        return installed_set
+
+
+PACMAN_QI_DUMP = "pacman_qi.txt"
+
+
+def _read_pacman_desc(path: str) -> "Dict[str, List[str]]":
+    """
+    Read a `desc` file from the pacman local database, and return its fields.
+    Each field is a `%NAME%` line followed by one value per line, ending at a blank line.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        text = file.read()
+
+    fields = {}
+    for block in text.split("\n\n"):
+        lines = block.strip("\n").split("\n")
+        key = lines[0]
+        if len(key) > 2 and key[0] == "%" and key[-1] == "%":
+            fields[key[1:-1]] = lines[1:]
+    return fields
+
+
+def _read_pacman_descs(paths: "List[str]") -> "List[Dict[str, List[str]]]":
+    return [_read_pacman_desc(path) for path in paths]
+
+
+_PACMAN_LOG_TRANSACTION = re.compile(
+    rb"^\[[^\]\n]*\] \[ALPM\] "
+    rb"(?:installed|upgraded|downgraded|reinstalled|removed) (\S+) \(",
+    re.MULTILINE,
+)
+
+
+@profiled("read pacman log")
+def read_pacman_log_changes(log_path: str, offset: int) -> "Optional[Set[str]]":
+    """
+    Read the names of all packages installed, upgraded, downgraded, reinstalled or
+    removed in the pacman log after the given byte offset.
+    Returns None if the log is shorter than the offset, e.g. because it was rotated.
+    """
+    with open(log_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < offset:
+            return None
+        file.seek(offset)
+        data = file.read()
+    return {
+        match.group(1).decode("utf-8", "replace")
+        for match in _PACMAN_LOG_TRANSACTION.finditer(data)
+    }
+
+
+def hash_file(path: str) -> str:
+    """
+    Compute the SHA-256 hash of a file's contents, as a hex string.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(partial(file.read, 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def pacman_db_state(db_path: str) -> str:
+    """
+    Summarise the state of the pacman local database as a string, which changes whenever
+    a package is installed, upgraded or removed.
+    """
+    latest = os.stat(db_path).st_mtime_ns
+    entries = 0
+    with os.scandir(db_path) as it:
+        for entry in it:
+            entries += 1
+            latest = max(latest, entry.stat(follow_symlinks=False).st_mtime_ns)
+    return f"{os.path.realpath(db_path)}:{entries}:{latest}"
+
+
+def default_cache_dir() -> str:
+    """
+    Get the default directory for the installed set cache.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "pacman_graph")
+
+
+class InstalledSetCache:
+    """
+    On-disk cache of a finalised PacmanInstalledSet, in a compact binary format.
+
+    The file starts with a magic number and a header recording the format version and
+    the key describing the input the installed set was built from. The body stores the
+    package graph as CSR arrays, which are loaded straight back into a PackageGraph
+    without resolving aliases or rebuilding reverse dependencies again.
+    """
+
+    __slots__ = ("path",)
+
+    MAGIC = b"PGRAPHC\n"
+    FORMAT = (2, sys.byteorder, array("I").itemsize, array("q").itemsize)
+
+    path: str
+
+    def __init__(self, cache_dir: str):
+        self.path = os.path.join(cache_dir, "installed_set.cache")
+
+    def load(self, key: str) -> "Optional[PacmanInstalledSet]":
+        """
+        Load the cached installed set, if there is one for the given key.
+        """
+        cached = self.load_latest()
+        if cached is None or cached[0] != key:
+            return None
+        return cached[2]
+
+    @profiled("load cache")
+    def load_latest(self) -> "Optional[Tuple[str, Any, PacmanInstalledSet]]":
+        """
+        Load the cached installed set whatever its key, and return the key, the state
+        stored alongside it, and the installed set itself.
+        """
+        try:
+            with open(self.path, "rb") as file:
+                if file.read(len(self.MAGIC)) != self.MAGIC:
+                    return None
+                header = marshal.load(file)
+                if header[0] != self.FORMAT:
+                    return None
+                _, key, state = header
+                payload = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return key, state, self._from_payload(payload)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    @profiled("store cache")
+    def store(self, key: str, installed_set: "PacmanInstalledSet", state: "Any" = None):
+        """
+        Store an installed set in the cache under the given key, replacing any previous one.
+        `state` is any marshallable value, for use in bringing the installed set up to date
+        once the key no longer matches.
+        """
+        cache_dir = os.path.dirname(self.path)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=cache_dir, delete=False) as file:
+            try:
+                file.write(self.MAGIC)
+                marshal.dump((self.FORMAT, key, state), file)
+                marshal.dump(self._to_payload(installed_set), file)
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, self.path)
 
-class OkLabTransform:
     @staticmethod
-    def rgb_linearise(value: float) -> float:
-        if value >= 0.0031308:
-            return (1.055) * value ** (1.0 / 2.4) - 0.055
-        else:
-            return 12.92 * value
+    def _to_payload(installed_set: "PacmanInstalledSet") -> "tuple":
+        graph = installed_set.get_graph()
+
+        packages = installed_set.packages.values()
+        return (
+            "\0".join(graph.names),
+            graph.num_packages,
+            array(
+                "q",
+                (-1 if package.size is None else package.size for package in packages),
+            ).tobytes(),
+            bytes(package.explicit_install for package in packages),
+            graph.dep_offsets.tobytes(),
+            graph.dep_targets.tobytes(),
+            graph.revdep_offsets.tobytes(),
+            graph.revdep_targets.tobytes(),
+            graph.optional_offsets.tobytes(),
+            graph.optional_targets.tobytes(),
+            installed_set.aliases,
+            sorted(installed_set.unknowns),
+            {
+                name: sorted(revdeps)
+                for name, revdeps in installed_set.missing_optional_revdeps.items()
+            },
+        )
 
     @staticmethod
-    def rgb_delinearise(value: float) -> float:
-        if value >= 0.04045:
-            return ((value + 0.055) / (1 + 0.055)) ** 2.4
+    def _from_payload(payload: "tuple") -> "PacmanInstalledSet":
+        (
+            joined_names,
+            num_packages,
+            size_bytes,
+            explicit_flags,
+            dep_offset_bytes,
+            dep_target_bytes,
+            revdep_offset_bytes,
+            revdep_target_bytes,
+            optional_offset_bytes,
+            optional_target_bytes,
+            aliases,
+            unknowns,
+            missing_optional_revdeps,
+        ) = payload
+
+        names = joined_names.split("\0") if joined_names else []
+        sizes = array("q")
+        sizes.frombytes(size_bytes)
+        csr = []
+        for data in (
+            dep_offset_bytes,
+            dep_target_bytes,
+            revdep_offset_bytes,
+            revdep_target_bytes,
+            optional_offset_bytes,
+            optional_target_bytes,
+        ):
+            values = array("I")
+            values.frombytes(data)
+            csr.append(values)
+        (
+            dep_offsets,
+            dep_targets,
+            revdep_offsets,
+            revdep_targets,
+            optional_offsets,
+            optional_targets,
+        ) = csr
+
+        graph_sizes = [max(size, 0) for size in sizes]
+        graph_sizes.extend(0 for _ in range(len(names) - num_packages))
+        graph = PackageGraph(
+            names,
+            num_packages,
+            graph_sizes,
+            dep_offsets,
+            dep_targets,
+            (revdep_offsets, revdep_targets),
+            (optional_offsets, optional_targets),
+        )
+
+        installed_set = PacmanInstalledSet()
+        installed_set.aliases = aliases
+        installed_set.unknowns = set(unknowns)
+        installed_set.revdep_cache = revdep_cache = defaultdict(set)
+        installed_set.optional_revdep_cache = optional_revdep_cache = defaultdict(set)
+        installed_set.missing_optional_revdeps = defaultdict(set)
+        for name, revdeps in missing_optional_revdeps.items():
+            installed_set.missing_optional_revdeps[name].update(revdeps)
+
+        packages = installed_set.packages
+        for package_id in range(num_packages):
+            name = names[package_id]
+            package = packages[name] = PacmanPackage(name)
+            package.size = None if sizes[package_id] < 0 else sizes[package_id]
+            package.explicit_install = bool(explicit_flags[package_id])
+            package.dependencies = set(
+                map(names.__getitem__, graph.dependencies(package_id))
+            )
+            package.optional_dependencies = set(
+                map(
+                    names.__getitem__,
+                    optional_targets[
+                        optional_offsets[package_id] : optional_offsets[package_id + 1]
+                    ],
+                )
+            )
+            for dependency in package.optional_dependencies:
+                optional_revdep_cache[dependency].add(name)
+
+        for package_id, name in enumerate(names):
+            revdeps = graph.reverse_dependencies(package_id)
+            if revdeps:
+                revdep_cache[name] = set(map(names.__getitem__, revdeps))
+
+        installed_set.graph = graph
+        return installed_set
+
+
+_BYTE_BITS = tuple(
+    tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)
+)
+
+
+def bitset_ids(bits: int) -> "Iterator[int]":
+    """
+    Iterate over the indices of the set bits in a bitset, in ascending order.
+    """
+    base = 0
+    for byte in bits.to_bytes((bits.bit_length() + 7) // 8, "little"):
+        if byte:
+            for bit in _BYTE_BITS[byte]:
+                yield base + bit
+        base += 8
+
+
+def bitset_count(bits: int) -> int:
+    """
+    Count the set bits in a bitset.
+    """
+    return bin(bits).count("1")
+
+
+if hasattr(int, "bit_count"):
+    # Python 3.10+
+    bitset_count = int.bit_count
+
+
+_FLAG_DIGITS = bytes.maketrans(b"\0\1", b"01")
+
+
+def bitset_from_flags(flags: "Iterable[bool]") -> int:
+    """
+    Build a bitset from one flag per index, in ascending order.
+    """
+    return int(bytes(flags).translate(_FLAG_DIGITS)[::-1] or b"0", 2)
+
+
+def floor_fraction_sum(numerators: "Dict[int, int]") -> int:
+    """
+    Round down the exact sum of `numerator / denominator` for each denominator in a
+    dictionary of non-negative numerators.
+    """
+    whole = 0
+    remainder = Fraction(0)
+    for denominator, numerator in numerators.items():
+        quotient, numerator = divmod(numerator, denominator)
+        whole += quotient
+        if numerator:
+            remainder += Fraction(numerator, denominator)
+    return whole + int(remainder)
+
+
+def bitset_from_mask(mask: "numpy.ndarray") -> int:
+    """
+    Build a bitset from an indicator vector; the inverse of `PackageGraph.bitset_mask`.
+    Requires NumPy.
+    """
+    packed = numpy.packbits(mask.astype(bool, copy=False), bitorder="little")
+    return int.from_bytes(packed.tobytes(), "little")
+
+
+class PackageGraph:
+    """
+    Compact, integer-indexed form of an installed set's dependency graph.
+
+    Package names are interned to dense IDs: installed packages come first, in insertion
+    order, followed by unknown dependencies. Dependencies and reverse dependencies are
+    stored as CSR arrays, i.e. the targets of node `i` are
+    `targets[offsets[i]:offsets[i + 1]]`. Sets of packages are represented as bitsets in
+    Python ints, with bit `i` set if package `i` is a member.
+    """
+
+    __slots__ = (
+        "names",
+        "ids",
+        "num_packages",
+        "sizes",
+        "size_vector",
+        "dep_offsets",
+        "dep_targets",
+        "revdep_offsets",
+        "revdep_targets",
+        "optional_offsets",
+        "optional_targets",
+        "revdep_counts",
+        "revdep_matrix",
+    )
+
+    names: "List[str]"
+    ids: "Dict[str, int]"
+    num_packages: int
+    sizes: "List[int]"
+    size_vector: "Optional[numpy.ndarray]"
+    dep_offsets: "array[int]"
+    dep_targets: "array[int]"
+    revdep_offsets: "array[int]"
+    revdep_targets: "array[int]"
+    optional_offsets: "array[int]"
+    optional_targets: "array[int]"
+    revdep_counts: "Optional[numpy.ndarray]"
+    revdep_matrix: "Optional[scipy_sparse.csr_matrix]"
+
+    def __init__(
+        self,
+        names: "List[str]",
+        num_packages: int,
+        sizes: "List[int]",
+        dep_offsets: "array[int]",
+        dep_targets: "array[int]",
+        revdep_csr: "Optional[Tuple[array[int], array[int]]]" = None,
+        optional_csr: "Optional[Tuple[array[int], array[int]]]" = None,
+    ):
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
+        self.num_packages = num_packages
+        self.sizes = sizes
+        self.size_vector = (
+            numpy.array(sizes, dtype=numpy.int64) if numpy is not None else None
+        )
+        self.dep_offsets = dep_offsets
+        self.dep_targets = dep_targets
+
+        if revdep_csr is not None:
+            self.revdep_offsets, self.revdep_targets = revdep_csr
         else:
-            return value / 12.92
+            revdep_lists: "List[List[int]]" = [[] for _ in names]
+            for package_id in range(len(names)):
+                for dependency in dep_targets[
+                    dep_offsets[package_id] : dep_offsets[package_id + 1]
+                ]:
+                    revdep_lists[dependency].append(package_id)
+            self.revdep_offsets, self.revdep_targets = self._to_csr(revdep_lists)
+
+        if optional_csr is not None:
+            self.optional_offsets, self.optional_targets = optional_csr
+        else:
+            self.optional_offsets = array("I", [0] * (len(names) + 1))
+            self.optional_targets = array("I")
+
+        # Row `q` of the reverse dependency matrix has a 1 in column `r` for every
+        # package `r` which depends on `q`, so multiplying it by a package set's
+        # indicator vector counts each package's reverse dependencies in the set
+        if scipy_sparse is not None:
+            offsets = numpy.frombuffer(self.revdep_offsets, dtype=numpy.uint32)
+            targets = numpy.frombuffer(self.revdep_targets, dtype=numpy.uint32)
+            self.revdep_counts = numpy.diff(offsets).astype(numpy.float64)
+            self.revdep_matrix = scipy_sparse.csr_matrix(
+                (numpy.ones(len(targets)), targets, offsets),
+                shape=(len(names), len(names)),
+            )
+        else:
+            self.revdep_counts = None
+            self.revdep_matrix = None
 
     @staticmethod
-    def from_rgb(r: float, g: float, b: float) -> "Tuple[float, float, float]":
-        r = OkLabTransform.rgb_delinearise(r)
-        g = OkLabTransform.rgb_delinearise(g)
-        b = OkLabTransform.rgb_delinearise(b)
-        l = 0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b
-        m = 0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b
-        s = 0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b
-
-        l_ = l ** (1 / 3)
-        m_ = m ** (1 / 3)
-        s_ = s ** (1 / 3)
+    @profiled("build package graph")
+    def from_installed_set(installed_set: "PacmanInstalledSet") -> "PackageGraph":
+        """
+        Build the graph of an installed set whose dependency sets have been finalised.
 
-        return (
-            0.2104542553 * l_ + 0.7936177850 * m_ - 0.0040720468 * s_,
-            1.9779984951 * l_ - 2.4285922050 * m_ + 0.4505937099 * s_,
-            0.0259040371 * l_ + 0.7827717662 * m_ - 0.8086757660 * s_,
+        Each node's targets, and the unknown packages, are kept in the iteration order
+        of the installed set's own sets, so that graph output walked from here comes
+        out in the same order as walking the sets, even after a round trip through the
+        cache.
+        """
+        packages = installed_set.packages
+        names = list(packages)
+        ids = {name: i for i, name in enumerate(names)}
+        for name in installed_set.unknowns:
+            ids[name] = len(names)
+            names.append(name)
+
+        def intern(name: str) -> int:
+            package_id = ids.get(name)
+            if package_id is None:
+                package_id = ids[name] = len(names)
+                names.append(name)
+            return package_id
+
+        ids_get = ids.get
+        dependency_lists = []
+        for package in packages.values():
+            dependency_ids = [ids_get(name) for name in package.dependencies]
+            if None in dependency_ids:
+                dependency_ids = [intern(name) for name in package.dependencies]
+            dependency_lists.append(dependency_ids)
+        dependency_lists.extend([] for _ in range(len(names) - len(packages)))
+
+        # Optional dependencies are only ever recorded on installed packages
+        optional_lists = [
+            [ids[name] for name in package.optional_dependencies]
+            for package in packages.values()
+        ]
+        optional_lists.extend([] for _ in range(len(names) - len(packages)))
+
+        sizes = [package.size or 0 for package in packages.values()]
+        sizes.extend(0 for _ in range(len(names) - len(packages)))
+
+        return PackageGraph(
+            names,
+            len(packages),
+            sizes,
+            *PackageGraph._to_csr(dependency_lists),
+            optional_csr=PackageGraph._to_csr(optional_lists),
         )
 
     @staticmethod
-    def to_rgb(l: float, a: float, b: float) -> "Tuple[float, float, float]":
-        l_ = l + 0.3963377774 * a + 0.2158037573 * b
-        m_ = l - 0.1055613458 * a - 0.0638541728 * b
-        s_ = l - 0.0894841775 * a - 1.2914855480 * b
+    def _to_csr(lists: "List[List[int]]") -> "Tuple[array[int], array[int]]":
+        offsets = array("I", [0])
+        targets = array("I")
+        for targets_of_node in lists:
+            targets.extend(targets_of_node)
+            offsets.append(len(targets))
+        return offsets, targets
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def dependencies(self, package_id: int) -> "array[int]":
+        """
+        Get the IDs of the dependencies of a package.
+        """
+        offsets = self.dep_offsets
+        return self.dep_targets[offsets[package_id] : offsets[package_id + 1]]
 
-        l = l_**3
-        m = m_**3
-        s = s_**3
+    def optional_dependencies(self, package_id: int) -> "array[int]":
+        """
+        Get the IDs of the optional dependencies of a package.
+        """
+        offsets = self.optional_offsets
+        return self.optional_targets[offsets[package_id] : offsets[package_id + 1]]
 
-        r = 4.0767416621 * l - 3.3077115913 * m + 0.2309699292 * s
-        g = -1.2684380046 * l + 2.6097574011 * m - 0.3413193965 * s
-        b = -0.0041960863 * l - 0.7034186147 * m + 1.7076147010 * s
+    def reverse_dependencies(self, package_id: int) -> "array[int]":
+        """
+        Get the IDs of the reverse dependencies of a package.
+        """
+        offsets = self.revdep_offsets
+        return self.revdep_targets[offsets[package_id] : offsets[package_id + 1]]
 
-        return (
-            OkLabTransform.rgb_linearise(r),
-            OkLabTransform.rgb_linearise(g),
-            OkLabTransform.rgb_linearise(b),
+    def to_bitset(self, names: "Iterable[str]") -> int:
+        """
+        Convert a set of package names to a bitset.
+        """
+        ids = self.ids
+        bits = 0
+        for name in names:
+            bits |= 1 << ids[name]
+        return bits
+
+    def to_names(self, bits: int) -> "Set[str]":
+        """
+        Convert a bitset to a set of package names.
+        """
+        names = self.names
+        return {names[i] for i in bitset_ids(bits)}
+
+    def bitset_size(self, bits: int) -> int:
+        """
+        Compute the total size of the packages in a bitset.
+        """
+        weights = self.size_vector if self.size_vector is not None else self.sizes
+        return int(self.bitset_dot(bits, weights))
+
+    def bitset_dot(self, bits: int, weights: "Sequence[float]") -> float:
+        """
+        Sum a per-package weight vector over the packages in a bitset.
+        With NumPy available and a NumPy weight vector, this is a masked dot product.
+        """
+        if numpy is not None and isinstance(weights, numpy.ndarray):
+            return weights @ self.bitset_mask(bits)
+        return sum(map(weights.__getitem__, bitset_ids(bits)))
+
+    def bitset_mask(self, bits: int) -> "numpy.ndarray":
+        """
+        Convert a bitset to an indicator vector, with a 1 for every package in the set.
+        Requires NumPy.
+        """
+        packed = numpy.frombuffer(
+            bits.to_bytes((len(self.names) + 7) // 8, "little"), dtype=numpy.uint8
         )
+        return numpy.unpackbits(packed, bitorder="little")[: len(self.names)]
 
 
-def lerp_vec3(
-    a: "Tuple[float, float, float]", b: "Tuple[float, float, float]", t: float
-) -> "Tuple[float, float, float]":
-    return (
-        a[0] * (1 - t) + b[0] * t,
-        a[1] * (1 - t) + b[1] * t,
-        a[2] * (1 - t) + b[2] * t,
+def strongly_connected_components(graph: PackageGraph) -> "List[List[int]]":
+    """
+    Find the strongly connected components of a package graph using Tarjan's algorithm.
+    The components are returned in reverse topological order, i.e. every component
+    comes after all of the components it has edges to.
+    This is iterative, so it is not limited by Python's recursion depth.
+    """
+    unvisited = -1
+    num_nodes = len(graph)
+    index = [unvisited] * num_nodes
+    lowlink = [0] * num_nodes
+    on_stack = [False] * num_nodes
+    stack: "List[int]" = []
+    components: "List[List[int]]" = []
+    counter = 0
+
+    for root in range(num_nodes):
+        if index[root] != unvisited:
+            continue
+
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, iter(graph.dependencies(root)))]
+
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if index[child] == unvisited:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    work.append((child, iter(graph.dependencies(child))))
+                    break
+                elif on_stack[child] and index[child] < lowlink[node]:
+                    lowlink[node] = index[child]
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if lowlink[node] < lowlink[parent]:
+                        lowlink[parent] = lowlink[node]
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    return components
+
+
+class RetainedSetEngine:
+    """
+    Precomputed retained sets and sizes for every package in an installed set.
+
+    The dependency graph is condensed into its strongly connected components, and the
+    retained set of each component is computed once, after those of its dependencies.
+    All packages in a dependency cycle retain each other, so they share one retained set.
+    Retained sets are stored as bitsets over the IDs of a `PackageGraph`.
+    Unknown (not installed) dependencies are treated as empty packages with no dependencies.
+    """
+
+    __slots__ = (
+        "installed_set",
+        "graph",
+        "component_of",
+        "components",
+        "retained_bitsets",
+        "retained_sizes",
     )
 
+    installed_set: "PacmanInstalledSet"
+    graph: PackageGraph
+    component_of: "array[int]"
+    components: "List[List[int]]"
+    retained_bitsets: "List[int]"
+    retained_sizes: "List[Optional[int]]"
+
+    def __init__(self, installed_set: "PacmanInstalledSet", graph: PackageGraph):
+        self.installed_set = installed_set
+        self.graph = graph
+        self.components = components = strongly_connected_components(graph)
+        self.component_of = component_of = array("I", bytes(4 * len(graph)))
+        self.retained_bitsets = retained_bitsets = []
+
+        for component_index, component in enumerate(components):
+            bits = 0
+            for member in component:
+                component_of[member] = component_index
+                bits |= 1 << member
+
+            child_components = {
+                component_of[dependency]
+                for member in component
+                for dependency in graph.dependencies(member)
+            }
+            child_components.discard(component_index)
+            for child in child_components:
+                bits |= retained_bitsets[child]
+
+            retained_bitsets.append(bits)
+
+        # Summing sizes over every bitset is most of the cost of building the engine,
+        # and top-K queries only need some of them, so they are filled in on demand
+        self.retained_sizes = [None] * len(components)
+
+    def _component(self, package: str) -> int:
+        return self.component_of[
+            self.graph.ids[self.installed_set.resolve_alias(package)]
+        ]
+
+    def retained_bitset(self, packages: "Iterable[str]") -> int:
+        """
+        Look up the bitset of packages retained by a set of packages.
+        """
+        if isinstance(packages, str):
+            return self.retained_bitsets[self._component(packages)]
+        bits = 0
+        for package in packages:
+            bits |= self.retained_bitsets[self._component(package)]
+        return bits
+
+    def retained_set(self, packages: "Iterable[str]") -> "Set[str]":
+        """
+        Look up the set of packages retained by a set of packages.
+        """
+        return self.graph.to_names(self.retained_bitset(packages))
+
+    def component_retained_size(self, component: int) -> int:
+        """
+        Get the retained size of a component, computing it on first use.
+        """
+        size = self.retained_sizes[component]
+        if size is None:
+            size = self.graph.bitset_size(self.retained_bitsets[component])
+            self.retained_sizes[component] = size
+        return size
+
+    def retained_size(self, packages: "Iterable[str]") -> int:
+        """
+        Look up the retained size of a set of packages.
+        """
+        if isinstance(packages, str):
+            return self.component_retained_size(self._component(packages))
+
+        components = {self._component(package) for package in packages}
+        if len(components) == 1:
+            return self.component_retained_size(next(iter(components)))
+
+        bits = 0
+        for component in components:
+            bits |= self.retained_bitsets[component]
+        return self.graph.bitset_size(bits)
+
+    def adjusted_size(self, packages: "Iterable[str]") -> int:
+        """
+        Compute the adjusted size of a set of packages with sparse matrix products, as in
+        `PacmanInstalledSet.compute_adjusted_size`. Requires SciPy.
+        """
+        graph = self.graph
+        if isinstance(packages, str):
+            packages = [packages]
+        resolve_alias = self.installed_set.resolve_alias
+        package_ids = list({graph.ids[resolve_alias(name)] for name in packages})
+        return self.exact_adjusted_size(package_ids, self.retained_bitset(packages))
+
+    def exact_adjusted_size(self, package_ids: "List[int]", bits: int) -> int:
+        """
+        Compute the adjusted size of a set of package IDs given the bitset of packages
+        they retain, summing the weighted sizes exactly as numerators by denominator.
+        Uses sparse matrix products if SciPy is available.
+        """
+        graph = self.graph
+        sizes = graph.sizes
+        adjusted_size = sum(map(sizes.__getitem__, package_ids))
+        numerators: "Dict[int, int]" = defaultdict(int)
+
+        if graph.revdep_matrix is None:
+            excluded = set(package_ids)
+            for package_id in bitset_ids(bits):
+                if package_id in excluded:
+                    continue
+                revdeps = graph.reverse_dependencies(package_id)
+                count = sum(1 for revdep in revdeps if bits >> revdep & 1)
+                if count:
+                    numerators[len(revdeps)] += sizes[package_id] * count
+            return adjusted_size + floor_fraction_sum(numerators)
+
+        retained = graph.bitset_mask(bits)
+        retained_revdeps = (graph.revdep_matrix @ retained).astype(numpy.int64)
+        # The packages themselves count in full rather than by weight
+        retained_revdeps[package_ids] = 0
+        weighted = numpy.flatnonzero(retained_revdeps * retained)
+        if not len(weighted):
+            return adjusted_size
+
+        denominators = graph.revdep_counts[weighted].astype(numpy.int64)
+        products = graph.size_vector[weighted] * retained_revdeps[weighted]
+        order = numpy.argsort(denominators, kind="stable")
+        denominators = denominators[order]
+        starts = numpy.flatnonzero(
+            numpy.concatenate(([True], denominators[1:] != denominators[:-1]))
+        )
+        sums = numpy.add.reduceat(products[order], starts)
+        numerators.update(zip(denominators[starts].tolist(), sums.tolist()))
+        return adjusted_size + floor_fraction_sum(numerators)
+
+    def all_retained_sizes(self) -> "List[int]":
+        """
+        Get the retained size of every node in the graph, indexed by ID.
+        """
+        retained_sizes = list(
+            map(self.component_retained_size, range(len(self.components)))
+        )
+        return [retained_sizes[component] for component in self.component_of]
+
+    def top_retained(self, count: int) -> "List[Tuple[int, int]]":
+        """
+        Find the `count` installed packages with the largest retained sizes, as pairs of
+        ID and size, largest first and then by ID. Only the retained sizes which could
+        make the cut are computed.
+
+        A package's retained size is at most that of any package depending on it, so
+        components are searched best-first from those nothing depends on, and the
+        dependencies of a component are only considered once it has made the cut.
+        Until its retained size is computed, a component is ranked by an upper bound:
+        the least of its own size plus the bounds of its dependencies, the total of as
+        many of the largest package sizes as it retains, and the retained size of the
+        component which led to it.
+        """
+        graph = self.graph
+        components = self.components
+        component_of = self.component_of
+        retained_sizes = self.retained_sizes
+        num_packages = graph.num_packages
+        count = min(count, num_packages)
+        if count <= 0:
+            return []
+        if None not in retained_sizes:
+            index = SizeIndex(
+                range(num_packages), self.all_retained_sizes()[:num_packages]
+            )
+            return index.top(count)
+
+        sizes = graph.sizes
+        largest_first = sorted(sizes, reverse=True)
+        largest_sums = [0]
+        largest_sums.extend(accumulate(largest_first))
+        bounds: "List[int]" = []
+        children: "List[Set[int]]" = []
+        has_parent = bytearray(len(components))
+        for component_index, component in enumerate(components):
+            child_components = {
+                component_of[dependency]
+                for member in component
+                for dependency in graph.dependencies(member)
+            }
+            child_components.discard(component_index)
+            children.append(child_components)
+            bound = sum(map(sizes.__getitem__, component))
+            for child in child_components:
+                has_parent[child] = True
+                bound += bounds[child]
+            count_bound = largest_sums[
+                bitset_count(self.retained_bitsets[component_index])
+            ]
+            bounds.append(min(bound, count_bound))
+
+        # Entries are (negated size or bound, component, whether the size is exact)
+        queue = [
+            (-bounds[component], component, False)
+            for component in range(len(components))
+            if not has_parent[component]
+        ]
+        heapq.heapify(queue)
+        queued = set(component for _, component, _ in queue)
+        found: "List[Tuple[int, int]]" = []
+        cutoff: "Optional[int]" = None
+        while queue:
+            key, component, exact = queue[0]
+            if cutoff is not None and -key < cutoff:
+                break
+            if not exact:
+                heapq.heapreplace(
+                    queue, (-self.component_retained_size(component), component, True)
+                )
+                continue
+            heapq.heappop(queue)
+            found.extend(
+                (member, -key)
+                for member in components[component]
+                if member < num_packages
+            )
+            if cutoff is None and len(found) >= count:
+                # Packages of exactly this size may still rank above some found by ID
+                cutoff = -key
+            for child in children[component]:
+                if child not in queued:
+                    queued.add(child)
+                    heapq.heappush(queue, (max(key, -bounds[child]), child, False))
+
+        found.sort(key=lambda item: (-item[1], item[0]))
+        return found[:count]
+
+    def all_retained_counts(self) -> "List[int]":
+        """
+        Get the number of packages retained by every node in the graph, indexed by ID.
+        """
+        counts = [bitset_count(bits) for bits in self.retained_bitsets]
+        return [counts[component] for component in self.component_of]
+
+    def all_adjusted_sizes(self) -> "List[int]":
+        """
+        Get the adjusted size of every node in the graph, indexed by ID.
+
+        The weight of a dependency `q` in the adjusted size of `p` is
+        `|revdeps(q) & retained(p)| / |revdeps(q)|`. Summing `size(q) * weight` over the
+        retained set counts each edge `r -> q` inside the retained set once, and every
+        dependency of a retained package is itself retained, so the sum is equal to the
+        sum over `r` in the retained set of the per-package constant
+        `sum(size(q) / |revdeps(q)| for q in deps(r))`.
+        That sum only depends on the retained set, so it is computed once per component.
+        The only correction needed is for `p` itself, which is excluded from the sum but
+        may be a dependency of other packages in its own dependency cycle.
+
+        These sums are done in floating point, so wherever their rounding error could
+        change the size once rounded down, it is computed exactly instead, as for a
+        single package.
+        """
+        graph = self.graph
+        sizes = graph.sizes
+        component_of = self.component_of
+        dep_offsets = graph.dep_offsets
+        max_degree = max(
+            (dep_offsets[i + 1] - dep_offsets[i] for i in range(len(graph))), default=0
+        )
+
+        share = [
+            size / len(revdeps) if revdeps else 0.0
+            for size, revdeps in zip(
+                sizes, map(graph.reverse_dependencies, range(len(graph)))
+            )
+        ]
+        dependency_share: "Sequence[float]" = [
+            sum(map(share.__getitem__, graph.dependencies(package_id)))
+            for package_id in range(len(graph))
+        ]
+        if numpy is not None:
+            dependency_share = numpy.array(dependency_share, dtype=numpy.float64)
+
+        retained_bitsets = self.retained_bitsets
+        component_shares = [
+            graph.bitset_dot(bits, dependency_share) for bits in retained_bitsets
+        ]
+        # Each component's share sums at most this many terms, and each dependency
+        # share at most `max_degree`
+        component_terms = [bitset_count(bits) for bits in retained_bitsets]
+
+        adjusted_sizes = []
+        for package_id, size in enumerate(sizes):
+            component = component_of[package_id]
+            cyclic_revdeps = sum(
+                1
+                for revdep in graph.reverse_dependencies(package_id)
+                if component_of[revdep] == component
+            )
+            correction = share[package_id] * cyclic_revdeps
+            component_share = component_shares[component]
+            adjusted_size = size + component_share - correction
+            rounded = math.floor(adjusted_size)
+
+            # A bound on the rounding error of summing n non-negative terms in
+            # floating point is n * 2**-53 times their total, doubled for safety.
+            # Without any shares, e.g. with no dependencies, the size is exact.
+            error_bound = (
+                (component_terms[component] + max_degree + 4)
+                * 2.0**-52
+                * (size + component_share + correction)
+            )
+            if component_share and (
+                adjusted_size - rounded <= error_bound
+                or rounded + 1 - adjusted_size <= error_bound
+            ):
+                rounded = self.exact_adjusted_size(
+                    [package_id], retained_bitsets[component]
+                )
+            adjusted_sizes.append(rounded)
+        return adjusted_sizes
+
+    def source_nodes(self) -> "List[int]":
+        """
+        Get every node in a component that no other component depends on.
+        Every node in the graph is reachable from these.
+        """
+        graph = self.graph
+        component_of = self.component_of
+        sources = []
+        for component_index, component in enumerate(self.components):
+            if all(
+                component_of[revdep] == component_index
+                for member in component
+                for revdep in graph.reverse_dependencies(member)
+            ):
+                sources.extend(component)
+        return sources
+
+
+class DominatorTree:
+    """
+    Dominator tree of an installed set's dependency graph.
+
+    The tree is rooted at a virtual root node which depends on every explicitly installed
+    package, and on every package in a component that nothing else depends on (so that
+    orphaned packages and orphaned dependency cycles are also reachable).
+    A package `p` dominates `q` if every chain of dependencies from the root to `q` passes
+    through `p`, i.e. `q` would no longer be needed if `p` were removed. This is the
+    "uniquely retained by" relation, and the uniquely retained size of a package is the
+    total size of its subtree.
+
+    Nodes can be excluded from the graph, to find the dominator tree of what would be
+    left after removing them.
+
+    Built with the Lengauer-Tarjan algorithm (the simple version, with path compression).
+    """
+
+    __slots__ = (
+        "graph",
+        "root",
+        "roots",
+        "idom",
+        "preorder",
+        "subtree_sizes",
+        "_subtree_end",
+        "_preorder_index",
+    )
+
+    graph: PackageGraph
+    root: int
+    roots: "List[int]"
+    idom: "List[int]"
+    preorder: "List[int]"
+    subtree_sizes: "List[int]"
+    _subtree_end: "List[int]"
+    _preorder_index: "List[int]"
+
+    def __init__(
+        self,
+        graph: PackageGraph,
+        roots: "Iterable[int]",
+        excluded: "Iterable[int]" = (),
+    ):
+        self.graph = graph
+        self.root = root = len(graph)
+        excluded = set(excluded)
+        self.roots = roots = sorted(set(roots) - excluded)
+        is_root = [False] * root
+        for node in roots:
+            is_root[node] = True
+
+        def predecessors(node: int) -> "Iterable[int]":
+            revdeps = graph.reverse_dependencies(node)
+            return [root, *revdeps] if is_root[node] else revdeps
+
+        # Number the nodes in DFS preorder; everything below works on these numbers.
+        # Excluded nodes are treated as already visited, so they are never numbered
+        unvisited = -1
+        number = [unvisited] * (root + 1)
+        for node in excluded:
+            number[node] = -2
+        vertex: "List[int]" = []
+        parent: "List[int]" = []
+        work = [(root, unvisited)]
+        while work:
+            node, node_parent = work.pop()
+            if number[node] != unvisited:
+                continue
+            number[node] = len(vertex)
+            vertex.append(node)
+            parent.append(node_parent)
+            children = roots if node == root else graph.dependencies(node)
+            work.extend(
+                (child, number[node])
+                for child in reversed(children)
+                if number[child] == unvisited
+            )
+
+        count = len(vertex)
+        semi = list(range(count))
+        idom = [0] * count
+        ancestor = [unvisited] * count
+        label = list(range(count))
+        bucket: "List[List[int]]" = [[] for _ in range(count)]
+
+        def evaluate(v: int) -> int:
+            if ancestor[v] == unvisited:
+                return v
+            path = []
+            u = v
+            while ancestor[ancestor[u]] != unvisited:
+                path.append(u)
+                u = ancestor[u]
+            while path:
+                u = path.pop()
+                a = ancestor[u]
+                if semi[label[a]] < semi[label[u]]:
+                    label[u] = label[a]
+                ancestor[u] = ancestor[a]
+            return label[v]
+
+        for w in range(count - 1, 0, -1):
+            for pred in predecessors(vertex[w]):
+                v = number[pred]
+                if v < 0:
+                    continue
+                u = evaluate(v)
+                if semi[u] < semi[w]:
+                    semi[w] = semi[u]
+            bucket[semi[w]].append(w)
+            parent_w = parent[w]
+            ancestor[w] = parent_w
+            for v in bucket[parent_w]:
+                u = evaluate(v)
+                idom[v] = u if semi[u] < semi[v] else parent_w
+            bucket[parent_w].clear()
+
+        for w in range(1, count):
+            if idom[w] != semi[w]:
+                idom[w] = idom[idom[w]]
+
+        # Translate back to node IDs; unreachable nodes have no dominator
+        self.idom = node_idom = [unvisited] * (root + 1)
+        for w in range(1, count):
+            node_idom[vertex[w]] = vertex[idom[w]]
+        node_idom[root] = root
+
+        # Lay out the tree itself in preorder, so subtrees are contiguous ranges
+        children_of: "List[List[int]]" = [[] for _ in range(root + 1)]
+        for w in range(count - 1, 0, -1):
+            node = vertex[w]
+            children_of[node_idom[node]].append(node)
+        self.preorder = preorder = []
+        self._preorder_index = preorder_index = [unvisited] * (root + 1)
+        self._subtree_end = subtree_end = [0] * (root + 1)
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node < 0:
+                subtree_end[~node] = len(preorder)
+                continue
+            preorder_index[node] = len(preorder)
+            preorder.append(node)
+            stack.append(~node)
+            stack.extend(children_of[node])
+
+        sizes = graph.sizes
+        self.subtree_sizes = subtree_sizes = [0] * (root + 1)
+        for node in reversed(preorder):
+            if node != root:
+                subtree_sizes[node] += sizes[node]
+                subtree_sizes[node_idom[node]] += subtree_sizes[node]
+
+    def immediate_dominator(self, package: str) -> "Optional[str]":
+        """
+        Get the immediate dominator of a package, or None if it is only retained by
+        the root (e.g. because it is explicitly installed).
+        """
+        idom = self.idom[self.graph.ids[package]]
+        if idom == self.root:
+            return None
+        return self.graph.names[idom]
+
+    def dominates(self, dominator: str, package: str) -> bool:
+        """
+        Check whether every chain of dependencies leading to a package passes through
+        another package. Every package dominates itself.
+        """
+        ids = self.graph.ids
+        start = self._preorder_index[ids[dominator]]
+        return (
+            start
+            <= self._preorder_index[ids[package]]
+            < self._subtree_end[ids[dominator]]
+        )
+
+    def dominated_ids(self, package_id: int) -> "List[int]":
+        """
+        Get the IDs of all packages dominated by a package, including itself.
+        """
+        start = self._preorder_index[package_id]
+        return self.preorder[start : self._subtree_end[package_id]]
+
+    def uniquely_retained_ids(self, package_ids: "Iterable[int]") -> "List[int]":
+        """
+        Get the IDs of all packages which are only retained by a set of packages, i.e.
+        which could not be reached from the root if those packages were removed.
+        Unlike looking up a single package's subtree, this works for any set of packages,
+        in time linear in the size of the graph.
+        """
+        graph = self.graph
+        removed = set(package_ids)
+        kept = [False] * len(graph)
+        stack = [node for node in self.roots if node not in removed]
+        for node in stack:
+            kept[node] = True
+        while stack:
+            for dependency in graph.dependencies(stack.pop()):
+                if not kept[dependency] and dependency not in removed:
+                    kept[dependency] = True
+                    stack.append(dependency)
+
+        seen = set(removed)
+        stack = list(removed)
+        while stack:
+            for dependency in graph.dependencies(stack.pop()):
+                if not kept[dependency] and dependency not in seen:
+                    seen.add(dependency)
+                    stack.append(dependency)
+        return sorted(seen)
+
+
+class OkLabTransform:
+    @staticmethod
+    def rgb_linearise(value: float) -> float:
+        if value >= 0.0031308:
+            return (1.055) * value ** (1.0 / 2.4) - 0.055
+        else:
+            return 12.92 * value
+
+    @staticmethod
+    def rgb_delinearise(value: float) -> float:
+        if value >= 0.04045:
+            return ((value + 0.055) / (1 + 0.055)) ** 2.4
+        else:
+            return value / 12.92
+
+    @staticmethod
+    def from_rgb(r: float, g: float, b: float) -> "Tuple[float, float, float]":
+        r = OkLabTransform.rgb_delinearise(r)
+        g = OkLabTransform.rgb_delinearise(g)
+        b = OkLabTransform.rgb_delinearise(b)
+        l = 0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b
+        m = 0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b
+        s = 0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b
+
+        l_ = l ** (1 / 3)
+        m_ = m ** (1 / 3)
+        s_ = s ** (1 / 3)
+
+        return (
+            0.2104542553 * l_ + 0.7936177850 * m_ - 0.0040720468 * s_,
+            1.9779984951 * l_ - 2.4285922050 * m_ + 0.4505937099 * s_,
+            0.0259040371 * l_ + 0.7827717662 * m_ - 0.8086757660 * s_,
+        )
+
+    @staticmethod
+    def to_rgb(l: float, a: float, b: float) -> "Tuple[float, float, float]":
+        l_ = l + 0.3963377774 * a + 0.2158037573 * b
+        m_ = l - 0.1055613458 * a - 0.0638541728 * b
+        s_ = l - 0.0894841775 * a - 1.2914855480 * b
+
+        l = l_**3
+        m = m_**3
+        s = s_**3
+
+        r = 4.0767416621 * l - 3.3077115913 * m + 0.2309699292 * s
+        g = -1.2684380046 * l + 2.6097574011 * m - 0.3413193965 * s
+        b = -0.0041960863 * l - 0.7034186147 * m + 1.7076147010 * s
+
+        return (
+            OkLabTransform.rgb_linearise(r),
+            OkLabTransform.rgb_linearise(g),
+            OkLabTransform.rgb_linearise(b),
+        )
+
+
+def lerp_vec3(
+    a: "Tuple[float, float, float]", b: "Tuple[float, float, float]", t: float
+) -> "Tuple[float, float, float]":
+    return (
+        a[0] * (1 - t) + b[0] * t,
+        a[1] * (1 - t) + b[1] * t,
+        a[2] * (1 - t) + b[2] * t,
+    )
+
+
+def clamp_vec3(value: "Tuple[float, float, float]") -> "Tuple[float, float, float]":
+    return (
+        max(0, min(1, value[0])),
+        max(0, min(1, value[1])),
+        max(0, min(1, value[2])),
+    )
+
+
+def heatmap_colouring(
+    min_value: float, max_value: float, palette: "List[Tuple[float, float, float]]"
+):
+    if len(palette) < 2:
+        raise ValueError("Palette must have at least two colours")
+
+    palette = [OkLabTransform.from_rgb(*rgb) for rgb in palette]
+
+    transform = lambda v: v**0.1
+
+    min_value = transform(min_value)
+    value_range = transform(max_value - min_value)
+
+    def colour(value: float) -> "Tuple[float, float, float]":
+        if value <= min_value:
+            return palette[0]
+        if value >= max_value:
+            return palette[-1]
+
+        value = transform(value - min_value)
+        t = value / value_range
+        if t <= 0:
+            return palette[0]
+        if t >= 1:
+            return palette[-1]
+
+        return heatmap_gradient(palette, t)
+
+    return colour
+
+
+def heatmap_gradient(
+    palette: "List[Tuple[float, float, float]]", t: float
+) -> "Tuple[float, float, float]":
+    """
+    Interpolate between the colours of an OkLab palette, for 0 <= t <= 1.
+    """
+    t *= len(palette) - 1
+    i = min(int(t), len(palette) - 2)
+    t -= i
+    return clamp_vec3(OkLabTransform.to_rgb(*lerp_vec3(palette[i], palette[i + 1], t)))
+
+
+def hex_colour(rgb: "Tuple[float, float, float]") -> str:
+    return f"#{int(rgb[0] * 255):02x}{int(rgb[1] * 255):02x}{int(rgb[2] * 255):02x}"
+
+
+class HeatmapColourTable:
+    """
+    Precomputed version of `heatmap_colouring`, for colouring many values at once.
+    The transformed value range is quantised into a fixed number of steps, each with its
+    colour computed ahead of time. With 256 steps or more, this keeps every channel
+    within 1/255 of the exact colour. With numpy available, whole arrays of values are
+    coloured in one go.
+    """
+
+    __slots__ = (
+        "min_value",
+        "max_value",
+        "value_range",
+        "size",
+        "rgb_table",
+        "hex_table",
+        "rgb_array",
+        "hex_array",
+    )
+
+    min_value: float
+    max_value: float
+    value_range: float
+    size: int
+    rgb_table: "List[Tuple[float, float, float]]"
+    hex_table: "List[str]"
+    rgb_array: "Optional[numpy.ndarray]"
+    hex_array: "Optional[numpy.ndarray]"
+
+    def __init__(
+        self,
+        min_value: float,
+        max_value: float,
+        palette: "List[Tuple[float, float, float]]",
+        size: int = 4096,
+    ):
+        if size < 2:
+            raise ValueError("Colour table must have at least two entries")
+        colour = heatmap_colouring(min_value, max_value, palette)
+        palette = [OkLabTransform.from_rgb(*rgb) for rgb in palette]
+
+        # Mirror the transform in heatmap_colouring exactly, including its edge cases
+        self.min_value = min_value = min_value**0.1
+        self.max_value = max_value
+        self.value_range = (max_value - min_value) ** 0.1
+        self.size = size
+
+        steps = size - 1
+        self.rgb_table = [heatmap_gradient(palette, i / steps) for i in range(size)]
+        self.rgb_table += [colour(min_value), colour(max_value)]
+        self.hex_table = list(map(hex_colour, self.rgb_table))
+
+        if numpy is not None:
+            self.rgb_array = numpy.array(self.rgb_table)
+            self.hex_array = numpy.array(self.hex_table, dtype=object)
+        else:
+            self.rgb_array = None
+            self.hex_array = None
+
+    def index(self, value: float) -> int:
+        """
+        Get the index of the colour for a value in the colour tables, where `size` and
+        `size + 1` stand for values below and above the range.
+        """
+        if value <= self.min_value:
+            return self.size
+        if value >= self.max_value:
+            return self.size + 1
+        t = (value - self.min_value) ** 0.1 / self.value_range
+        if t <= 0:
+            return self.size
+        if t >= 1:
+            return self.size + 1
+        return int(t * (self.size - 1) + 0.5)
+
+    def indices(self, values: "Sequence[float]") -> "numpy.ndarray":
+        """
+        Get the index of the colour for every value in an array, as with `index`.
+        Requires numpy.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        below = values <= self.min_value
+        above = values >= self.max_value
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            t = numpy.maximum(values - self.min_value, 0) ** 0.1 / self.value_range
+        below |= t <= 0
+        above |= t >= 1
+        indices = numpy.rint(t * (self.size - 1)).astype(numpy.intp)
+        indices[below] = self.size
+        indices[above] = self.size + 1
+        return indices
+
+    def rgb(self, value: float) -> "Tuple[float, float, float]":
+        """
+        Get the colour for a value.
+        """
+        return self.rgb_table[self.index(value)]
+
+    def hex_colours(self, values: "Sequence[float]") -> "List[str]":
+        """
+        Get the colours for many values, as `#rrggbb` strings.
+        """
+        if self.hex_array is not None:
+            return self.hex_array[self.indices(values)].tolist()
+        hex_table = self.hex_table
+        return [hex_table[self.index(value)] for value in values]
+
+    def rgb_colours(self, values: "Sequence[float]") -> "numpy.ndarray":
+        """
+        Get the colours for many values, as an array with one row per value.
+        Requires numpy.
+        """
+        return self.rgb_array[self.indices(values)]
+
+
+class SizeFormatter:
+    name: str
+
+    def get_size(
+        self, installed_set: PacmanInstalledSet, package: PacmanPackage
+    ) -> int:
+        raise NotImplementedError()
+
+    def format_size(self, size: int) -> str:
+        return format_size(size)
+
+
+class OwnSizeFormatter(SizeFormatter):
+    name = "own"
+
+    def get_size(
+        self, installed_set: PacmanInstalledSet, package: PacmanPackage
+    ) -> int:
+        return package.size or 0
+
+
+class RetainedSizeFormatter(SizeFormatter):
+    name = "retained"
+
+    def get_size(
+        self, installed_set: PacmanInstalledSet, package: PacmanPackage
+    ) -> int:
+        return installed_set.compute_retained_size(package.name)
+
+
+class AdjustedSizeFormatter(SizeFormatter):
+    name = "adjusted"
+
+    def get_size(
+        self, installed_set: PacmanInstalledSet, package: PacmanPackage
+    ) -> int:
+        return installed_set.compute_adjusted_size(package.name)
+
+
+class UniquelyRetainedSizeFormatter(SizeFormatter):
+    name = "uniquely retained"
+
+    def get_size(
+        self, installed_set: PacmanInstalledSet, package: PacmanPackage
+    ) -> int:
+        return installed_set.compute_uniquely_retained_size(package.name)
+
+
+class RetainedPackagesFormatter(SizeFormatter):
+    name = "retained packages"
+
+    def get_size(
+        self, installed_set: PacmanInstalledSet, package: PacmanPackage
+    ) -> int:
+        return len(installed_set.compute_retained_set(package.name))
+
+    def format_size(self, size: int) -> str:
+        return str(size)
+
+
+_DOT_CHUNK_LINES = 4096
+
+
+def write_lines(output_file: "IO[bytes]", lines: "Iterable[str]"):
+    """
+    Write lines of text to a binary file as UTF-8, joining them into large chunks
+    rather than writing each line separately.
+    """
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, _DOT_CHUNK_LINES))
+        if not chunk:
+            break
+        chunk.append("")
+        output_file.write("\n".join(chunk).encode("utf-8"))
+
+
+class _ClosingGzipFile(gzip.GzipFile):
+    """
+    GzipFile which closes the file it was given to write to when it is closed, as
+    GzipFile only does for files it opened itself.
+    """
+
+    def close(self):
+        output_file = self.fileobj
+        try:
+            super().close()
+        finally:
+            if output_file is not None:
+                output_file.close()
+
+
+def open_graph_output(path: "Optional[str]", compress: bool = False) -> "IO[bytes]":
+    """
+    Open a buffered binary file to write a graph to, or standard output if no path is
+    given. If `compress` is set, or the path ends with `.gz`, the output is gzipped as
+    it is written. Closing the returned file closes the output, whether gzipped or not.
+    """
+    to_stdout = path is None or path == "-"
+    if compress or (not to_stdout and path.endswith(".gz")):
+        if to_stdout:
+            return _ClosingGzipFile(
+                fileobj=os.fdopen(os.dup(sys.stdout.fileno()), "wb"),
+                mode="wb",
+                compresslevel=6,
+            )
+        return gzip.GzipFile(path, mode="wb", compresslevel=6)
+    if to_stdout:
+        return os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    return open(path, "wb")
+
+
+GRAPH_PALETTE = ((0.5, 0.5, 1.0), (1.0, 1.0, 1.0), (0.9, 0.9, 0.5), (1.0, 0.5, 0.5))
+
+
+@lru_cache(maxsize=8)
+def graph_colour_table(max_size: int, size: int) -> HeatmapColourTable:
+    """
+    Get the colour table for graphs with the given maximum size. Tables are kept for
+    reuse, since building one takes longer than colouring a small graph with it.
+    """
+    return HeatmapColourTable(0, max_size, list(GRAPH_PALETTE), size)
+
+
+class FilterContext:
+    """
+    What package filters are evaluated against: an installed set, its package graph and
+    the sizes being graphed. Filters select installed packages only, which are the first
+    `graph.num_packages` IDs of the graph.
+    """
+
+    __slots__ = (
+        "installed_set",
+        "graph",
+        "packages",
+        "package_sizes",
+        "all_packages",
+        "size_values",
+        "index",
+    )
+
+    installed_set: PacmanInstalledSet
+    graph: PackageGraph
+    packages: "List[PacmanPackage]"
+    package_sizes: "Dict[str, int]"
+    all_packages: int
+    size_values: "Optional[Sequence[int]]"
+    index: "Optional[SizeIndex]"
+
+    def __init__(
+        self, installed_set: PacmanInstalledSet, package_sizes: "Dict[str, int]"
+    ):
+        self.installed_set = installed_set
+        self.graph = graph = installed_set.get_graph()
+        packages = installed_set.packages
+        names = graph.names[: graph.num_packages]
+        if list(packages) == names:
+            # Installed packages are usually numbered in insertion order
+            self.packages = list(packages.values())
+        else:
+            self.packages = [packages[name] for name in names]
+        self.package_sizes = package_sizes
+        self.all_packages = (1 << graph.num_packages) - 1
+        self.size_values = None
+        self.index = None
+
+    def package_id(self, name: str) -> int:
+        """
+        Look up the graph ID of an installed package, by name or alias.
+        """
+        package_id = self.graph.ids.get(self.installed_set.resolve_alias(name))
+        if package_id is None or package_id >= self.graph.num_packages:
+            raise ValueError(f"Package {name} not installed")
+        return package_id
+
+    def sizes(self) -> "Sequence[int]":
+        """
+        Get the sizes of the installed packages in ID order, as a NumPy array if NumPy
+        is available, or a list otherwise.
+        """
+        if self.size_values is None:
+            package_sizes = self.package_sizes
+            sizes = [package_sizes[package.name] for package in self.packages]
+            if numpy is not None:
+                self.size_values = numpy.array(sizes, dtype=numpy.int64)
+            else:
+                self.size_values = sizes
+        return self.size_values
+
+    def size_index(self) -> SizeIndex:
+        """
+        Get the sizes of the installed packages indexed for top-K and percentile
+        queries, with indices being package IDs.
+        """
+        if self.index is None:
+            names = [package.name for package in self.packages]
+            self.index = SizeIndex(names, self.sizes())
+        return self.index
+
+
+class PackageFilter:
+    """
+    A condition on installed packages, evaluated for every package at once into a
+    bitset over package IDs. Filters can be combined with `&`, `|` and `~`.
+    """
+
+    __slots__ = ()
+
+    def evaluate(self, context: FilterContext) -> int:
+        raise NotImplementedError()
+
+    def __and__(self, other: "PackageFilter") -> "PackageFilter":
+        return AllOf([self, other])
+
+    def __or__(self, other: "PackageFilter") -> "PackageFilter":
+        return AnyOf([self, other])
+
+    def __invert__(self) -> "PackageFilter":
+        return Not(self)
+
+
+class AllOf(PackageFilter):
+    __slots__ = ("filters",)
+
+    filters: "List[PackageFilter]"
+
+    def __init__(self, filters: "Iterable[PackageFilter]"):
+        self.filters = list(filters)
+
+    def evaluate(self, context: FilterContext) -> int:
+        bits = context.all_packages
+        for package_filter in self.filters:
+            if not bits:
+                break
+            bits &= package_filter.evaluate(context)
+        return bits
+
+
+class AnyOf(PackageFilter):
+    __slots__ = ("filters",)
+
+    filters: "List[PackageFilter]"
+
+    def __init__(self, filters: "Iterable[PackageFilter]"):
+        self.filters = list(filters)
+
+    def evaluate(self, context: FilterContext) -> int:
+        bits = 0
+        for package_filter in self.filters:
+            if bits == context.all_packages:
+                break
+            bits |= package_filter.evaluate(context)
+        return bits
+
+
+class Not(PackageFilter):
+    __slots__ = ("filter",)
+
+    filter: PackageFilter
+
+    def __init__(self, package_filter: PackageFilter):
+        self.filter = package_filter
+
+    def evaluate(self, context: FilterContext) -> int:
+        return context.all_packages & ~self.filter.evaluate(context)
+
+
+class PackageFlags(PackageFilter):
+    """
+    Selects packages by a flag computed for every installed package, in ID order.
+    """
+
+    __slots__ = ("flags",)
+
+    flags: "Callable[[FilterContext], Iterable[bool]]"
+
+    def __init__(self, flags: "Callable[[FilterContext], Iterable[bool]]"):
+        self.flags = flags
+
+    def evaluate(self, context: FilterContext) -> int:
+        return context.all_packages & bitset_from_flags(self.flags(context))
+
+
+class NoReverseDependencies(PackageFilter):
+    """
+    Selects packages which no installed package (optionally) depends on.
+    """
+
+    __slots__ = ("optional",)
+
+    optional: bool
+
+    def __init__(self, optional: bool):
+        self.optional = optional
+
+    def evaluate(self, context: FilterContext) -> int:
+        if self.optional:
+            get_revdeps = context.installed_set.optional_revdep_cache.get
+            return bitset_from_flags(
+                [not get_revdeps(package.name) for package in context.packages]
+            )
+
+        # Required dependencies are in the package graph, which has a count of each
+        # package's reverse dependencies in its offsets
+        offsets = context.graph.revdep_offsets[: context.graph.num_packages + 1]
+        if numpy is not None:
+            offsets = numpy.frombuffer(offsets, dtype=numpy.uint32)
+            return bitset_from_mask(numpy.diff(offsets) == 0)
+        return bitset_from_flags(
+            [start == end for start, end in zip(offsets, islice(offsets, 1, None))]
+        )
+
+
+class NamePattern(PackageFilter):
+    __slots__ = ("pattern",)
+
+    pattern: "re.Pattern[str]"
+
+    def __init__(self, pattern: str):
+        try:
+            self.pattern = re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"Invalid name pattern {pattern!r}: {e}") from e
+
+    def evaluate(self, context: FilterContext) -> int:
+        search = self.pattern.search
+        return bitset_from_flags(
+            search(package.name) is not None for package in context.packages
+        )
+
+
+class SizeRange(PackageFilter):
+    """
+    Selects packages whose size (of the type being graphed) is within a range.
+    """
+
+    __slots__ = ("min_size", "max_size")
+
+    min_size: "Optional[int]"
+    max_size: "Optional[int]"
+
+    def __init__(self, min_size: "Optional[int]", max_size: "Optional[int]" = None):
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def evaluate(self, context: FilterContext) -> int:
+        sizes = context.sizes()
+        if isinstance(sizes, list):
+            min_size = self.min_size if self.min_size is not None else -1
+            max_size = self.max_size if self.max_size is not None else float("inf")
+            return bitset_from_flags(min_size <= size <= max_size for size in sizes)
+        mask = numpy.ones(len(sizes), dtype=bool)
+        if self.min_size is not None:
+            mask &= sizes >= self.min_size
+        if self.max_size is not None:
+            mask &= sizes <= self.max_size
+        return bitset_from_mask(mask)
+
+
+class TopSize(PackageFilter):
+    """
+    Selects packages at least a fraction of the size of the largest package.
+    """
+
+    __slots__ = ("fraction",)
+
+    fraction: float
+
+    def __init__(self, fraction: float):
+        self.fraction = fraction
+
+    def evaluate(self, context: FilterContext) -> int:
+        sizes = context.sizes()
+        if not len(sizes):
+            return 0
+        threshold = context.size_index().max_size() * self.fraction
+        if isinstance(sizes, list):
+            return bitset_from_flags(size >= threshold for size in sizes)
+        return bitset_from_mask(sizes >= threshold)
+
+
+class TopPercentile(PackageFilter):
+    """
+    Selects packages at or above a percentile of package sizes.
+    """
+
+    __slots__ = ("percentile",)
+
+    percentile: float
+
+    def __init__(self, percentile: float):
+        self.percentile = percentile
+
+    def evaluate(self, context: FilterContext) -> int:
+        sizes = context.sizes()
+        if not len(sizes):
+            return 0
+        threshold = context.size_index().percentile(self.percentile)
+        if isinstance(sizes, list):
+            return bitset_from_flags(size >= threshold for size in sizes)
+        return bitset_from_mask(sizes >= threshold)
+
+
+class TopCount(PackageFilter):
+    """
+    Selects the given number of largest packages.
+    """
+
+    __slots__ = ("count",)
+
+    count: int
+
+    def __init__(self, count: int):
+        self.count = count
+
+    def evaluate(self, context: FilterContext) -> int:
+        flags = bytearray(len(context.packages))
+        for package_id in context.size_index().top_ids(self.count):
+            flags[package_id] = 1
+        return bitset_from_flags(flags)
+
+
+class Packages(PackageFilter):
+    """
+    Selects the given packages.
+    """
+
+    __slots__ = ("packages",)
+
+    packages: "List[str]"
+
+    def __init__(self, packages: "Iterable[str]"):
+        self.packages = list(packages)
+
+    def evaluate(self, context: FilterContext) -> int:
+        bits = 0
+        for package in self.packages:
+            bits |= 1 << context.package_id(package)
+        return bits
+
+
+class ReachableFrom(PackageFilter):
+    """
+    Selects the given packages and everything they (transitively) depend on.
+    """
+
+    __slots__ = ("packages",)
 
-def clamp_vec3(value: "Tuple[float, float, float]") -> "Tuple[float, float, float]":
-    return (
-        max(0, min(1, value[0])),
-        max(0, min(1, value[1])),
-        max(0, min(1, value[2])),
-    )
+    packages: "List[str]"
 
+    def __init__(self, packages: "Iterable[str]"):
+        self.packages = list(packages)
 
-def heatmap_colouring(
-    min_value: float, max_value: float, palette: "List[Tuple[float, float, float]]"
-):
-    if len(palette) < 2:
-        raise ValueError("Palette must have at least two colours")
+    def evaluate(self, context: FilterContext) -> int:
+        graph = context.graph
+        engine = context.installed_set.retained_set_engine
+        if engine is not None and engine.graph is graph:
+            return context.all_packages & engine.retained_bitset(self.packages)
 
-    colourspace = OkLabTransform
-    palette = [colourspace.from_rgb(*rgb) for rgb in palette]
+        bits = 0
+        queue = deque()
+        for package in self.packages:
+            package_id = context.package_id(package)
+            if not bits >> package_id & 1:
+                bits |= 1 << package_id
+                queue.append(package_id)
+        while queue:
+            for dependency in graph.dependencies(queue.popleft()):
+                if not bits >> dependency & 1:
+                    bits |= 1 << dependency
+                    queue.append(dependency)
+        return context.all_packages & bits
 
-    transform = lambda v: v**0.1
 
-    min_value = transform(min_value)
-    value_range = transform(max_value - min_value)
+class Neighbourhood(PackageFilter):
+    """
+    Selects the packages within a number of dependency or reverse dependency edges of a
+    package.
+    """
 
-    def colour(value: float) -> "Tuple[float, float, float]":
-        if value <= min_value:
-            return palette[0]
-        if value >= max_value:
-            return palette[-1]
+    __slots__ = ("package", "depth")
+
+    package: str
+    depth: int
+
+    def __init__(self, package: str, depth: int = 1):
+        if depth < 0:
+            raise ValueError("Neighbourhood depth must not be negative")
+        self.package = package
+        self.depth = depth
+
+    def evaluate(self, context: FilterContext) -> int:
+        graph = context.graph
+        package_id = context.package_id(self.package)
+        bits = 1 << package_id
+        frontier = [package_id]
+        for _ in range(self.depth):
+            next_frontier = []
+            for node in frontier:
+                for neighbour in chain(
+                    graph.dependencies(node), graph.reverse_dependencies(node)
+                ):
+                    if not bits >> neighbour & 1:
+                        bits |= 1 << neighbour
+                        next_frontier.append(neighbour)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return context.all_packages & bits
 
-        value = transform(value - min_value)
-        t = value / value_range
-        if t <= 0:
-            return palette[0]
-        if t >= 1:
-            return palette[-1]
 
-        t *= len(palette) - 1
-        i = int(t)
-        t -= i
-        return clamp_vec3(colourspace.to_rgb(*lerp_vec3(palette[i], palette[i + 1], t)))
+def parse_size_threshold(size: str) -> int:
+    """
+    Parse a size given on the command line, e.g. `1.5MiB` or `1024`, in bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([KMGT]iB|B)?\s*", size)
+    if match is None:
+        raise ValueError(f"Invalid size {size}")
+    return int(float(match[1]) * _units[match[2] or "B"])
+
+
+def parse_top_count(count: str) -> TopCount:
+    try:
+        return TopCount(int(count))
+    except ValueError:
+        raise ValueError(f"Invalid package count {count}") from None
+
+
+def parse_neighbourhood(argument: str) -> Neighbourhood:
+    package, _, depth = argument.partition(":")
+    try:
+        return Neighbourhood(package, int(depth) if depth else 1)
+    except ValueError:
+        raise ValueError(f"Invalid neighbourhood {argument}") from None
+
+
+PACKAGE_FILTERS: "Dict[str, PackageFilter]" = {
+    "no-deps": PackageFlags(
+        lambda context: (not package.dependencies for package in context.packages)
+    ),
+    "no-revdeps": NoReverseDependencies(optional=False),
+    "no-optional-deps": PackageFlags(
+        lambda context: (
+            not package.optional_dependencies for package in context.packages
+        )
+    ),
+    "no-optional-revdeps": NoReverseDependencies(optional=True),
+    "installed-explicitly": PackageFlags(
+        lambda context: (package.explicit_install for package in context.packages)
+    ),
+    "installed-as-dep": PackageFlags(
+        lambda context: (not package.explicit_install for package in context.packages)
+    ),
+    "top-size": TopSize(0.5),
+    "top-size-percentile": TopPercentile(90),
+}
 
-    return colour
+PARAMETERISED_PACKAGE_FILTERS: "Dict[str, Callable[[str], PackageFilter]]" = {
+    "name": NamePattern,
+    "package": lambda packages: Packages(packages.split(",")),
+    "min-size": lambda size: SizeRange(parse_size_threshold(size)),
+    "max-size": lambda size: SizeRange(None, parse_size_threshold(size)),
+    "reachable-from": lambda packages: ReachableFrom(packages.split(",")),
+    "neighbourhood": parse_neighbourhood,
+    "top": parse_top_count,
+}
 
 
-class SizeFormatter:
-    name: str
+def parse_package_filter(expression: str) -> PackageFilter:
+    """
+    Parse a filter expression, made of the filters in `PACKAGE_FILTERS` and
+    `PARAMETERISED_PACKAGE_FILTERS` (written as `name:argument`) combined with `and`,
+    `or`, `not` and parentheses. Arguments containing spaces or parentheses can be
+    quoted as in a shell.
+    """
+    lexer = shlex.shlex(expression, posix=True, punctuation_chars="()")
+    lexer.whitespace_split = True
+    tokens = list(lexer)
+    position = 0
+
+    def peek() -> "Optional[str]":
+        return tokens[position] if position < len(tokens) else None
+
+    def take() -> str:
+        nonlocal position
+        token = peek()
+        if token is None:
+            raise ValueError(f"Unexpected end of filter expression {expression!r}")
+        position += 1
+        return token
+
+    def parse_any() -> PackageFilter:
+        filters = [parse_all()]
+        while peek() == "or":
+            take()
+            filters.append(parse_all())
+        return filters[0] if len(filters) == 1 else AnyOf(filters)
+
+    def parse_all() -> PackageFilter:
+        filters = [parse_not()]
+        while peek() == "and":
+            take()
+            filters.append(parse_not())
+        return filters[0] if len(filters) == 1 else AllOf(filters)
+
+    def parse_not() -> PackageFilter:
+        token = take()
+        if token == "not":
+            return Not(parse_not())
+        if token == "(":
+            package_filter = parse_any()
+            if take() != ")":
+                raise ValueError(f"Expected ) in filter expression {expression!r}")
+            return package_filter
+        if token in PACKAGE_FILTERS:
+            return PACKAGE_FILTERS[token]
+        name, colon, argument = token.partition(":")
+        if colon and name in PARAMETERISED_PACKAGE_FILTERS:
+            return PARAMETERISED_PACKAGE_FILTERS[name](argument)
+        raise ValueError(f"Unknown filter {token}")
+
+    package_filter = parse_any()
+    if peek() is not None:
+        raise ValueError(f"Unexpected {peek()} in filter expression {expression!r}")
+    return package_filter
+
+
+class GraphContents:
+    """
+    The nodes and edges of a package graph, after filtering and colouring, ready to be
+    written out in any of the `GRAPH_FORMATS`.
+    """
 
-    def get_size(
-        self, installed_set: PacmanInstalledSet, package: PacmanPackage
-    ) -> int:
-        raise NotImplementedError()
+    __slots__ = (
+        "graph",
+        "shown",
+        "hidden",
+        "unknowns",
+        "colours",
+        "size_formatter",
+        "display_package_sizes",
+        "include_optional",
+    )
 
-    def format_size(self, size: int) -> str:
-        return format_size(size)
+    graph: "PackageGraph"
+    shown: "List[PacmanPackage]"
+    hidden: "Set[str]"
+    unknowns: "List[str]"
+    colours: "List[str]"
+    size_formatter: SizeFormatter
+    display_package_sizes: "Dict[str, int]"
+    include_optional: bool
+
+    def __init__(
+        self,
+        installed_set: PacmanInstalledSet,
+        package_sizes: "Dict[str, int]",
+        max_size: int,
+        size_formatter: SizeFormatter,
+        package_filter: "Optional[PackageFilter]" = None,
+        include_optional: bool = False,
+        colour_table_size: int = 0,
+    ):
+        packages = installed_set.packages
+
+        if size_formatter.name == "own":
+            # Switch to retained size for display
+            self.size_formatter = RetainedSizeFormatter()
+            self.display_package_sizes = installed_set.compute_all_sizes("retained")
+        else:
+            self.size_formatter = size_formatter
+            self.display_package_sizes = package_sizes
 
+        # Decide which packages are shown once, rather than for every edge endpoint
+        if package_filter is None:
+            self.shown = list(packages.values())
+        else:
+            context = FilterContext(installed_set, package_sizes)
+            self.shown = list(
+                map(
+                    context.packages.__getitem__,
+                    bitset_ids(package_filter.evaluate(context)),
+                )
+            )
+        self.hidden = packages.keys() - {package.name for package in self.shown}
+
+        # Edges and unknown packages are listed in the graph's order rather than by
+        # walking the sets, which may iterate differently once loaded from the cache
+        self.graph = graph = installed_set.get_graph()
+        unknowns = installed_set.unknowns
+        self.unknowns = [
+            name for name in graph.names[graph.num_packages :] if name in unknowns
+        ]
+        self.include_optional = include_optional
+
+        shown_sizes = [package_sizes[package.name] for package in self.shown]
+        if colour_table_size:
+            self.colours = graph_colour_table(max_size, colour_table_size).hex_colours(
+                shown_sizes
+            )
+        else:
+            colouring = heatmap_colouring(0, max_size, list(GRAPH_PALETTE))
+            self.colours = [hex_colour(colouring(size)) for size in shown_sizes]
 
-class OwnSizeFormatter(SizeFormatter):
-    name = "own"
+    def edges(self, optional: bool) -> "Iterator[Tuple[str, str]]":
+        """
+        Iterate over the (optional) dependency edges between shown packages and
+        unknown packages, as pairs of names.
+        """
+        hidden = self.hidden
+        names = self.graph.names
+        ids = self.graph.ids
+        dependencies = (
+            self.graph.optional_dependencies if optional else self.graph.dependencies
+        )
+        for package in self.shown:
+            name = package.name
+            for dependency_id in dependencies(ids[name]):
+                dependency = names[dependency_id]
+                if dependency not in hidden:
+                    yield name, dependency
+
+    def quoted_names(self, quote: "Callable[[str], str]") -> "Dict[str, str]":
+        """
+        Quote the name of every node in the graph, for formats which repeat the names
+        of both ends of each edge.
+        """
+        return {
+            name: quote(name)
+            for name in chain((package.name for package in self.shown), self.unknowns)
+        }
 
-    def get_size(
-        self, installed_set: PacmanInstalledSet, package: PacmanPackage
-    ) -> int:
-        return package.size or 0
 
+def write_dot_graph(graph: GraphContents, output_file: "IO[bytes]"):
+    """
+    Write a package graph in Graphviz DOT format.
+    """
+    format_size = graph.size_formatter.format_size
+    size_name = graph.size_formatter.name
+    display_package_sizes = graph.display_package_sizes
 
-class RetainedSizeFormatter(SizeFormatter):
-    name = "retained"
+    def node_line(package: PacmanPackage, colour: str) -> str:
+        name = package.name
+        details = (
+            f"{name}\\n{format_size(package.size or 0)}; "
+            f"{size_name} {format_size(display_package_sizes[name])}"
+        )
+        return f'"{name}" [label="{details}" style=filled fillcolor="{colour}"]'
+
+    def graph_lines() -> "Iterator[str]":
+        yield from (
+            "digraph {",
+            "node [shape=box];",
+            "layout=neato",
+            "overlap=false",
+            "model=subset",
+            "",
+            "// Package node definitions",
+            "{",
+        )
+        yield from map(node_line, graph.shown, graph.colours)
+        yield from (
+            "}",
+            "",
+            "// Unknown package nodes",
+            "{",
+            'node [style=filled fillcolor="#000000" fontcolor="#ffffff"]',
+        )
+        yield from (f'"{name}"' for name in graph.unknowns)
+        yield from ("}", "", "// Dependency edges", "{")
+        yield from (f'"{name}" -> "{target}"' for name, target in graph.edges(False))
+        yield "}"
+
+        if graph.include_optional:
+            yield from (
+                "",
+                "// Optional dependency edges",
+                "{",
+                "edge [style=dashed]",
+            )
+            yield from (f'"{name}" -> "{target}"' for name, target in graph.edges(True))
+            yield "}"
 
-    def get_size(
-        self, installed_set: PacmanInstalledSet, package: PacmanPackage
-    ) -> int:
-        return installed_set.compute_retained_size(package.name)
+        yield "}"
 
+    write_lines(output_file, graph_lines())
 
-class AdjustedSizeFormatter(SizeFormatter):
-    name = "adjusted"
 
-    def get_size(
-        self, installed_set: PacmanInstalledSet, package: PacmanPackage
-    ) -> int:
-        return installed_set.compute_adjusted_size(package.name)
+def write_json_lines_graph(graph: GraphContents, output_file: "IO[bytes]"):
+    """
+    Write a package graph as newline-delimited JSON: a "graph" record naming the size
+    type, then one record per node and per edge. Unknown packages are nodes with
+    `"unknown": true` and no sizes.
+    """
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    display_package_sizes = graph.display_package_sizes
+
+    def graph_lines() -> "Iterator[str]":
+        yield dumps(
+            {
+                "type": "graph",
+                "size_type": graph.size_formatter.name,
+                "optional": graph.include_optional,
+            }
+        )
+        for package, colour in zip(graph.shown, graph.colours):
+            yield dumps(
+                {
+                    "type": "node",
+                    "name": package.name,
+                    "own_size": package.size or 0,
+                    "size": display_package_sizes[package.name],
+                    "colour": colour,
+                    "explicit": package.explicit_install,
+                }
+            )
+        for name in graph.unknowns:
+            yield dumps({"type": "node", "name": name, "unknown": True})
+
+        # Edges far outnumber nodes, so encode each name once and format edges directly
+        quoted = graph.quoted_names(dumps)
+        for optional in (False, True) if graph.include_optional else (False,):
+            suffix = f',"optional":{dumps(optional)}}}'
+            for name, target in graph.edges(optional):
+                yield (
+                    f'{{"type":"edge","source":{quoted[name]},'
+                    f'"target":{quoted[target]}{suffix}'
+                )
 
+    write_lines(output_file, graph_lines())
 
-class UniquelyRetainedSizeFormatter(SizeFormatter):
-    name = "uniquely retained"
 
-    def get_size(
-        self, installed_set: PacmanInstalledSet, package: PacmanPackage
-    ) -> int:
-        return installed_set.compute_uniquely_retained_size(package.name)
+def write_graphml_graph(graph: GraphContents, output_file: "IO[bytes]"):
+    """
+    Write a package graph in GraphML format, with the same node and edge attributes as
+    the JSON lines format.
+    """
+    display_package_sizes = graph.display_package_sizes
+
+    def graph_lines() -> "Iterator[str]":
+        yield from (
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">',
+            '<key id="own_size" for="node" attr.name="own_size" attr.type="long"/>',
+            '<key id="size" for="node" attr.name="size" attr.type="long"/>',
+            '<key id="colour" for="node" attr.name="colour" attr.type="string"/>',
+            '<key id="explicit" for="node" attr.name="explicit" attr.type="boolean"/>',
+            '<key id="unknown" for="node" attr.name="unknown" attr.type="boolean">'
+            "<default>false</default></key>",
+            '<key id="optional" for="edge" attr.name="optional" attr.type="boolean">'
+            "<default>false</default></key>",
+            f'<graph edgedefault="directed" id={quoteattr(graph.size_formatter.name)}>',
+        )
+        for package, colour in zip(graph.shown, graph.colours):
+            yield (
+                f"<node id={quoteattr(package.name)}>"
+                f'<data key="own_size">{package.size or 0}</data>'
+                f'<data key="size">{display_package_sizes[package.name]}</data>'
+                f'<data key="colour">{colour}</data>'
+                f'<data key="explicit">{str(package.explicit_install).lower()}</data>'
+                "</node>"
+            )
+        for name in graph.unknowns:
+            yield f'<node id={quoteattr(name)}><data key="unknown">true</data></node>'
+
+        quoted = graph.quoted_names(quoteattr)
+        for name, target in graph.edges(False):
+            yield f"<edge source={quoted[name]} target={quoted[target]}/>"
+        if graph.include_optional:
+            for name, target in graph.edges(True):
+                yield (
+                    f"<edge source={quoted[name]} target={quoted[target]}>"
+                    '<data key="optional">true</data></edge>'
+                )
+        yield from ("</graph>", "</graphml>")
 
+    write_lines(output_file, graph_lines())
 
-class RetainedPackagesFormatter(SizeFormatter):
-    name = "retained packages"
 
-    def get_size(
-        self, installed_set: PacmanInstalledSet, package: PacmanPackage
-    ) -> int:
-        return len(installed_set.compute_retained_set(package.name))
+def write_npz_graph(graph: GraphContents, output_file: "IO[bytes]"):
+    """
+    Write a package graph as a NumPy `.npz` archive of arrays. Nodes are numbered by
+    their position in `names`, shown packages first and then unknown packages, and
+    edges are `(source, target)` rows of node numbers in `edges` (and `optional_edges`
+    if optional dependencies are included). Requires numpy.
+    """
+    if numpy is None:
+        raise ValueError("The npz graph format requires numpy")
+
+    names = [package.name for package in graph.shown]
+    names.extend(graph.unknowns)
+    node_ids = {name: node_id for node_id, name in enumerate(names)}
+    num_shown = len(graph.shown)
+    display_package_sizes = graph.display_package_sizes
+
+    def edge_array(optional: bool) -> "numpy.ndarray":
+        edges = array("I")
+        for name, target in graph.edges(optional):
+            edges.append(node_ids[name])
+            edges.append(node_ids[target])
+        return numpy.frombuffer(edges, dtype=numpy.uint32).reshape(-1, 2)
+
+    arrays = {
+        "size_type": numpy.array(graph.size_formatter.name),
+        "names": numpy.array(names, dtype=str),
+        "own_sizes": numpy.fromiter(
+            (package.size or 0 for package in graph.shown), numpy.int64, num_shown
+        ),
+        "sizes": numpy.fromiter(
+            (display_package_sizes[package.name] for package in graph.shown),
+            numpy.int64,
+            num_shown,
+        ),
+        "colours": numpy.fromiter(
+            (int(colour[1:], 16) for colour in graph.colours), numpy.uint32, num_shown
+        ),
+        "explicit": numpy.fromiter(
+            (package.explicit_install for package in graph.shown), bool, num_shown
+        ),
+        "edges": edge_array(False),
+    }
+    if graph.include_optional:
+        arrays["optional_edges"] = edge_array(True)
+    numpy.savez(output_file, **arrays)
 
-    def format_size(self, size: int) -> str:
-        return str(size)
+
+GRAPH_FORMATS: "Dict[str, Callable[[GraphContents, IO[bytes]], None]]" = {
+    "dot": write_dot_graph,
+    "jsonl": write_json_lines_graph,
+    "graphml": write_graphml_graph,
+    "npz": write_npz_graph,
+}
 
 
+@profiled("write graph")
 def make_graph(
     installed_set: PacmanInstalledSet,
     package_sizes: "Dict[str, int]",
     max_size: int,
     size_formatter: SizeFormatter,
-    output_file: "IO[str]",
-    filter_func: "Optional[Callable[[PacmanPackage], bool]]" = None,
+    output_file: "IO[bytes]",
+    package_filter: "Optional[PackageFilter]" = None,
     include_optional: bool = False,
+    colour_table_size: int = 0,
+    output_format: str = "dot",
 ):
-    format_size = size_formatter.format_size
-    if filter_func is None:
-        filter_func = lambda _: True
-
-    if size_formatter.name == "own":
-        # Switch to retained size for display
-        size_formatter = RetainedSizeFormatter()
-        display_package_sizes = {
-            package.name: installed_set.compute_retained_size(package.name)
-            for package in installed_set.packages.values()
-        }
+    """
+    Write the package graph to a binary file, in one of the `GRAPH_FORMATS` (Graphviz
+    DOT by default).
+    Node colours are computed exactly by default, or with a non-zero
+    `colour_table_size`, taken from a HeatmapColourTable with that many entries, which
+    is faster but may be off by one in a colour channel.
+    """
+    write_graph = GRAPH_FORMATS.get(output_format)
+    if write_graph is None:
+        raise ValueError(f"Unknown graph format {output_format}")
+    with profile_phase("filter and colour packages"):
+        graph = GraphContents(
+            installed_set,
+            package_sizes,
+            max_size,
+            size_formatter,
+            package_filter=package_filter,
+            include_optional=include_optional,
+            colour_table_size=colour_table_size,
+        )
+    with profile_phase(f"write {output_format}"):
+        write_graph(graph, output_file)
+
+
+def make_size_formatter(size_type: str) -> SizeFormatter:
+    """
+    Get the formatter for a size type, as named on the command line.
+    """
+    if size_type == "own":
+        return OwnSizeFormatter()
+    elif size_type == "retained":
+        return RetainedSizeFormatter()
+    elif size_type == "adjusted":
+        return AdjustedSizeFormatter()
+    elif size_type == "uniquely-retained":
+        return UniquelyRetainedSizeFormatter()
+    elif size_type == "retained-packages":
+        return RetainedPackagesFormatter()
     else:
-        display_package_sizes = package_sizes
+        raise ValueError(f"Unknown size type {size_type}")
 
-    colouring = heatmap_colouring(
-        0,
-        max_size,
-        [(0.5, 0.5, 1.0), (1.0, 1.0, 1.0), (0.9, 0.9, 0.5), (1.0, 0.5, 0.5)],
+
+def analyse_host(
+    dump_path: str,
+    output_dir: str,
+    size_type: str,
+    include_optional: bool = False,
+    compress: bool = False,
+    output_format: str = "dot",
+    colour_table_size: int = 0,
+) -> "Tuple[str, List[str], bytes, bytes, bytes]":
+    """
+    Parse one host's `pacman -Qi` dump, write its graph to the output directory, and
+    return a compact summary of it for `FleetSummary`: the host name, the installed
+    package names, their own sizes and sizes of the given type (as `array("q")` bytes),
+    and a flag per package saying whether it is retained by an explicitly installed
+    package.
+    """
+    host = os.path.basename(dump_path)
+    for suffix in (".txt", ".qi"):
+        if host.endswith(suffix):
+            host = host[: -len(suffix)]
+
+    installed_set = PacmanInstalledSet.from_pacman_qi_file(dump_path)
+
+    package_sizes = installed_set.compute_all_sizes(size_type)
+    max_size = max(package_sizes.values(), default=0)
+    graph_path = os.path.join(
+        output_dir, f"{host}.{output_format}" + (".gz" if compress else "")
     )
+    with open_graph_output(graph_path, compress) as output_file:
+        make_graph(
+            installed_set,
+            package_sizes,
+            max_size,
+            make_size_formatter(size_type),
+            output_file,
+            include_optional=include_optional,
+            colour_table_size=colour_table_size,
+            output_format=output_format,
+        )
 
-    print("digraph {", file=output_file)
-    print("node [shape=box];", file=output_file)
-    print("layout=neato", file=output_file)
-    print("overlap=false", file=output_file)
-    print("model=subset", file=output_file)
-    print(file=output_file)
-    print("// Package node definitions", file=output_file)
-    print("{", file=output_file)
+    packages = installed_set.packages.values()
+    retained = installed_set.compute_retained_set(
+        [package.name for package in packages if package.explicit_install]
+    )
+    return (
+        host,
+        list(installed_set.packages),
+        array("q", (package.size or 0 for package in packages)).tobytes(),
+        array("q", (package_sizes[package.name] for package in packages)).tobytes(),
+        bytes(package.name in retained for package in packages),
+    )
 
-    for package in installed_set.packages.values():
-        if not filter_func(package):
-            continue
 
-        size = package_sizes[package.name]
-        colour = colouring(size)
-        colour = f"#{int(colour[0] * 255):02x}{int(colour[1] * 255):02x}{int(colour[2] * 255):02x}"
+class FleetSummary:
+    """
+    Fleet-wide totals over many hosts' installed sets, built up one host at a time so
+    that no host's installed set needs to be kept around.
+    Package names are interned into a single universe shared by all hosts, and totals
+    are kept in arrays indexed by each name's position in it.
+    """
 
-        own_size = package.size or 0
-        own_size_str = format_size(own_size)
+    __slots__ = (
+        "hosts",
+        "ids",
+        "names",
+        "installed_hosts",
+        "retained_hosts",
+        "own_sizes",
+        "sizes",
+    )
 
-        calc_size = display_package_sizes[package.name]
-        calc_size_str = format_size(calc_size)
+    hosts: "List[str]"
+    ids: "Dict[str, int]"
+    names: "List[str]"
+    installed_hosts: "array[int]"
+    retained_hosts: "array[int]"
+    own_sizes: "array[int]"
+    sizes: "array[int]"
 
-        details = (
-            f"{package.name}\\n{own_size_str}; {size_formatter.name} {calc_size_str}"
-        )
-        print(
-            f'"{package.name}" [label="{details}" style=filled fillcolor="{colour}"]',
-            file=output_file,
+    def __init__(self):
+        self.hosts = []
+        self.ids = {}
+        self.names = []
+        self.installed_hosts = array("I")
+        self.retained_hosts = array("I")
+        self.own_sizes = array("q")
+        self.sizes = array("q")
+
+    def add_host(self, summary: "Tuple[str, List[str], bytes, bytes, bytes]"):
+        """
+        Add one host's summary, as returned by `analyse_host`.
+        """
+        host, names, own_size_bytes, size_bytes, retained_flags = summary
+        own_sizes = array("q")
+        own_sizes.frombytes(own_size_bytes)
+        sizes = array("q")
+        sizes.frombytes(size_bytes)
+
+        ids = self.ids
+        for name in names:
+            if name not in ids:
+                ids[sys.intern(name)] = len(self.names)
+                self.names.append(name)
+        new_packages = len(self.names) - len(self.installed_hosts)
+        for totals in (self.installed_hosts, self.retained_hosts):
+            totals.extend(0 for _ in range(new_packages))
+        for totals in (self.own_sizes, self.sizes):
+            totals.extend(0 for _ in range(new_packages))
+
+        self.hosts.append(host)
+        for name, own_size, size, retained in zip(
+            names, own_sizes, sizes, retained_flags
+        ):
+            package_id = ids[name]
+            self.installed_hosts[package_id] += 1
+            self.retained_hosts[package_id] += retained
+            self.own_sizes[package_id] += own_size
+            self.sizes[package_id] += size
+
+    def top_packages(self, count: int) -> "List[Tuple[str, int]]":
+        """
+        Find the `count` packages with the largest total sizes over the fleet, with
+        their totals, largest first.
+        """
+        return SizeIndex(self.names, list(self.sizes)).top(count)
+
+    def write_tsv(self, file: "IO[str]", size_type: str):
+        """
+        Write the totals as tab-separated values, one package per line.
+        """
+        file.write(
+            "package\thosts_installed\thosts_retained\ttotal_own_bytes"
+            f"\ttotal_{size_type}\n"
         )
+        for name in sorted(self.names):
+            package_id = self.ids[name]
+            file.write(
+                f"{name}\t{self.installed_hosts[package_id]}"
+                f"\t{self.retained_hosts[package_id]}"
+                f"\t{self.own_sizes[package_id]}\t{self.sizes[package_id]}\n"
+            )
 
-    print("}", file=output_file)
-    print(file=output_file)
-    print("// Unknown package nodes", file=output_file)
-    print("{", file=output_file)
-    print(
-        'node [style=filled fillcolor="#000000" fontcolor="#ffffff"]', file=output_file
+
+def analyse_hosts(
+    dump_paths: "Sequence[str]",
+    output_dir: str,
+    size_type: str,
+    include_optional: bool = False,
+    compress: bool = False,
+    max_workers: "Optional[int]" = None,
+    output_format: str = "dot",
+    colour_table_size: int = 0,
+) -> "Iterator[Tuple[str, List[str], bytes, bytes, bytes]]":
+    """
+    Run `analyse_host` on each dump in a pool of worker processes, yielding the
+    summaries in the order they finish. Only a couple of dumps per worker are queued at
+    once, so that results are streamed back rather than piling up.
+    """
+    analyse = partial(
+        analyse_host,
+        output_dir=output_dir,
+        size_type=size_type,
+        include_optional=include_optional,
+        compress=compress,
+        output_format=output_format,
+        colour_table_size=colour_table_size,
     )
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=stop_profiling
+    ) as executor:
+        pending: "Set[Future]" = set()
+        for dump_path in dump_paths:
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(analyse, dump_path))
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def top_tsv_lines(top: "List[Tuple[str, int]]", size_column: str) -> "Iterator[str]":
+    """
+    Format packages and their sizes as lines of tab-separated values, for `write_lines`.
+    """
+    yield f"package\t{size_column}"
+    for name, size in top:
+        yield f"{name}\t{size}"
 
-    for package_name in installed_set.unknowns:
-        print(
-            f'"{package_name}"',
-            file=output_file,
-        )
 
-    print("}", file=output_file)
-    print(file=output_file)
-    print("// Dependency edges", file=output_file)
-    print("{", file=output_file)
+@profiled("batch")
+def run_batch(
+    dump_dir: str,
+    output_dir: str,
+    size_type: str,
+    include_optional: bool = False,
+    compress: bool = False,
+    max_workers: "Optional[int]" = None,
+    output_format: str = "dot",
+    top: "Optional[int]" = None,
+    colour_table_size: int = 0,
+) -> FleetSummary:
+    """
+    Analyse every `pacman -Qi` dump in a directory, writing a graph per host and the
+    fleet-wide totals (`fleet.tsv`) to the output directory. If `top` is given, the
+    packages with the largest totals are also listed in `fleet-top.tsv`.
+    """
+    dump_paths = sorted(
+        entry.path
+        for entry in os.scandir(dump_dir)
+        if entry.is_file() and not entry.name.startswith(".")
+    )
+    os.makedirs(output_dir, exist_ok=True)
+
+    fleet = FleetSummary()
+    with tqdm(total=len(dump_paths), unit="hosts", desc="Analysing hosts") as t:
+        for summary in analyse_hosts(
+            dump_paths,
+            output_dir,
+            size_type,
+            include_optional=include_optional,
+            compress=compress,
+            max_workers=max_workers,
+            output_format=output_format,
+            colour_table_size=colour_table_size,
+        ):
+            fleet.add_host(summary)
+            t.update()
+
+    with open(os.path.join(output_dir, "fleet.tsv"), "w", encoding="utf-8") as file:
+        fleet.write_tsv(file, size_type)
+    if top is not None:
+        with open(os.path.join(output_dir, "fleet-top.tsv"), "wb") as file:
+            write_lines(
+                file, top_tsv_lines(fleet.top_packages(top), f"total_{size_type}")
+            )
+    return fleet
 
-    for package in installed_set.packages.values():
-        if not filter_func(package):
-            continue
 
-        for dependency in package.dependencies:
-            if dependency in installed_set.packages and not filter_func(
-                installed_set.packages[dependency]
-            ):
-                continue
+class QueryServer:
+    """
+    Answers queries about an installed set which is loaded once and kept in memory,
+    so that each query costs milliseconds rather than a full parse and graph build.
+
+    Queries and answers are JSON objects, one per line. Each query has a "query" field
+    naming its type, and an optional "id" which is copied into the answer. Answers have
+    either a "result" or an "error" field. The query types are:
+
+    - "size": `kind` (as in `--size-type`) of the set of `packages`
+    - "top": the `count` packages with the largest sizes of `kind`, as pairs of name
+      and size
+    - "retained": the packages retained by the set of `packages`
+    - "dependants": the packages which (transitively) depend on the set of `packages`
+    - "path": a shortest dependency chain to `package`, from `start` if given, or else
+      from any explicitly installed package
+    - "dot": the graph in DOT format, limited to `packages` plus what they retain (or
+      with `"retained": false`, just the packages themselves) and further by a
+      `filter` expression if given, with sizes of `kind` and optional dependencies
+      if `optional` is set
+    """
 
-            print(f'"{package.name}" -> "{dependency}"', file=output_file)
+    __slots__ = ("installed_set", "all_sizes", "size_indexes", "lock")
+
+    installed_set: PacmanInstalledSet
+    all_sizes: "Dict[str, Dict[str, int]]"
+    size_indexes: "Dict[str, SizeIndex]"
+    lock: "threading.Lock"
+
+    def __init__(self, installed_set: PacmanInstalledSet, warm: bool = True):
+        self.installed_set = installed_set
+        self.all_sizes = {}
+        self.size_indexes = {}
+        self.lock = threading.Lock()
+        if warm:
+            installed_set.build_retained_set_engine()
+            installed_set.build_dominator_tree()
+            for kind in ("retained", "adjusted", "uniquely-retained"):
+                self.get_all_sizes(kind)
+
+    def get_all_sizes(self, kind: str) -> "Dict[str, int]":
+        """
+        Get one kind of size for every package, computing it on first use.
+        """
+        sizes = self.all_sizes.get(kind)
+        if sizes is None:
+            sizes = self.all_sizes[kind] = self.installed_set.compute_all_sizes(kind)
+        return sizes
 
-    print("}", file=output_file)
+    @staticmethod
+    def _packages(request: "Dict[str, Any]") -> "List[str]":
+        packages = request.get("packages")
+        if isinstance(packages, str):
+            return [packages]
+        if not isinstance(packages, list) or not packages:
+            raise ValueError("Expected a non-empty list of packages")
+        return packages
+
+    def _check_known(self, packages: "Iterable[str]"):
+        installed_set = self.installed_set
+        for name in packages:
+            if installed_set.resolve_alias(name) not in installed_set.packages:
+                raise ValueError(f"Package {name} not installed")
+
+    def answer(self, request: "Dict[str, Any]") -> "Any":
+        """
+        Answer a single query, raising ValueError if it is malformed.
+        """
+        installed_set = self.installed_set
+        query = request.get("query")
+
+        if query == "size":
+            kind = request.get("kind", "retained")
+            packages = self._packages(request)
+            self._check_known(packages)
+            if len(packages) == 1:
+                name = installed_set.resolve_alias(packages[0])
+                if kind == "own":
+                    return installed_set[name].size or 0
+                return self.get_all_sizes(kind)[name]
+            return installed_set.compute_size(kind, packages)
+        elif query == "top":
+            kind = request.get("kind", "retained")
+            count = request.get("count", 10)
+            if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+                raise ValueError("Expected a non-negative count")
+            index = self.size_indexes.get(kind)
+            if index is None:
+                if kind not in self.all_sizes and kind != "own":
+                    # Only as many sizes as the answer needs are computed, if possible
+                    return installed_set.top_packages(kind, count)
+                package_sizes = (
+                    installed_set.compute_all_sizes("own")
+                    if kind == "own"
+                    else self.all_sizes[kind]
+                )
+                index = self.size_indexes[kind] = SizeIndex.from_dict(package_sizes)
+            return index.top(count)
+        elif query == "retained":
+            packages = self._packages(request)
+            self._check_known(packages)
+            return sorted(installed_set.compute_retained_set(packages))
+        elif query == "dependants":
+            packages = self._packages(request)
+            self._check_known(packages)
+            return sorted(installed_set.compute_dependants(packages))
+        elif query == "path":
+            package = request.get("package")
+            start = request.get("start")
+            self._check_known([package] if start is None else [package, start])
+            return installed_set.find_dependency_path(package, start)
+        elif query == "dot":
+            packages = self._packages(request)
+            self._check_known(packages)
+            package_filter = (
+                ReachableFrom(packages)
+                if request.get("retained", True)
+                else Packages(packages)
+            )
+            if request.get("filter") is not None:
+                package_filter &= parse_package_filter(request["filter"])
+            kind = request.get("kind", "retained")
+            package_sizes = (
+                installed_set.compute_all_sizes("own")
+                if kind == "own"
+                else self.get_all_sizes(kind)
+            )
+            output = io.BytesIO()
+            make_graph(
+                installed_set,
+                package_sizes,
+                max(package_sizes.values(), default=0),
+                make_size_formatter(kind),
+                output,
+                package_filter=package_filter,
+                include_optional=bool(request.get("optional", False)),
+            )
+            return output.getvalue().decode("utf-8")
+        else:
+            raise ValueError(f"Unknown query type {query!r}")
 
-    if include_optional:
-        print(file=output_file)
-        print("// Optional dependency edges", file=output_file)
-        print("{", file=output_file)
-        print("edge [style=dashed]", file=output_file)
+    def handle_line(self, line: str) -> str:
+        """
+        Answer a query given as a line of JSON, returning the answer as a line of JSON.
+        """
+        request: "Any" = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Query must be a JSON object")
+            with self.lock:
+                response = {"result": self.answer(request)}
+        except (ValueError, KeyError, TypeError) as e:
+            response = {"error": str(e)}
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        return json.dumps(response) + "\n"
+
+    def serve_stream(self, input_stream: "IO[str]", output_stream: "IO[str]"):
+        """
+        Answer queries from a stream, one per line, until it ends.
+        """
+        for line in input_stream:
+            if line.strip():
+                output_stream.write(self.handle_line(line))
+                output_stream.flush()
 
-        for package in installed_set.packages.values():
-            if not filter_func(package):
-                continue
+    def make_unix_server(self, path: str) -> "socketserver.UnixStreamServer":
+        """
+        Create a server listening on a Unix socket, which answers queries from any
+        number of clients at once. Call `serve_forever` on it to start answering.
+        A socket left at the path by a server which has gone away is replaced, but
+        anything else there is left alone, and a ValueError is raised.
+        """
+        query_server = self
 
-            for dependency in package.optional_dependencies:
-                if dependency in installed_set.packages and not filter_func(
-                    installed_set.packages[dependency]
-                ):
-                    continue
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        response = query_server.handle_line(line.decode("utf-8"))
+                        self.wfile.write(response.encode("utf-8"))
 
-                print(
-                    f'"{package.name}" -> "{dependency}"',
-                    file=output_file,
-                )
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(f"{path} already exists and is not a socket")
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except ConnectionRefusedError:
+                    os.unlink(path)
+                else:
+                    raise ValueError(f"Another server is already listening on {path}")
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        return server
+
+
+class QueryClient:
+    """
+    Client for a QueryServer listening on a Unix socket.
+    """
 
-        print("}", file=output_file)
+    __slots__ = ("connection", "reader", "next_id")
 
-    print("}", file=output_file)
+    connection: "socket.socket"
+    reader: "IO[bytes]"
+    next_id: int
 
+    def __init__(self, path: str):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(path)
+        self.reader = self.connection.makefile("rb")
+        self.next_id = 0
 
-def main():
-    """Main entry point; parses pacman output and prints a graph of the packages."""
+    def query(self, query: str, **params: "Any") -> "Any":
+        """
+        Send a query and wait for its result, raising ValueError if the server reports
+        an error.
+        """
+        self.next_id += 1
+        request = dict(params, query=query, id=self.next_id)
+        self.connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        response = json.loads(self.reader.readline())
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self.reader.close()
+        self.connection.close()
+
+    def __enter__(self) -> "QueryClient":
+        return self
 
-    package_sizes: "Dict[str, int]" = {}
-    max_size: int = 0
-    size_90th_percentile: int = 0
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    package_filters = {
-        "no-deps": (lambda _: lambda package: not package.dependencies),
-        "no-revdeps": (
-            lambda installed_set: lambda package: package.name
-            not in installed_set.revdep_cache
-        ),
-        "no-optional-deps": (
-            lambda _: lambda package: not package.optional_dependencies
-        ),
-        "no-optional-revdeps": (
-            lambda installed_set: lambda package: package.name
-            not in installed_set.optional_revdep_cache
-        ),
-        "installed-explicitly": (lambda _: lambda package: package.explicit_install),
-        "installed-as-dep": (lambda _: lambda package: not package.explicit_install),
-        "top-size": lambda _: lambda package: package_sizes[package.name] >= max_size * 0.5,
-        "top-size-percentile": lambda _: lambda package: package_sizes[package.name] >= size_90th_percentile,
-    }
+
+def main():
+    """Main entry point; parses pacman output and prints a graph of the packages."""
 
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Generate a graph of pacman packages.")
@@ -871,62 +4791,192 @@ def main():
     parser.add_argument(
         "--filter",
         action="append",
-        choices=package_filters.keys(),
-        help="Filter packages to display in the graph. May be used multiple times, in which case all specified filters are applied.",
+        metavar="EXPRESSION",
+        help="Filter packages to display in the graph. May be used multiple times, in which case all specified filters are applied. "
+        "Filters are combined with and, or, not and parentheses, from: "
+        + ", ".join(PACKAGE_FILTERS)
+        + ", name:REGEX, package:NAME[,NAME...], min-size:SIZE, max-size:SIZE, "
+        "reachable-from:NAME[,NAME...], neighbourhood:NAME[:DEPTH], top:COUNT",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="File to write the graph to (default: standard output), or with --batch, "
+        "the directory to write graphs and fleet.tsv to (default: current directory)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=GRAPH_FORMATS.keys(),
+        default="dot",
+        help="Format to write the graph in: Graphviz DOT, JSON lines, GraphML or a "
+        "NumPy .npz archive of arrays (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--colour-table-size",
+        type=int,
+        default=0,
+        metavar="ENTRIES",
+        help="Colour nodes from a precomputed table with this many entries, which is "
+        "faster for large graphs; with 256 entries or more, each colour channel is "
+        "at most one off (default: 0, for exact colours)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        metavar="COUNT",
+        help="Instead of a graph, list the COUNT largest packages by --size-type as "
+        "tab-separated values, or with --batch, also list the COUNT largest fleet-wide "
+        "totals in fleet-top.tsv",
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Compress the graph with gzip (implied if the output file ends with .gz)",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="DUMP_DIR",
+        help="Analyse a directory of pacman -Qi dumps, one per host, writing a graph "
+        "for each host plus fleet-wide totals",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes for --batch (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Answer JSON-lines queries about the installed packages on standard input, "
+        "instead of printing a graph",
+    )
+    parser.add_argument(
+        "--serve-socket",
+        metavar="PATH",
+        help="Answer JSON-lines queries about the installed packages on a Unix socket, "
+        "instead of printing a graph",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Write a JSON report of the time taken by each phase of the run, and "
+        "counters such as retained set cache hits, to a file",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Also record the peak memory use of each phase with --profile (this "
+        "makes everything slower)",
+    )
+    parser.add_argument(
+        "--db-path",
+        default="/var/lib/pacman/local",
+        help="Path to the pacman local database (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-path",
+        default="/var/log/pacman.log",
+        help="Path to the pacman log, used to update the cache incrementally (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="Directory to cache the parsed package database in (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Neither read nor write the package database cache",
     )
     args = parser.parse_args()
 
-    if args.size_type == "own":
-        size_formatter = OwnSizeFormatter()
-    elif args.size_type == "retained":
-        size_formatter = RetainedSizeFormatter()
-    elif args.size_type == "adjusted":
-        size_formatter = AdjustedSizeFormatter()
-    elif args.size_type == "uniquely-retained":
-        size_formatter = UniquelyRetainedSizeFormatter()
-    elif args.size_type == "retained-packages":
-        size_formatter = RetainedPackagesFormatter()
-    else:
-        raise ValueError(f"Unknown size type {args.size_type}")
-
-    installed_set = PacmanInstalledSet.retrieve_pacman_packages()
-    filters = [
-        package_filters[filter_name](installed_set) for filter_name in args.filter or []
-    ]
-    overall_filter_func = None
+    if args.format == "npz" and args.gzip:
+        parser.error("--gzip cannot be used with --format npz")
+    if args.top is not None and args.top < 0:
+        parser.error("--top must not be negative")
+    if args.colour_table_size and args.colour_table_size < 2:
+        parser.error("--colour-table-size must be 0 or at least 2")
+
+    try:
+        filters = [parse_package_filter(expression) for expression in args.filter or []]
+    except ValueError as e:
+        parser.error(str(e))
+    package_filter = AllOf(filters) if filters else None
+    if args.batch is not None and args.filter:
+        parser.error("--filter cannot be used with --batch")
+
+    if args.profile is None:
+        run(args, package_filter)
+        return
+
+    profiler = PhaseProfiler(trace_memory=args.profile_memory)
+    profiler.start()
+    try:
+        run(args, package_filter)
+    finally:
+        profiler.stop()
+        profiler.write_summary(sys.stderr)
+        with open(args.profile, "w", encoding="utf-8") as file:
+            json.dump(profiler.report(), file, indent=2)
+            file.write("\n")
+
+
+def run(args: argparse.Namespace, package_filter: "Optional[PackageFilter]"):
+    """
+    Do what the command-line arguments parsed by `main` ask for.
+    """
+    if args.batch is not None:
+        run_batch(
+            args.batch,
+            args.output or ".",
+            args.size_type,
+            include_optional=args.optional,
+            compress=args.gzip,
+            max_workers=args.workers,
+            output_format=args.format,
+            top=args.top,
+            colour_table_size=args.colour_table_size,
+        )
+        return
 
-    def filter_and(f1, f2):
-        return lambda package: f1(package) and f2(package)
+    size_formatter = make_size_formatter(args.size_type)
 
-    for filter_func in filters:
-        if overall_filter_func is None:
-            overall_filter_func = filter_func
+    installed_set = PacmanInstalledSet.retrieve_pacman_packages(
+        None if args.no_cache else InstalledSetCache(args.cache_dir),
+        args.db_path,
+        args.log_path,
+    )
+    if args.serve or args.serve_socket:
+        query_server = QueryServer(installed_set)
+        if args.serve_socket:
+            with query_server.make_unix_server(args.serve_socket) as server:
+                print(f"Listening on {args.serve_socket}", file=sys.stderr)
+                server.serve_forever()
         else:
-            overall_filter_func = filter_and(overall_filter_func, filter_func)
-
-    size_calc = partial(size_formatter.get_size, installed_set)
-    package_sizes = {
-        package.name: size_calc(package)
-        for package in tqdm(
-            installed_set.packages.values(),
-            desc="Computing package sizes",
-            unit="packages",
+            query_server.serve_stream(sys.stdin, sys.stdout)
+        return
+
+    if args.top is not None:
+        top = installed_set.top_packages(args.size_type, args.top)
+        with open_graph_output(args.output, args.gzip) as output_file:
+            write_lines(output_file, top_tsv_lines(top, args.size_type))
+        return
+
+    package_sizes = installed_set.compute_all_sizes(args.size_type)
+    max_size = max(package_sizes.values())
+
+    with open_graph_output(args.output, args.gzip) as output_file:
+        make_graph(
+            installed_set,
+            package_sizes,
+            max_size,
+            size_formatter,
+            output_file,
+            package_filter=package_filter,
+            include_optional=args.optional,
+            colour_table_size=args.colour_table_size,
+            output_format=args.format,
         )
-    }
-    sorted_sizes = sorted(package_sizes.values())
-    max_size = sorted_sizes[-1]
-    size_90th_percentile = sorted_sizes[int(len(sorted_sizes) * 0.9)]
-    del sorted_sizes
-
-    make_graph(
-        installed_set,
-        package_sizes,
-        max_size,
-        size_formatter,
-        sys.stdout,
-        filter_func=overall_filter_func,
-        include_optional=args.optional,
-    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,2415 @@
+#!/usr/bin/env python3
+# pylint: disable=no-else-return
+"""
+Benchmarks for pacman_graph.py, run against synthetic installed sets so that they can be
+run without a real Arch system.
+"""
+
+import argparse
+from fractions import Fraction
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from itertools import chain
+from xml.etree import ElementTree
+
+from pacman_graph import (
+    AdjustedSizeFormatter,
+    FilterContext,
+    FleetSummary,
+    GRAPH_PALETTE,
+    InstalledSetCache,
+    OwnSizeFormatter,
+    PacmanInstalledSet,
+    PacmanPackage,
+    PhaseProfiler,
+    QueryClient,
+    QueryServer,
+    RetainedPackagesFormatter,
+    RetainedSetCache,
+    RetainedSizeFormatter,
+    SizeFormatter,
+    SizeIndex,
+    UniquelyRetainedSizeFormatter,
+    HeatmapColourTable,
+    format_size,
+    graph_colour_table,
+    hash_file,
+    heatmap_colouring,
+    analyse_host,
+    bitset_ids,
+    hex_colour,
+    make_graph,
+    numpy,
+    parse_package_filter,
+    profile_phase,
+    read_pacman_log_changes,
+    run_batch,
+    scipy_sparse,
+)
+
+TYPING = False
+
+if TYPING:
+    from typing import (
+        IO,
+        Any,
+        Callable,
+        Dict,
+        FrozenSet,
+        Iterable,
+        List,
+        Optional,
+        Set,
+        Tuple,
+    )
+
+
+def make_synthetic_installed_set(
+    num_packages: int,
+    seed: int = 0,
+    max_deps: int = 8,
+    cycle_fraction: float = 0.002,
+) -> PacmanInstalledSet:
+    """
+    Generate a random installed set with a roughly realistic shape: most packages depend on
+    a handful of widely-used "core" packages, and a small fraction of dependencies point
+    back up the graph to form cycles.
+    """
+    rng = random.Random(seed)
+    names = [f"pkg{i:06d}" for i in range(num_packages)]
+    installed_set = PacmanInstalledSet()
+
+    for name in names:
+        installed_set.add_package(name)
+        package = installed_set.packages[name]
+        package.size = int(rng.lognormvariate(12, 2))
+        package.explicit_install = rng.random() < 0.1
+
+    last = num_packages - 1
+    for i, name in enumerate(names[:-1]):
+        for _ in range(rng.randint(0, max_deps)):
+            # Skew dependencies towards the end of the list, where the "core" packages live
+            j = last - int((last - i - 1) * rng.random() ** 3)
+            installed_set.add_dependency(name, names[j])
+            if rng.random() < cycle_fraction:
+                installed_set.add_dependency(names[j], name)
+
+    installed_set.finalise_dependency_sets()
+    return installed_set
+
+
+def make_scale_free_installed_set(
+    num_packages: int,
+    seed: int = 0,
+    mean_deps: float = 4.0,
+    cycle_fraction: float = 0.02,
+    alias_fraction: float = 0.05,
+    optional_fraction: float = 0.3,
+    finalise: bool = True,
+) -> PacmanInstalledSet:
+    """
+    Generate a random installed set with a scale-free dependency graph, as real ones
+    tend to be. Packages are added one at a time, each depending on earlier packages
+    picked in proportion to how many packages already depend on them, so that a few
+    libraries end up with most of the reverse dependencies.
+
+    A fraction of packages provide a virtual name, which half of the dependencies on
+    them use instead of the real one. A fraction of packages form a dependency cycle
+    with the package added before them, like split packages which depend on each other
+    (edges back to popular packages would instead merge into one giant cycle). A
+    fraction of packages get up to three optional dependencies. Unless `finalise` is
+    false, the installed set is finalised, which resolves the virtual names.
+    """
+    rng = random.Random(seed)
+    installed_set = PacmanInstalledSet()
+    names: "List[str]" = []
+    virtual_names: "Dict[str, str]" = {}
+    # Every package is in here once, plus once per reverse dependency, so picking from
+    # it uniformly is picking in proportion to reverse dependencies
+    attachment: "List[str]" = []
+    depended_on: "Set[str]" = set()
+
+    for i in range(num_packages):
+        name = f"pkg{i:06d}"
+        installed_set.add_package(name)
+        package = installed_set.packages[name]
+        package.size = int(rng.lognormvariate(12, 2))
+        package.explicit_install = rng.random() < 0.1
+        if rng.random() < alias_fraction:
+            virtual_names[name] = f"virtual{i:06d}"
+            installed_set.add_alias(virtual_names[name], name)
+
+        if names:
+            num_deps = int(rng.expovariate(1 / mean_deps))
+            # Deduplicated in the order picked, as set order varies with the hash seed
+            picked = dict.fromkeys(rng.choice(attachment) for _ in range(num_deps))
+            for dependency in picked:
+                attachment.append(dependency)
+                depended_on.add(dependency)
+                if dependency in virtual_names and rng.random() < 0.5:
+                    installed_set.add_dependency(name, virtual_names[dependency])
+                else:
+                    installed_set.add_dependency(name, dependency)
+            # Only a package nothing depends on yet can't be reached from this one's
+            # other dependencies, which keeps the cycle to the two of them
+            if rng.random() < cycle_fraction and names[-1] not in depended_on:
+                installed_set.add_dependency(name, names[-1])
+                installed_set.add_dependency(names[-1], name)
+                depended_on.update((name, names[-1]))
+            if rng.random() < optional_fraction:
+                for _ in range(rng.randint(1, 3)):
+                    installed_set.add_optional_dependency(name, rng.choice(names))
+
+        names.append(name)
+        attachment.append(name)
+
+    if finalise:
+        installed_set.finalise_dependency_sets()
+    return installed_set
+
+
+def to_pacman_qi(installed_set: PacmanInstalledSet) -> str:
+    """
+    Serialise an installed set in the format printed by `pacman -Qi`.
+    """
+    provides: "Dict[str, List[str]]" = {}
+    for alias, target in installed_set.aliases.items():
+        provides.setdefault(target, []).append(alias)
+
+    revdeps = installed_set.revdep_cache or {}
+    optional_revdeps = installed_set.optional_revdep_cache or {}
+
+    def field(key: str, value: str) -> str:
+        return f"{key:<16}: {value}\n"
+
+    def listing(values: "Iterable[str]") -> str:
+        return "  ".join(sorted(values)) or "None"
+
+    records = []
+    for name, package in installed_set.packages.items():
+        optional_lines = [
+            f"{dependency}: for extra features"
+            + (" [installed]" if dependency in installed_set.packages else "")
+            for dependency in sorted(package.optional_dependencies)
+        ]
+        records.append(
+            "".join(
+                (
+                    field("Name", name),
+                    field("Version", "1.0-1"),
+                    field("Description", f"Synthetic package {name}"),
+                    field("Architecture", "x86_64"),
+                    field("URL", f"https://example.org/{name}"),
+                    field("Licenses", "GPL"),
+                    field("Groups", "None"),
+                    field("Provides", listing(provides.get(name, ()))),
+                    field("Depends On", listing(package.dependencies)),
+                    field(
+                        "Optional Deps",
+                        ("\n" + " " * 18).join(optional_lines) or "None",
+                    ),
+                    field("Required By", listing(revdeps.get(name, ()))),
+                    field("Optional For", listing(optional_revdeps.get(name, ()))),
+                    field("Conflicts With", "None"),
+                    field("Replaces", "None"),
+                    field("Installed Size", format_size(package.size or 0)),
+                    field("Packager", "Nobody <nobody@example.org>"),
+                    field("Build Date", "Thu 01 Jan 1970 00:00:00 UTC"),
+                    field("Install Date", "Thu 01 Jan 1970 00:00:00 UTC"),
+                    field(
+                        "Install Reason",
+                        (
+                            "Explicitly installed"
+                            if package.explicit_install
+                            else "Installed as a dependency for another package"
+                        ),
+                    ),
+                    field("Install Script", "No"),
+                    field("Validated By", "Signature"),
+                )
+            )
+        )
+    return "\n".join(records) + "\n"
+
+
+def make_fixture_installed_set() -> PacmanInstalledSet:
+    """
+    Build a small, fixed installed set for `--check`, with a virtual name, a dependency
+    cycle and both installed and missing optional dependencies. No package has more than
+    one dependency or optional dependency, so that graphs of it come out in the same
+    order whatever the hash seed.
+    """
+    installed_set = PacmanInstalledSet()
+    for name, size, explicit in (
+        ("firefox", 250 * 1024**2, True),
+        ("gtk3", 40 * 1024**2, False),
+        ("cairo", 2 * 1024**2, False),
+        ("glibc", 45 * 1024**2, False),
+        ("ffmpeg", 30 * 1024**2, True),
+        ("x264", 3 * 1024**2, False),
+        ("python-pip", 9 * 1024**2, True),
+        ("python-setuptools", 5 * 1024**2, False),
+        ("python", 80 * 1024**2, False),
+        ("orphan", None, False),
+        ("tiny", 512, True),
+    ):
+        installed_set.add_package(name)
+        package = installed_set.packages[name]
+        package.size = size
+        package.explicit_install = explicit
+
+    installed_set.add_alias("libcairo", "cairo")
+    for package, dependency in (
+        ("firefox", "gtk3"),
+        ("gtk3", "libcairo"),
+        ("cairo", "glibc"),
+        ("ffmpeg", "x264"),
+        ("x264", "glibc"),
+        ("python-pip", "python-setuptools"),
+        ("python-setuptools", "python-pip"),
+        ("python", "glibc"),
+    ):
+        installed_set.add_dependency(package, dependency)
+    for package, dependency in (
+        ("firefox", "ffmpeg"),
+        ("ffmpeg", "vulkan-driver"),
+        ("python-setuptools", "python"),
+    ):
+        installed_set.add_optional_dependency(package, dependency)
+
+    installed_set.finalise_dependency_sets()
+    return installed_set
+
+
+def write_pacman_desc(
+    db_path: str, package: PacmanPackage, provides: "Iterable[str]", version: str
+):
+    """
+    Write a single package's `desc` file into a pacman local database.
+    """
+
+    def section(key: str, values: "Iterable[str]") -> str:
+        values = list(values)
+        if not values:
+            return ""
+        return f"%{key}%\n" + "".join(f"{value}\n" for value in values) + "\n"
+
+    name = package.name
+    package_dir = os.path.join(db_path, f"{name}-{version}")
+    os.mkdir(package_dir)
+    with open(os.path.join(package_dir, "desc"), "w", encoding="utf-8") as file:
+        file.write(
+            "".join(
+                (
+                    section("NAME", [name]),
+                    section("VERSION", [version]),
+                    section("DESC", [f"Synthetic package {name}"]),
+                    section("ARCH", ["x86_64"]),
+                    section("SIZE", [str(package.size or 0)]),
+                    section("REASON", [] if package.explicit_install else ["1"]),
+                    section("PROVIDES", sorted(provides)),
+                    section("DEPENDS", sorted(package.dependencies)),
+                    section(
+                        "OPTDEPENDS",
+                        (
+                            f"{dependency}: for extra features"
+                            for dependency in sorted(package.optional_dependencies)
+                        ),
+                    ),
+                )
+            )
+        )
+
+
+def write_pacman_local_db(installed_set: PacmanInstalledSet, db_path: str):
+    """
+    Write an installed set out as a pacman local database, with one `desc` file per package.
+    """
+    provides: "Dict[str, List[str]]" = {}
+    for alias, target in installed_set.aliases.items():
+        provides.setdefault(target, []).append(alias)
+
+    os.makedirs(db_path, exist_ok=True)
+    with open(os.path.join(db_path, "ALPM_DB_VERSION"), "w", encoding="utf-8") as file:
+        file.write("9\n")
+
+    for name, package in installed_set.packages.items():
+        write_pacman_desc(db_path, package, provides.get(name, ()), "1.0-1")
+
+
+def run_synthetic_transaction(
+    db_path: str,
+    log_path: str,
+    rng: random.Random,
+    num_changes: int,
+    tag: str,
+    virtuals: "List[str]",
+):
+    """
+    Remove, upgrade and install packages in a synthetic pacman local database, logging
+    each change to the pacman log as pacman would. Upgraded packages provide new virtual
+    names, and upgraded and installed packages depend on the given existing ones, so that
+    aliases come and go as well.
+    """
+    with os.scandir(db_path) as it:
+        entries = {
+            entry.name.rsplit("-", 2)[0]: entry.name
+            for entry in it
+            if entry.is_dir(follow_symlinks=False)
+        }
+    names = sorted(entries)
+    changed = rng.sample(names, min(2 * num_changes, len(names)))
+    removed, upgraded = changed[:num_changes], changed[num_changes:]
+    survivors = sorted(set(names).difference(removed))
+
+    def write_random_package(name: str, version: str, provides: "List[str]"):
+        package = PacmanPackage(name)
+        package.size = int(rng.lognormvariate(12, 2))
+        package.explicit_install = rng.random() < 0.1
+        package.dependencies = set(rng.sample(survivors, rng.randint(0, 4)))
+        package.dependencies.update(rng.sample(virtuals, min(2, len(virtuals))))
+        package.optional_dependencies = set(rng.sample(names, rng.randint(0, 2)))
+        write_pacman_desc(db_path, package, provides, version)
+
+    prefix = "[2024-01-01T00:00:00+0000] [ALPM]"
+    log_lines = []
+    for name in removed:
+        shutil.rmtree(os.path.join(db_path, entries[name]))
+        log_lines.append(f"{prefix} removed {name} ({entries[name][len(name) + 1:]})")
+    # Each virtual name is provided by one package at a time, since which of several
+    # providers wins depends on the order the database is read in
+    for i, name in enumerate(upgraded):
+        shutil.rmtree(os.path.join(db_path, entries[name]))
+        write_random_package(name, f"{tag}-1", [f"virtual-{tag}-{i}"])
+        log_lines.append(
+            f"{prefix} upgraded {name} ({entries[name][len(name) + 1:]} -> {tag}-1)"
+        )
+    for i in range(num_changes):
+        name = f"new-{tag}-{i}"
+        write_random_package(name, "1.0-1", [])
+        log_lines.append(f"{prefix} installed {name} (1.0-1)")
+
+    with open(log_path, "a", encoding="utf-8") as log:
+        log.write("".join(f"{line}\n" for line in log_lines))
+
+
+def describe_installed_set(installed_set: PacmanInstalledSet) -> "object":
+    """
+    Reduce an installed set to plain data, so that two of them can be compared.
+    """
+    return (
+        {
+            name: (
+                package.dependencies,
+                package.optional_dependencies,
+                package.size,
+                package.explicit_install,
+            )
+            for name, package in installed_set.packages.items()
+        },
+        installed_set.aliases,
+        installed_set.unknowns,
+    )
+
+
+def timed(label: str, func: "Callable[[], object]") -> "object":
+    """
+    Run a function once, print how long it took, and return its result.
+    """
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed:10.3f} s", file=sys.stderr)
+    return result
+
+
+class TimeLimitExceeded(Exception):
+    """
+    Raised when a benchmarked function runs past its time limit.
+    """
+
+
+def run_with_time_limit(func: "Callable[[], None]", time_limit: float) -> bool:
+    """
+    Run a function until it returns or the time limit expires.
+    Returns whether it finished in time.
+    """
+
+    def on_alarm(_signum, _frame):
+        raise TimeLimitExceeded()
+
+    old_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, time_limit)
+    try:
+        func()
+        return True
+    except TimeLimitExceeded:
+        return False
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def bench_retained(num_packages: int, seed: int, time_limit: float):
+    """
+    Compare the recursive retained size computation with the SCC-condensed engine.
+    The recursive path can take exponential time around dependency cycles, so it is only
+    run until the time limit expires, and compared on the packages it managed to finish.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    names = list(installed_set.packages)
+
+    recursive: "Dict[str, int]" = {}
+
+    def recursive_sizes():
+        for name in names:
+            recursive[name] = installed_set.compute_retained_size(name)
+
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, num_packages * 4))
+    try:
+        timed(
+            "recursive retained sizes",
+            lambda: run_with_time_limit(recursive_sizes, time_limit),
+        )
+    finally:
+        sys.setrecursionlimit(old_limit)
+    print(
+        f"  (recursive path finished {len(recursive)} of {num_packages} packages)",
+        file=sys.stderr,
+    )
+
+    timed("build SCC engine", installed_set.build_retained_set_engine)
+    engine: "Dict[str, int]" = timed(
+        "engine retained sizes",
+        lambda: {name: installed_set.compute_retained_size(name) for name in names},
+    )
+
+    if any(engine[name] != size for name, size in recursive.items()):
+        raise AssertionError("Engine retained sizes differ from recursive ones")
+
+
+def bench_sizes(num_packages: int, seed: int, time_limit: float):
+    """
+    Compare computing every package's size one at a time with the batch computation,
+    for each size type.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    timed("build SCC engine", installed_set.build_retained_set_engine)
+
+    for formatter in (
+        OwnSizeFormatter(),
+        RetainedSizeFormatter(),
+        AdjustedSizeFormatter(),
+        UniquelyRetainedSizeFormatter(),
+        RetainedPackagesFormatter(),
+    ):
+        kind = formatter.name.replace(" ", "-")
+        per_package: "Dict[str, int]" = {}
+
+        def per_package_sizes():
+            for package in installed_set.packages.values():
+                per_package[package.name] = formatter.get_size(installed_set, package)
+
+        timed(
+            f"{kind}: per-package",
+            lambda: run_with_time_limit(per_package_sizes, time_limit),
+        )
+        batch: "Dict[str, int]" = timed(
+            f"{kind}: batch", lambda: installed_set.compute_all_sizes(kind)
+        )
+        differences = sum(
+            1 for name, size in per_package.items() if batch[name] != size
+        )
+        print(
+            f"  (per-package finished {len(per_package)} of {num_packages} packages, "
+            f"{differences} differ from batch)",
+            file=sys.stderr,
+        )
+
+
+def bench_parse(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare the line-by-line `pacman -Qi` parser with the whole-buffer parser.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", encoding="utf-8") as dump:
+        dump.write(
+            timed("serialise to pacman -Qi format", lambda: to_pacman_qi(installed_set))
+        )
+        dump.flush()
+        print(
+            f"  ({os.path.getsize(dump.name) / 1024**2:.1f} MiB dump)", file=sys.stderr
+        )
+
+        def parse_stream() -> PacmanInstalledSet:
+            with open(dump.name, "r", encoding="utf-8") as file:
+                return PacmanInstalledSet.from_pacman_qi_stream(file)
+
+        line_parsed = timed("line-by-line parser", parse_stream)
+        buffer_parsed = timed(
+            "whole-buffer parser",
+            lambda: PacmanInstalledSet.from_pacman_qi_file(dump.name),
+        )
+
+    timed(
+        "(shared finalise_dependency_sets step)",
+        buffer_parsed.finalise_dependency_sets,
+    )
+
+    if describe_installed_set(line_parsed) != describe_installed_set(buffer_parsed):
+        raise AssertionError("Whole-buffer parser disagrees with line-by-line parser")
+
+
+def bench_cache(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare parsing a `pacman -Qi` dump with loading the same installed set from the cache.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        dump_path = os.path.join(cache_dir, "pacman_qi.txt")
+        with open(dump_path, "w", encoding="utf-8") as dump:
+            dump.write(to_pacman_qi(installed_set))
+
+        parsed = timed(
+            "parse dump", lambda: PacmanInstalledSet.from_pacman_qi_file(dump_path)
+        )
+        key = "qi:" + timed("hash dump", lambda: hash_file(dump_path))
+        cache = InstalledSetCache(cache_dir)
+        timed("store in cache", lambda: cache.store(key, parsed))
+        print(
+            f"  ({os.path.getsize(cache.path) / 1024**2:.1f} MiB cache file)",
+            file=sys.stderr,
+        )
+        loaded = timed("load from cache", lambda: cache.load(key))
+
+    if loaded is None or describe_installed_set(parsed) != describe_installed_set(
+        loaded
+    ):
+        raise AssertionError("Cached installed set differs from parsed one")
+
+
+def bench_local_db(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare reading the pacman local database directly with parsing `pacman -Qi` output.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, "local")
+        timed(
+            "write local database",
+            lambda: write_pacman_local_db(installed_set, db_path),
+        )
+        dump = to_pacman_qi(installed_set)
+
+        from_qi = timed(
+            "parse pacman -Qi output",
+            lambda: PacmanInstalledSet.from_pacman_qi_buffer(dump),
+        )
+        from_db = timed(
+            "read local database",
+            lambda: PacmanInstalledSet.from_pacman_local_db(db_path),
+        )
+
+    for package in from_qi.packages.values():
+        package.size = None
+    sizes = {name: package.size for name, package in from_db.packages.items()}
+    for package in from_db.packages.values():
+        package.size = None
+    if describe_installed_set(from_qi) != describe_installed_set(from_db):
+        raise AssertionError("Local database reader disagrees with pacman -Qi parser")
+    if sizes != {
+        name: package.size for name, package in installed_set.packages.items()
+    }:
+        raise AssertionError("Local database reader did not give exact sizes")
+
+
+def bench_incremental(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare rebuilding the installed set after a pacman transaction with updating the
+    cached one from the pacman log, and check that both give the same sizes.
+    """
+    rng = random.Random(seed)
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    num_changes = max(1, num_packages // 500)
+    kinds = ("own", "retained", "adjusted", "uniquely-retained", "retained-packages")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, "local")
+        log_path = os.path.join(temp_dir, "pacman.log")
+        write_pacman_local_db(installed_set, db_path)
+        open(log_path, "w", encoding="utf-8").close()
+        cache = InstalledSetCache(temp_dir)
+        PacmanInstalledSet.retrieve_pacman_packages(cache, db_path, log_path)
+
+        virtuals: "List[str]" = []
+        for transaction in range(1, 4):
+            print(
+                f"  (transaction {transaction}: {num_changes} packages each removed, "
+                "upgraded and installed)",
+                file=sys.stderr,
+            )
+            run_synthetic_transaction(
+                db_path, log_path, rng, num_changes, str(transaction), virtuals
+            )
+
+            # Fill the retained set cache, to check that entries affected by the
+            # transaction are dropped
+            _, (log_offset, _), stale = cache.load_latest()
+            engine = stale.build_retained_set_engine()
+            for name in rng.sample(sorted(stale.packages), num_changes * 10):
+                stale.retained_set_cache[name] = frozenset(engine.retained_set(name))
+            stale.update_from_pacman_local_db(
+                read_pacman_log_changes(log_path, log_offset), db_path
+            )
+
+            updated = timed(
+                "update from pacman log",
+                lambda: PacmanInstalledSet.retrieve_pacman_packages(
+                    cache, db_path, log_path
+                ),
+            )
+            rebuilt = timed(
+                "rebuild from local database",
+                lambda: PacmanInstalledSet.from_pacman_local_db(db_path),
+            )
+            virtuals = sorted(rebuilt.aliases)
+
+            if describe_installed_set(updated) != describe_installed_set(rebuilt):
+                raise AssertionError("Updated installed set differs from rebuilt one")
+            for kind in kinds:
+                if updated.compute_all_sizes(kind) != rebuilt.compute_all_sizes(kind):
+                    raise AssertionError(f"Updated {kind} sizes differ from rebuilt")
+            retained_sets = rebuilt.build_retained_set_engine()
+            for name, retained_set in stale.retained_set_cache.items():
+                if retained_set != retained_sets.retained_set(name):
+                    raise AssertionError(f"Stale retained set left cached for {name}")
+
+
+def make_graph_with_print(
+    installed_set: PacmanInstalledSet,
+    package_sizes: "Dict[str, int]",
+    max_size: int,
+    size_formatter: SizeFormatter,
+    output_file: "IO[str]",
+    filter_func: "Optional[Callable[[PacmanPackage], bool]]" = None,
+    include_optional: bool = False,
+):
+    """
+    The original DOT writer, printing each line separately, for comparison with the
+    buffered writer in `make_graph`.
+    """
+    format_size = size_formatter.format_size
+    if filter_func is None:
+        filter_func = lambda _: True
+
+    if size_formatter.name == "own":
+        # Switch to retained size for display
+        size_formatter = RetainedSizeFormatter()
+        display_package_sizes = installed_set.compute_all_sizes("retained")
+    else:
+        display_package_sizes = package_sizes
+
+    colouring = heatmap_colouring(
+        0,
+        max_size,
+        [(0.5, 0.5, 1.0), (1.0, 1.0, 1.0), (0.9, 0.9, 0.5), (1.0, 0.5, 0.5)],
+    )
+
+    print("digraph {", file=output_file)
+    print("node [shape=box];", file=output_file)
+    print("layout=neato", file=output_file)
+    print("overlap=false", file=output_file)
+    print("model=subset", file=output_file)
+    print(file=output_file)
+    print("// Package node definitions", file=output_file)
+    print("{", file=output_file)
+
+    for package in installed_set.packages.values():
+        if not filter_func(package):
+            continue
+
+        size = package_sizes[package.name]
+        colour = colouring(size)
+        colour = f"#{int(colour[0] * 255):02x}{int(colour[1] * 255):02x}{int(colour[2] * 255):02x}"
+
+        own_size = package.size or 0
+        own_size_str = format_size(own_size)
+
+        calc_size = display_package_sizes[package.name]
+        calc_size_str = format_size(calc_size)
+
+        details = (
+            f"{package.name}\\n{own_size_str}; {size_formatter.name} {calc_size_str}"
+        )
+        print(
+            f'"{package.name}" [label="{details}" style=filled fillcolor="{colour}"]',
+            file=output_file,
+        )
+
+    print("}", file=output_file)
+    print(file=output_file)
+    print("// Unknown package nodes", file=output_file)
+    print("{", file=output_file)
+    print(
+        'node [style=filled fillcolor="#000000" fontcolor="#ffffff"]', file=output_file
+    )
+
+    for package_name in installed_set.unknowns:
+        print(
+            f'"{package_name}"',
+            file=output_file,
+        )
+
+    print("}", file=output_file)
+    print(file=output_file)
+    print("// Dependency edges", file=output_file)
+    print("{", file=output_file)
+
+    for package in installed_set.packages.values():
+        if not filter_func(package):
+            continue
+
+        for dependency in package.dependencies:
+            if dependency in installed_set.packages and not filter_func(
+                installed_set.packages[dependency]
+            ):
+                continue
+
+            print(f'"{package.name}" -> "{dependency}"', file=output_file)
+
+    print("}", file=output_file)
+
+    if include_optional:
+        print(file=output_file)
+        print("// Optional dependency edges", file=output_file)
+        print("{", file=output_file)
+        print("edge [style=dashed]", file=output_file)
+
+        for package in installed_set.packages.values():
+            if not filter_func(package):
+                continue
+
+            for dependency in package.optional_dependencies:
+                if dependency in installed_set.packages and not filter_func(
+                    installed_set.packages[dependency]
+                ):
+                    continue
+
+                print(
+                    f'"{package.name}" -> "{dependency}"',
+                    file=output_file,
+                )
+
+        print("}", file=output_file)
+
+    print("}", file=output_file)
+
+
+def bench_dot(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare writing the graph in DOT format a line at a time with the buffered writer,
+    and check that the output is identical. `check_dot` checks the output against that
+    of the original script itself.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    rng = random.Random(seed)
+    for package in installed_set.packages.values():
+        package.optional_dependencies = set(
+            rng.sample(sorted(installed_set.packages), rng.randint(0, 2))
+        )
+    installed_set.finalise_dependency_sets()
+    package_sizes = installed_set.compute_all_sizes("retained")
+    max_size = max(package_sizes.values())
+    num_edges = sum(
+        len(package.dependencies) + len(package.optional_dependencies)
+        for package in installed_set.packages.values()
+    )
+    print(f"  ({num_edges} edges)", file=sys.stderr)
+    formatter = RetainedSizeFormatter()
+
+    def with_print() -> bytes:
+        output = io.StringIO()
+        make_graph_with_print(
+            installed_set, package_sizes, max_size, formatter, output, None, True
+        )
+        return output.getvalue().encode("utf-8")
+
+    def buffered(colour_table_size: int = 0) -> bytes:
+        output = io.BytesIO()
+        make_graph(
+            installed_set,
+            package_sizes,
+            max_size,
+            formatter,
+            output,
+            None,
+            True,
+            colour_table_size,
+        )
+        return output.getvalue()
+
+    def buffered_gzip() -> bytes:
+        output = io.BytesIO()
+        with gzip.GzipFile(fileobj=output, mode="wb", compresslevel=6) as compressed:
+            make_graph(
+                installed_set,
+                package_sizes,
+                max_size,
+                formatter,
+                compressed,
+                None,
+                True,
+                0,
+            )
+        return output.getvalue()
+
+    timed("buffered writer, colour table", lambda: buffered(4096))
+
+    # Colours from the table may be slightly off, so compare with exact colours only
+    expected = None
+    for label, func, decode in (
+        ("print each line", with_print, bytes),
+        ("buffered writer", buffered, bytes),
+        ("buffered writer, gzipped", buffered_gzip, gzip.decompress),
+    ):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        output = decode(result)
+        print(
+            f"{label:<40} {elapsed:10.3f} s  "
+            f"({len(output) / 1024**2 / elapsed:.1f} MiB/s, {len(result)} bytes written)",
+            file=sys.stderr,
+        )
+        if expected is None:
+            expected = output
+        elif output != expected:
+            raise AssertionError(f"{label} output differs from printing each line")
+
+
+def bench_formats(num_packages: int, seed: int, _time_limit: float):
+    """
+    Time writing the graph in each output format, and check that they all describe the
+    same nodes, edges and sizes.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    rng = random.Random(seed)
+    for package in installed_set.packages.values():
+        package.optional_dependencies = set(
+            rng.sample(sorted(installed_set.packages), rng.randint(0, 2))
+        )
+    installed_set.finalise_dependency_sets()
+    package_sizes = installed_set.compute_all_sizes("retained")
+    max_size = max(package_sizes.values())
+    formatter = RetainedSizeFormatter()
+
+    def write(output_format: str) -> bytes:
+        output = io.BytesIO()
+        make_graph(
+            installed_set,
+            package_sizes,
+            max_size,
+            formatter,
+            output,
+            include_optional=True,
+            output_format=output_format,
+        )
+        return output.getvalue()
+
+    def from_json_lines(data: bytes) -> "object":
+        records = [json.loads(line) for line in data.splitlines()]
+        nodes = {
+            record["name"]: (record.get("own_size"), record.get("size"))
+            for record in records
+            if record["type"] == "node"
+        }
+        edges = {
+            (record["source"], record["target"], record["optional"])
+            for record in records
+            if record["type"] == "edge"
+        }
+        return nodes, edges
+
+    def from_graphml(data: bytes) -> "object":
+        namespace = "{http://graphml.graphdrawing.org/xmlns}"
+        graph = ElementTree.fromstring(data).find(f"{namespace}graph")
+        nodes = {}
+        for node in graph.iter(f"{namespace}node"):
+            values = {item.get("key"): item.text for item in node}
+            nodes[node.get("id")] = (
+                int(values["own_size"]) if "own_size" in values else None,
+                int(values["size"]) if "size" in values else None,
+            )
+        edges = {
+            (edge.get("source"), edge.get("target"), len(edge) > 0)
+            for edge in graph.iter(f"{namespace}edge")
+        }
+        return nodes, edges
+
+    def from_npz(data: bytes) -> "object":
+        arrays = numpy.load(io.BytesIO(data))
+        names = arrays["names"].tolist()
+        own_sizes = arrays["own_sizes"].tolist()
+        sizes = arrays["sizes"].tolist()
+        nodes = {
+            name: (own_sizes[i], sizes[i]) if i < len(sizes) else (None, None)
+            for i, name in enumerate(names)
+        }
+        edges = {
+            (names[source], names[target], optional)
+            for key, optional in (("edges", False), ("optional_edges", True))
+            for source, target in arrays[key].tolist()
+        }
+        return nodes, edges
+
+    readers: "List[Tuple[str, Callable[[bytes], object]]]" = [
+        ("jsonl", from_json_lines),
+        ("graphml", from_graphml),
+    ]
+    if numpy is not None:
+        readers.append(("npz", from_npz))
+
+    timed("write dot", lambda: write("dot"))
+    expected = None
+    for output_format, read in readers:
+        start = time.perf_counter()
+        result = write(output_format)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{'write ' + output_format:<40} {elapsed:10.3f} s  "
+            f"({len(result)} bytes written)",
+            file=sys.stderr,
+        )
+        contents = read(result)
+        if expected is None:
+            expected = contents
+        elif contents != expected:
+            raise AssertionError(f"{output_format} output differs from jsonl output")
+
+
+def bench_filters(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare evaluating several filters as chained per-package lambdas with evaluating
+    them into one bitset, and check that they select the same packages.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    rng = random.Random(seed)
+    for package in installed_set.packages.values():
+        package.optional_dependencies = set(
+            rng.sample(sorted(installed_set.packages), rng.randint(0, 2))
+        )
+    installed_set.finalise_dependency_sets()
+    package_sizes = installed_set.compute_all_sizes("retained")
+    sorted_sizes = sorted(package_sizes.values())
+    size_90th_percentile = sorted_sizes[int(len(sorted_sizes) * 0.9)]
+    revdep_cache = installed_set.revdep_cache
+    optional_revdep_cache = installed_set.optional_revdep_cache
+
+    lambdas: "List[Callable[[PacmanPackage], bool]]" = [
+        lambda package: not package.explicit_install,
+        lambda package: package.name in revdep_cache,
+        lambda package: package.name not in optional_revdep_cache,
+        lambda package: package_sizes[package.name] < size_90th_percentile,
+    ]
+    expression = (
+        "installed-as-dep and not no-revdeps and no-optional-revdeps "
+        "and not top-size-percentile"
+    )
+
+    def chained() -> "List[str]":
+        def filter_and(f1, f2):
+            return lambda package: f1(package) and f2(package)
+
+        overall_filter_func = lambdas[0]
+        for filter_func in lambdas[1:]:
+            overall_filter_func = filter_and(overall_filter_func, filter_func)
+        return [
+            package.name
+            for package in installed_set.packages.values()
+            if overall_filter_func(package)
+        ]
+
+    def compiled() -> "List[str]":
+        context = FilterContext(installed_set, package_sizes)
+        bits = parse_package_filter(expression).evaluate(context)
+        return [context.packages[i].name for i in bitset_ids(bits)]
+
+    installed_set.get_graph()
+    expected = timed("chained lambdas", chained)
+    if timed("compiled filter", compiled) != expected:
+        raise AssertionError("Compiled filter selects different packages")
+    print(f"  ({len(expected)} packages selected)", file=sys.stderr)
+
+    name = rng.choice(sorted(installed_set.packages))
+    for expression in (
+        f"neighbourhood:{name}:2",
+        f"reachable-from:{name} or name:'0$'",
+        "min-size:1MiB and not (installed-explicitly or top-size)",
+    ):
+        timed(
+            f"filter {expression}",
+            lambda: parse_package_filter(expression).evaluate(
+                FilterContext(installed_set, package_sizes)
+            ),
+        )
+
+
+def bench_colours(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare colouring sizes one at a time with the precomputed colour table, with and
+    without numpy, and check that the colours agree to within 1/255 per channel.
+    """
+    rng = random.Random(seed)
+    sizes = [int(rng.lognormvariate(16, 3)) for _ in range(num_packages)]
+    sizes += [0, 1, max(sizes)]
+    max_size = max(sizes)
+    palette = [(0.5, 0.5, 1.0), (1.0, 1.0, 1.0), (0.9, 0.9, 0.5), (1.0, 0.5, 0.5)]
+
+    colouring = heatmap_colouring(0, max_size, palette)
+    exact = timed("scalar", lambda: [hex_colour(colouring(size)) for size in sizes])
+    colour_table = timed(
+        "build colour table", lambda: HeatmapColourTable(0, max_size, palette)
+    )
+    table_colours = timed(
+        "colour table, per value",
+        lambda: [colour_table.hex_table[colour_table.index(size)] for size in sizes],
+    )
+    if numpy is not None:
+        vectorised = timed(
+            "colour table, numpy", lambda: colour_table.hex_colours(sizes)
+        )
+        if vectorised != table_colours:
+            raise AssertionError(
+                "numpy colour table path disagrees with per-value path"
+            )
+
+    worst = 0.0
+    for size, expected, actual in zip(sizes, exact, table_colours):
+        rgb = colour_table.rgb(size)
+        for expected_channel, actual_channel in zip(colouring(size), rgb):
+            worst = max(worst, abs(expected_channel - actual_channel))
+        if "-" not in expected and not colours_within_one(expected, actual):
+            raise AssertionError(f"Colour table is too far off for size {size}")
+    print(f"  (largest difference {worst * 255:.3f}/255)", file=sys.stderr)
+    if worst > 1 / 255:
+        raise AssertionError("Colour table is too far off")
+
+
+def bench_batch(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare analysing a fleet of hosts' `pacman -Qi` dumps one after another with the
+    parallel batch mode, and check that both give the same fleet-wide totals.
+    """
+    num_hosts = 16
+    packages_per_host = max(1, num_packages // 4)
+
+    def fleet_totals(fleet: FleetSummary) -> "object":
+        return sorted(
+            (
+                name,
+                fleet.installed_hosts[package_id],
+                fleet.retained_hosts[package_id],
+                fleet.own_sizes[package_id],
+                fleet.sizes[package_id],
+            )
+            for name, package_id in fleet.ids.items()
+        )
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dump_dir = os.path.join(temp_dir, "dumps")
+        os.mkdir(dump_dir)
+
+        def write_dumps():
+            for host in range(num_hosts):
+                installed_set = make_synthetic_installed_set(
+                    packages_per_host, seed + host
+                )
+                dump_path = os.path.join(dump_dir, f"host{host:03d}.txt")
+                with open(dump_path, "w", encoding="utf-8") as dump:
+                    dump.write(to_pacman_qi(installed_set))
+
+        timed(
+            f"generate {num_hosts} hosts of {packages_per_host} packages", write_dumps
+        )
+        dump_paths = sorted(
+            os.path.join(dump_dir, name) for name in os.listdir(dump_dir)
+        )
+
+        def sequential() -> FleetSummary:
+            fleet = FleetSummary()
+            for dump_path in dump_paths:
+                fleet.add_host(
+                    analyse_host(dump_path, os.path.join(temp_dir, "seq"), "retained")
+                )
+            return fleet
+
+        os.mkdir(os.path.join(temp_dir, "seq"))
+        expected = timed("one host at a time", sequential)
+        for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+            fleet = timed(
+                f"batch mode, {workers} workers",
+                lambda: run_batch(
+                    dump_dir,
+                    os.path.join(temp_dir, f"batch{workers}"),
+                    "retained",
+                    max_workers=workers,
+                ),
+            )
+            if fleet_totals(fleet) != fleet_totals(expected):
+                raise AssertionError("Batch mode totals differ from sequential ones")
+
+
+def bench_adjusted(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare the pure-Python adjusted size computation with the sparse matrix one, for
+    single packages and random sets of packages, and check that they agree.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    engine = timed("build SCC engine", installed_set.build_retained_set_engine)
+    graph = engine.graph
+    if graph.revdep_matrix is None:
+        print("  (SciPy not available, skipping)", file=sys.stderr)
+        return
+
+    rng = random.Random(seed)
+    names = sorted(installed_set.packages)
+    queries: "List[Iterable[str]]" = [rng.choice(names) for _ in range(500)]
+    queries.extend(rng.sample(names, rng.randint(2, 8)) for _ in range(100))
+
+    sparse = timed(
+        f"sparse: {len(queries)} queries",
+        lambda: [installed_set.compute_adjusted_size(query) for query in queries],
+    )
+    revdep_matrix = graph.revdep_matrix
+    graph.revdep_matrix = None
+    try:
+        pure_python = timed(
+            f"pure Python: {len(queries)} queries",
+            lambda: [installed_set.compute_adjusted_size(query) for query in queries],
+        )
+    finally:
+        graph.revdep_matrix = revdep_matrix
+
+    differences = sum(1 for a, b in zip(sparse, pure_python) if a != b)
+    if differences:
+        raise AssertionError(f"{differences} adjusted sizes differ")
+
+
+def bench_server(num_packages: int, seed: int, _time_limit: float):
+    """
+    Measure the latency of queries to the query server over a Unix socket, and check
+    its answers against computing them directly.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    query_server = timed("start query server", lambda: QueryServer(installed_set))
+
+    rng = random.Random(seed)
+    names = sorted(installed_set.packages)
+    queries: "List[Tuple[str, Dict[str, object], object]]" = []
+    for kind in ("retained", "adjusted", "uniquely-retained", "retained-packages"):
+        for _ in range(50):
+            packages = rng.sample(names, rng.choice((1, 1, 3)))
+            queries.append(
+                (
+                    "size",
+                    {"kind": kind, "packages": packages},
+                    installed_set.compute_size(kind, packages),
+                )
+            )
+    for _ in range(50):
+        package = rng.choice(names)
+        queries.append(
+            (
+                "dependants",
+                {"packages": [package]},
+                sorted(installed_set.compute_dependants(package)),
+            )
+        )
+        queries.append(("path", {"package": package}, None))
+    for _ in range(10):
+        queries.append(("dot", {"packages": [rng.choice(names[-100:])]}, None))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        socket_path = os.path.join(temp_dir, "query.sock")
+        server = query_server.make_unix_server(socket_path)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            latencies: "Dict[str, List[float]]" = {}
+            with QueryClient(socket_path) as client:
+                for query, params, expected in queries:
+                    start = time.perf_counter()
+                    result = client.query(query, **params)
+                    latencies.setdefault(query, []).append(time.perf_counter() - start)
+
+                    if query == "path":
+                        if result is not None and (
+                            result[-1] != params["package"]
+                            or not installed_set[result[0]].explicit_install
+                            or any(
+                                dependency not in installed_set[package].dependencies
+                                for package, dependency in zip(result, result[1:])
+                            )
+                        ):
+                            raise AssertionError(f"Bad dependency path {result}")
+                    elif query == "dot":
+                        if not result.startswith("digraph {"):
+                            raise AssertionError("Bad DOT output")
+                    elif result != expected:
+                        raise AssertionError(f"Wrong answer to {query} {params}")
+
+                try:
+                    client.query("size", packages=["no such package"])
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("Query for an unknown package did not fail")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    for query, times in latencies.items():
+        times.sort()
+        print(
+            f"{query + ' query':<40} {times[len(times) // 2] * 1000:10.3f} ms median, "
+            f"{times[-1] * 1000:.3f} ms max",
+            file=sys.stderr,
+        )
+
+
+def bench_removal(num_packages: int, seed: int, _time_limit: float):
+    """
+    Time simulating package removals and the greedy search for the removals which free
+    the most space, and check them against the dominator tree and a full rebuild.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_synthetic_installed_set(num_packages, seed),
+    )
+    timed("build dominator tree", installed_set.build_dominator_tree)
+    rng = random.Random(seed)
+    names = sorted(installed_set.packages)
+    removals = [rng.sample(names, 15) for _ in range(100)]
+
+    plans = timed(
+        f"simulate {len(removals)} removals of 15 packages",
+        lambda: [installed_set.simulate_removal(packages) for packages in removals],
+    )
+    for packages, plan in zip(removals, plans):
+        if plan.freed_bytes != installed_set.compute_uniquely_retained_size(packages):
+            raise AssertionError("Simulated removal disagrees with dominator tree")
+
+    choices = timed("greedy top 10 removals", lambda: installed_set.plan_removals(10))
+    chosen = [name for name, _ in choices]
+    for name, freed_bytes in choices:
+        print(f"  ({name} frees {format_size(freed_bytes)})", file=sys.stderr)
+    plan = installed_set.simulate_removal(chosen)
+    if plan.freed_bytes != sum(freed_bytes for _, freed_bytes in choices):
+        raise AssertionError("Greedy removals disagree with simulated removal")
+
+    timed("apply removal", lambda: installed_set.apply_removal(plan))
+    rebuilt = PacmanInstalledSet.from_pacman_qi_buffer(to_pacman_qi(installed_set))
+    for name, package in rebuilt.packages.items():
+        # Installed sizes are rounded in pacman's output
+        package.size = installed_set.packages[name].size
+    rebuilt.graph = None
+    if describe_installed_set(installed_set) != describe_installed_set(rebuilt):
+        raise AssertionError("Installed set after removal differs from rebuilt one")
+    for kind in ("retained", "uniquely-retained"):
+        if installed_set.compute_all_sizes(kind) != rebuilt.compute_all_sizes(kind):
+            raise AssertionError(f"{kind} sizes after removal differ from rebuilt")
+
+
+def bench_profile(num_packages: int, seed: int, time_limit: float):
+    """
+    Time a run from parsing to writing the graph with and without the phase profiler,
+    and check that the profile covers each phase and counts retained set cache use.
+    The recursive retained set path is only run until the time limit expires, as in
+    `bench_retained`.
+    """
+    buffer = to_pacman_qi(make_synthetic_installed_set(num_packages, seed))
+
+    def pipeline() -> PacmanInstalledSet:
+        installed_set = PacmanInstalledSet.from_pacman_qi_buffer(buffer)
+        package_sizes = installed_set.compute_all_sizes("retained")
+        make_graph(
+            installed_set,
+            package_sizes,
+            max(package_sizes.values()),
+            RetainedSizeFormatter(),
+            io.BytesIO(),
+        )
+        return installed_set
+
+    def recursive_retained_sets():
+        # Without the engine, retained sets come from the recursive, cached path
+        installed_set = pipeline()
+        installed_set.retained_set_engine = None
+
+        def compute():
+            for name in installed_set.packages:
+                installed_set.compute_retained_set(name)
+
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, num_packages * 4))
+        try:
+            run_with_time_limit(compute, time_limit)
+        finally:
+            sys.setrecursionlimit(old_limit)
+
+    def profile(trace_memory: bool, func: "Callable[[], object]") -> PhaseProfiler:
+        profiler = PhaseProfiler(trace_memory=trace_memory)
+        profiler.start()
+        try:
+            func()
+        finally:
+            profiler.stop()
+        return profiler
+
+    timed("without profiler", pipeline)
+    timed("with profiler", lambda: profile(False, pipeline))
+    timed("with profiler, tracing memory", lambda: profile(True, pipeline))
+    profiler = profile(True, recursive_retained_sets)
+    profiler.write_summary(sys.stderr)
+
+    report = json.loads(json.dumps(profiler.report()))
+    paths = [tuple(phase["path"]) for phase in report["phases"]]
+    for path in (
+        ("parse pacman -Qi", "finalise dependency sets", "build package graph"),
+        ("compute sizes", "build retained set engine"),
+        ("write graph", "write dot"),
+    ):
+        if path not in paths:
+            raise AssertionError(f"Phase {path} missing from profile")
+    counters = report["counters"]
+    if not counters.get("retained set cache misses"):
+        raise AssertionError("Retained set cache misses not counted")
+    if report["peak_memory"] is None or report["peak_memory"] <= 0:
+        raise AssertionError("Peak memory not recorded")
+
+
+def bench_retained_cache(num_packages: int, seed: int, time_limit: float):
+    """
+    Compute every retained set through the recursive, cached path with the cache
+    unbounded and then bounded by entries and by memory, and check that the bounds
+    change the hit rate and memory use but not the results. Scale-free installed sets
+    are used, as the recursive path around large dependency cycles may not finish.
+    """
+    installed_set = timed(
+        f"generate {num_packages} packages",
+        lambda: make_scale_free_installed_set(num_packages, seed),
+    )
+    names = sorted(installed_set.packages)
+    aliases = sorted(installed_set.aliases)
+    rng = random.Random(seed)
+    # Repeated lookups of popular packages, as the server or a filter would make
+    queries = names + aliases + rng.choices(names[: len(names) // 10 + 1], k=len(names))
+
+    def compute(cache: RetainedSetCache) -> "Optional[List[FrozenSet[str]]]":
+        installed_set.retained_set_engine = None
+        installed_set.retained_set_cache = cache
+        results = []
+
+        def run():
+            for name in queries:
+                results.append(frozenset(installed_set.compute_retained_set(name)))
+
+        finished = run_with_time_limit(run, time_limit)
+        stats = cache.statistics()
+        hit_rate = stats["hit_rate"] or 0.0
+        print(
+            f"  ({stats['entries']} entries, "
+            f"~{format_size(stats['estimated_bytes'])}, hit rate {hit_rate:.1%}, "
+            f"{stats['evictions']} evicted)",
+            file=sys.stderr,
+        )
+        return results if finished else None
+
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, num_packages * 4))
+    try:
+        unbounded_cache = RetainedSetCache()
+        unbounded = timed("unbounded cache", lambda: compute(unbounded_cache))
+        if unbounded is None:
+            print("  (unbounded cache did not finish in time)", file=sys.stderr)
+            return
+        limits = {
+            "cache of 10% of entries": RetainedSetCache(
+                max_entries=len(unbounded_cache) // 10 + 1
+            ),
+            "cache of 10% of memory": RetainedSetCache(
+                max_bytes=unbounded_cache.estimated_bytes // 10
+            ),
+        }
+        for label, cache in limits.items():
+            bounded = timed(label, lambda: compute(cache))
+            if bounded is None:
+                print(f"  ({label} did not finish in time)", file=sys.stderr)
+            elif bounded != unbounded:
+                raise AssertionError(f"Retained sets with {label} differ")
+            if cache.max_bytes is not None and cache.estimated_bytes > cache.max_bytes:
+                raise AssertionError(f"{label} exceeds its memory limit")
+            if cache.max_entries is not None and len(cache) > cache.max_entries:
+                raise AssertionError(f"{label} exceeds its entry limit")
+    finally:
+        sys.setrecursionlimit(old_limit)
+
+    engine = installed_set.build_retained_set_engine()
+    if any(
+        retained_set != frozenset(engine.retained_set(name))
+        for name, retained_set in zip(queries, unbounded)
+    ):
+        raise AssertionError("Cached retained sets differ from the engine's")
+
+
+def bench_top(num_packages: int, seed: int, _time_limit: float):
+    """
+    Compare finding the largest packages by computing every size and sorting them
+    with the top-K search, which only computes the retained sizes that could make the
+    cut, and check both give the same packages, ties included.
+    """
+    counts = (1, 50, num_packages // 10)
+    for label, make_installed_set in (
+        ("synthetic", make_synthetic_installed_set),
+        ("scale-free", make_scale_free_installed_set),
+    ):
+        buffer = to_pacman_qi(make_installed_set(num_packages, seed))
+        # Rounding in the dump makes for plenty of ties
+        installed_set = PacmanInstalledSet.from_pacman_qi_buffer(buffer)
+        names = list(installed_set.packages)
+
+        def sorted_top(count: int) -> "List[Tuple[str, int]]":
+            sizes = installed_set.compute_all_sizes("retained")
+            ranked = sorted(names, key=lambda name: -sizes[name])
+            return [(name, sizes[name]) for name in ranked[:count]]
+
+        for count in counts:
+            installed_set.build_retained_set_engine()
+            expected = timed(
+                f"{label}: all sizes, sorted, top {count}",
+                lambda: sorted_top(count),
+            )
+            installed_set.build_retained_set_engine()
+            engine = installed_set.retained_set_engine
+            top = timed(
+                f"{label}: top-K search, top {count}",
+                lambda: installed_set.top_packages("retained", count),
+            )
+            computed = sum(size is not None for size in engine.retained_sizes)
+            print(
+                f"  ({computed} of {len(engine.retained_sizes)} retained sizes "
+                "computed)",
+                file=sys.stderr,
+            )
+            if top != expected:
+                raise AssertionError(f"Top {count} by retained size differs")
+
+        for kind in ("own", "adjusted", "uniquely-retained", "retained-packages"):
+            sizes = installed_set.compute_all_sizes(kind)
+            ranked = sorted(names, key=lambda name: -sizes[name])
+            if installed_set.top_packages(kind, 50) != [
+                (name, sizes[name]) for name in ranked[:50]
+            ]:
+                raise AssertionError(f"Top 50 by {kind} size differs")
+
+    sizes = installed_set.compute_all_sizes("retained")
+    values = list(sizes.values())
+    for percentile in (0, 50, 90, 99, 100):
+        expected = sorted(values)[min(len(values) * percentile // 100, len(values) - 1)]
+        for index in (
+            SizeIndex(names, values),
+            SizeIndex(names, numpy.array(values) if numpy is not None else values),
+        ):
+            if index.percentile(percentile) != expected:
+                raise AssertionError(f"Percentile {percentile} differs")
+            if index.top(50) != SizeIndex.from_dict(sizes).top(50):
+                raise AssertionError("Top 50 differs between lists and arrays")
+
+    timed(
+        "sorted 90th percentile",
+        lambda: sorted(values)[len(values) * 90 // 100],
+    )
+    timed("indexed 90th percentile", lambda: SizeIndex(names, values).percentile(90))
+    context = FilterContext(installed_set, sizes)
+    selected = timed(
+        "top:50 filter",
+        lambda: set(bitset_ids(parse_package_filter("top:50").evaluate(context))),
+    )
+    if {names[package_id] for package_id in selected} != {
+        name for name, _ in SizeIndex.from_dict(sizes).top(50)
+    }:
+        raise AssertionError("top:50 filter selects the wrong packages")
+
+
+# Output of the original script for the fixture, with `pacman_qi.txt` dumped from it
+FIXTURE_DOT_OUTPUTS: "Dict[Tuple[str, ...], str]" = {
+    (): r"""digraph {
+node [shape=box];
+layout=neato
+overlap=false
+model=subset
+
+// Package node definitions
+{
+"firefox" [label="firefox\n250.00 MiB; retained 337.00 MiB" style=filled fillcolor="#bd240e"]
+"gtk3" [label="gtk3\n40.00 MiB; retained 87.00 MiB" style=filled fillcolor="#f6b580"]
+"cairo" [label="cairo\n2.00 MiB; retained 47.00 MiB" style=filled fillcolor="#e9e994"]
+"glibc" [label="glibc\n45.00 MiB; retained 45.00 MiB" style=filled fillcolor="#f7b280"]
+"ffmpeg" [label="ffmpeg\n30.00 MiB; retained 78.00 MiB" style=filled fillcolor="#f4bc80"]
+"x264" [label="x264\n3.00 MiB; retained 48.00 MiB" style=filled fillcolor="#e7e78a"]
+"python-pip" [label="python-pip\n9.00 MiB; retained 14.00 MiB" style=filled fillcolor="#ebd780"]
+"python-setuptools" [label="python-setuptools\n5.00 MiB; retained 14.00 MiB" style=filled fillcolor="#e6e27f"]
+"python" [label="python\n80.00 MiB; retained 125.00 MiB" style=filled fillcolor="#faa280"]
+"orphan" [label="orphan\n0 B; retained 0 B" style=filled fillcolor="#a808-2e"]
+"tiny" [label="tiny\n512 B; retained 512 B" style=filled fillcolor="#e3e7ff"]
+}
+
+// Unknown package nodes
+{
+node [style=filled fillcolor="#000000" fontcolor="#ffffff"]
+}
+
+// Dependency edges
+{
+"firefox" -> "gtk3"
+"gtk3" -> "cairo"
+"cairo" -> "glibc"
+"ffmpeg" -> "x264"
+"x264" -> "glibc"
+"python-pip" -> "python-setuptools"
+"python-setuptools" -> "python-pip"
+"python" -> "glibc"
+}
+}
+""",
+    ("--size-type", "adjusted", "--optional"): r"""digraph {
+node [shape=box];
+layout=neato
+overlap=false
+model=subset
+
+// Package node definitions
+{
+"firefox" [label="firefox\n250.00 MiB; adjusted 307.00 MiB" style=filled fillcolor="#bd240e"]
+"gtk3" [label="gtk3\n40.00 MiB; adjusted 57.00 MiB" style=filled fillcolor="#f7b180"]
+"cairo" [label="cairo\n2.00 MiB; adjusted 17.00 MiB" style=filled fillcolor="#efcd80"]
+"glibc" [label="glibc\n45.00 MiB; adjusted 45.00 MiB" style=filled fillcolor="#f6b780"]
+"ffmpeg" [label="ffmpeg\n30.00 MiB; adjusted 48.00 MiB" style=filled fillcolor="#f6b580"]
+"x264" [label="x264\n3.00 MiB; adjusted 18.00 MiB" style=filled fillcolor="#efcc80"]
+"python-pip" [label="python-pip\n9.00 MiB; adjusted 14.00 MiB" style=filled fillcolor="#edd280"]
+"python-setuptools" [label="python-setuptools\n5.00 MiB; adjusted 14.00 MiB" style=filled fillcolor="#edd280"]
+"python" [label="python\n80.00 MiB; adjusted 95.00 MiB" style=filled fillcolor="#faa380"]
+"orphan" [label="orphan\n0 B; adjusted 0 B" style=filled fillcolor="#a808-2e"]
+"tiny" [label="tiny\n512 B; adjusted 512 B" style=filled fillcolor="#e1e5ff"]
+}
+
+// Unknown package nodes
+{
+node [style=filled fillcolor="#000000" fontcolor="#ffffff"]
+}
+
+// Dependency edges
+{
+"firefox" -> "gtk3"
+"gtk3" -> "cairo"
+"cairo" -> "glibc"
+"ffmpeg" -> "x264"
+"x264" -> "glibc"
+"python-pip" -> "python-setuptools"
+"python-setuptools" -> "python-pip"
+"python" -> "glibc"
+}
+
+// Optional dependency edges
+{
+edge [style=dashed]
+"firefox" -> "ffmpeg"
+"python-setuptools" -> "python"
+}
+}
+""",
+}
+
+PACMAN_GRAPH_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "pacman_graph.py"
+)
+
+
+def run_pacman_graph(work_dir: str, args: "Iterable[str]", hash_seed: int = 0) -> str:
+    """
+    Run the `pacman_graph.py` script in a directory holding a `pacman_qi.txt` dump, with
+    a fixed hash seed, and return what it wrote. The cache is kept in the same directory,
+    separately for each hash seed, as cached sets iterate in the order they had when
+    they were stored.
+    """
+    env = dict(
+        os.environ,
+        PYTHONHASHSEED=str(hash_seed),
+        XDG_CACHE_HOME=os.path.join(work_dir, f"cache-{hash_seed}"),
+    )
+    return subprocess.run(
+        [sys.executable, PACMAN_GRAPH_SCRIPT, *args],
+        cwd=work_dir,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+        encoding="utf-8",
+    ).stdout
+
+
+def check_dot():
+    """
+    Check that the script draws the fixture exactly as the original script did, both
+    with and without the cache, and that a larger installed set, whose edges come out in
+    hash order, is drawn the same through the cache as without it.
+    """
+    for installed_set, expected_outputs in (
+        (make_fixture_installed_set(), FIXTURE_DOT_OUTPUTS),
+        (make_scale_free_installed_set(300, 0), dict.fromkeys(FIXTURE_DOT_OUTPUTS)),
+    ):
+        with tempfile.TemporaryDirectory() as work_dir:
+            dump_path = os.path.join(work_dir, "pacman_qi.txt")
+            with open(dump_path, "w", encoding="utf-8") as dump:
+                dump.write(to_pacman_qi(installed_set))
+
+            for hash_seed in (0, 1):
+                for args, expected in expected_outputs.items():
+                    uncached = run_pacman_graph(
+                        work_dir, ("--no-cache", *args), hash_seed
+                    )
+                    if expected is not None and uncached != expected:
+                        raise AssertionError(
+                            f"Graph with {args} differs from the original script's"
+                        )
+                    # The first run fills the cache, and the rest read from it
+                    for _ in range(2):
+                        if run_pacman_graph(work_dir, args, hash_seed) != uncached:
+                            raise AssertionError(
+                                f"Graph with {args} changes through the cache"
+                            )
+
+
+def check_local_db():
+    """
+    Check that reading a local database written out from the fixture, and from a small
+    generated installed set, gives back the installed set it was written from, and the
+    same one as parsing `pacman -Qi` output.
+    """
+    for installed_set in (
+        make_fixture_installed_set(),
+        make_scale_free_installed_set(300, 0),
+    ):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, "local")
+            write_pacman_local_db(installed_set, db_path)
+            from_db = PacmanInstalledSet.from_pacman_local_db(db_path)
+        from_qi = PacmanInstalledSet.from_pacman_qi_buffer(to_pacman_qi(installed_set))
+
+        # The database has no way to say a size is unknown
+        for package in installed_set.packages.values():
+            package.size = package.size or 0
+        if describe_installed_set(from_db) != describe_installed_set(installed_set):
+            raise AssertionError(
+                "Local database reader did not read back what was written"
+            )
+        if from_db.revdep_cache != installed_set.revdep_cache:
+            raise AssertionError("Local database reader got reverse dependencies wrong")
+
+        # pacman -Qi output only gives sizes to two decimal places
+        for package in chain(from_qi.packages.values(), from_db.packages.values()):
+            package.size = None
+        if describe_installed_set(from_qi) != describe_installed_set(from_db):
+            raise AssertionError(
+                "Local database reader disagrees with pacman -Qi parser"
+            )
+
+
+def check_incremental():
+    """
+    Check that updating the cached installed set from the pacman log after each of a
+    few small transactions gives the same installed set and sizes as rebuilding it from
+    the local database, starting from the fixture and from a small generated set.
+    """
+    kinds = ("own", "retained", "adjusted", "uniquely-retained", "retained-packages")
+    for installed_set in (
+        make_fixture_installed_set(),
+        make_scale_free_installed_set(300, 0),
+    ):
+        rng = random.Random(0)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, "local")
+            log_path = os.path.join(temp_dir, "pacman.log")
+            write_pacman_local_db(installed_set, db_path)
+            open(log_path, "w", encoding="utf-8").close()
+            cache = InstalledSetCache(temp_dir)
+            PacmanInstalledSet.retrieve_pacman_packages(cache, db_path, log_path)
+
+            virtuals: "List[str]" = []
+            for transaction in range(1, 4):
+                run_synthetic_transaction(
+                    db_path, log_path, rng, 2, str(transaction), virtuals
+                )
+
+                # Update a copy of the cached set directly, to be sure it isn't rebuilt
+                _, (log_offset, stored_time), updated = cache.load_latest()
+                changed = read_pacman_log_changes(log_path, log_offset)
+                if changed is None or not updated.update_from_pacman_local_db(
+                    changed, db_path, stored_time
+                ):
+                    raise AssertionError(
+                        f"Transaction {transaction} could not be applied to the cache"
+                    )
+                retrieved = PacmanInstalledSet.retrieve_pacman_packages(
+                    cache, db_path, log_path
+                )
+                rebuilt = PacmanInstalledSet.from_pacman_local_db(db_path)
+                virtuals = sorted(rebuilt.aliases)
+
+                expected = describe_installed_set(rebuilt)
+                for candidate in (updated, retrieved):
+                    if describe_installed_set(candidate) != expected:
+                        raise AssertionError(
+                            f"Installed set updated after transaction {transaction} "
+                            "differs from rebuilt one"
+                        )
+                    for kind in kinds:
+                        sizes = candidate.compute_all_sizes(kind)
+                        if sizes != rebuilt.compute_all_sizes(kind):
+                            raise AssertionError(
+                                f"{kind} sizes updated after transaction {transaction} "
+                                "differ from rebuilt ones"
+                            )
+
+
+# The fill colour of a package node in DOT output
+NODE_COLOUR = re.compile(r'style=filled fillcolor="([^"]*)"\]$', re.MULTILINE)
+
+
+def colours_within_one(expected: str, actual: str) -> bool:
+    """
+    Check whether two colours written as "#rrggbb" differ by at most one in each
+    channel. A colour with a negative channel, as `hex_colour` gives for sizes below
+    the bottom of the scale, must match exactly.
+    """
+    if "-" in expected or "-" in actual:
+        return expected == actual
+    return all(
+        abs(int(expected[i : i + 2], 16) - int(actual[i : i + 2], 16)) <= 1
+        for i in (1, 3, 5)
+    )
+
+
+def check_colours():
+    """
+    Check that colours from colour tables of 256 entries and more, with and without
+    numpy, are within 1/255 per channel of the exact colours, and that graphs of the
+    fixture only use the table when asked to.
+    """
+    rng = random.Random(0)
+    sizes = [int(rng.lognormvariate(16, 3)) for _ in range(2000)]
+    sizes += [0, 1, 2, max(sizes)]
+    max_size = max(sizes)
+    palette = list(GRAPH_PALETTE)
+    colouring = heatmap_colouring(0, max_size, palette)
+
+    for table_size in (256, 4096):
+        colour_table = HeatmapColourTable(0, max_size, palette, table_size)
+        table_colours = [
+            colour_table.hex_table[colour_table.index(size)] for size in sizes
+        ]
+        if numpy is not None and colour_table.hex_colours(sizes) != table_colours:
+            raise AssertionError(
+                "numpy colour table path disagrees with per-value path"
+            )
+        for size, actual in zip(sizes, table_colours):
+            expected = colouring(size)
+            if any(
+                abs(expected_channel - actual_channel) > 1 / 255
+                for expected_channel, actual_channel in zip(
+                    expected, colour_table.rgb(size)
+                )
+            ) or not colours_within_one(hex_colour(expected), actual):
+                raise AssertionError(
+                    f"Colour for size {size} from a table of {table_size} entries is "
+                    "too far off"
+                )
+
+    # Graphs drawn with and without a table differ only in colours, by at most one
+    installed_set = make_fixture_installed_set()
+    package_sizes = installed_set.compute_all_sizes("retained")
+    max_package_size = max(package_sizes.values())
+    graphs: "Dict[int, str]" = {}
+    for colour_table_size in (0, 4096):
+        output = io.BytesIO()
+        make_graph(
+            installed_set,
+            package_sizes,
+            max_package_size,
+            RetainedSizeFormatter(),
+            output,
+            colour_table_size=colour_table_size,
+        )
+        graphs[colour_table_size] = output.getvalue().decode("utf-8")
+
+    graph_colouring = heatmap_colouring(0, max_package_size, palette)
+    exact_colours = NODE_COLOUR.findall(graphs[0])
+    if exact_colours != [
+        hex_colour(graph_colouring(size)) for size in package_sizes.values()
+    ]:
+        raise AssertionError("Graphs are not drawn with exact colours by default")
+    if NODE_COLOUR.sub("", graphs[0]) != NODE_COLOUR.sub("", graphs[4096]) or not all(
+        map(colours_within_one, exact_colours, NODE_COLOUR.findall(graphs[4096]))
+    ):
+        raise AssertionError("Graph drawn with a colour table is too far off")
+
+
+def adjusted_size_by_definition(
+    installed_set: PacmanInstalledSet, packages: "Iterable[str]"
+) -> int:
+    """
+    Work out the adjusted size of a set of packages straight from its definition, with
+    exact fractions: their own sizes, plus the size of every other package they retain
+    weighted by the fraction of its reverse dependencies which they retain, rounded
+    down.
+    """
+    packages = {installed_set.resolve_alias(name) for name in packages}
+    retained_set = installed_set.compute_retained_set(packages)
+    adjusted_size = Fraction(sum(installed_set[name].size or 0 for name in packages))
+    for name in retained_set - packages:
+        revdeps = installed_set.revdep_cache[name]
+        adjusted_size += Fraction(
+            (installed_set[name].size or 0) * len(revdeps & retained_set), len(revdeps)
+        )
+    return int(adjusted_size)
+
+
+def check_adjusted():
+    """
+    Check the adjusted sizes of single packages and of sets of packages, with the
+    sparse matrix path and the pure-Python one, and of every package at once, against
+    their definition. Besides small generated sets, this uses one where a package's size
+    is split ten ways, which adds up to a little less than its size in floating point.
+    """
+    shared = PacmanInstalledSet()
+    for name in ["app", "lib"] + [f"plugin{i}" for i in range(10)]:
+        shared.add_package(name)
+        shared.packages[name].size = 0
+    shared.packages["lib"].size = 1
+    for i in range(10):
+        shared.add_dependency("app", f"plugin{i}")
+        shared.add_dependency(f"plugin{i}", "lib")
+    shared.finalise_dependency_sets()
+
+    for installed_set in (
+        shared,
+        make_fixture_installed_set(),
+        make_synthetic_installed_set(300, 0, cycle_fraction=0.05),
+        make_scale_free_installed_set(300, 0),
+    ):
+        rng = random.Random(0)
+        names = list(installed_set.packages)
+        queries: "List[List[str]]" = [[name] for name in names]
+        queries.extend(rng.sample(names, min(3, len(names))) for _ in range(50))
+        queries.extend([alias] for alias in installed_set.aliases)
+        graph = installed_set.build_retained_set_engine().graph
+        expected = [
+            adjusted_size_by_definition(installed_set, query) for query in queries
+        ]
+
+        revdep_matrix = graph.revdep_matrix
+        paths = {"pure Python": None}
+        if revdep_matrix is not None:
+            paths["sparse matrix"] = revdep_matrix
+        try:
+            for label, matrix in paths.items():
+                graph.revdep_matrix = matrix
+                for query, size in zip(queries, expected):
+                    if installed_set.compute_adjusted_size(query) != size:
+                        raise AssertionError(
+                            f"Adjusted size of {query} by {label} differs from its "
+                            "definition"
+                        )
+        finally:
+            graph.revdep_matrix = revdep_matrix
+
+        all_sizes = installed_set.compute_all_sizes("adjusted")
+        for name, size in zip(names, expected):
+            if all_sizes[name] != size:
+                raise AssertionError(
+                    f"Adjusted size of {name} computed in bulk differs from its "
+                    "definition"
+                )
+
+
+def check_server():
+    """
+    Check a round trip to the query server over a Unix socket, with the fixture: queries
+    are answered as computing them directly would, bad requests get an error without
+    stopping the server, and the socket path is only taken over from a server which has
+    gone away.
+    """
+    installed_set = make_fixture_installed_set()
+    query_server = QueryServer(installed_set)
+    queries: "List[Tuple[str, Dict[str, object], object]]" = [
+        (
+            "size",
+            {"kind": kind, "packages": packages},
+            installed_set.compute_size(kind, packages),
+        )
+        for kind in ("retained", "adjusted", "uniquely-retained", "retained-packages")
+        for packages in (["firefox"], ["libcairo"], ["python-pip", "ffmpeg"])
+    ]
+    queries += [
+        (
+            "retained",
+            {"packages": ["python-pip"]},
+            sorted(installed_set.compute_retained_set(["python-pip"])),
+        ),
+        (
+            "dependants",
+            {"packages": ["glibc"]},
+            sorted(installed_set.compute_dependants(["glibc"])),
+        ),
+        (
+            "top",
+            {"kind": "retained", "count": 3},
+            [list(entry) for entry in installed_set.top_packages("retained", 3)],
+        ),
+        ("path", {"package": "glibc"}, installed_set.find_dependency_path("glibc")),
+    ]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        socket_path = os.path.join(temp_dir, "query.sock")
+        server = query_server.make_unix_server(socket_path)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with QueryClient(socket_path) as client:
+                for query, params, expected in queries:
+                    if client.query(query, **params) != expected:
+                        raise AssertionError(f"Wrong answer to {query} {params}")
+                if not client.query("dot", packages=["gtk3"]).startswith("digraph {"):
+                    raise AssertionError("Bad DOT output")
+                try:
+                    client.query("size", packages=["no such package"])
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("Query for an unknown package did not fail")
+
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(socket_path)
+                reader = connection.makefile("rb")
+                for line, request_id in (
+                    (b'"idea"', None),
+                    (b"[1]", None),
+                    (b"null", None),
+                    (b"{", None),
+                    (b'{"id": 1}', 1),
+                    (
+                        b'{"id": 2, "query": "dot", "packages": ["gtk3"], '
+                        b'"filter": "name:["}',
+                        2,
+                    ),
+                ):
+                    connection.sendall(line + b"\n")
+                    response = json.loads(reader.readline())
+                    if "error" not in response:
+                        raise AssertionError(f"Bad request {line!r} did not fail")
+                    if response.get("id") != request_id:
+                        raise AssertionError(f"Wrong id echoed for {line!r}")
+
+            with QueryClient(socket_path) as client:
+                if client.query("size", packages=["tiny"]) != 512:
+                    raise AssertionError("Server stopped answering after bad requests")
+
+            try:
+                query_server.make_unix_server(socket_path)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("Socket of a running server was taken over")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # The socket is left behind, but nothing answers on it any more
+        query_server.make_unix_server(socket_path).server_close()
+
+        not_a_socket = os.path.join(temp_dir, "not-a-socket")
+        open(not_a_socket, "w", encoding="utf-8").close()
+        try:
+            query_server.make_unix_server(not_a_socket)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("A file which is not a socket was replaced")
+        if not os.path.isfile(not_a_socket):
+            raise AssertionError("A file which is not a socket was removed")
+
+
+BENCHMARKS: "Dict[str, Callable[[int, int, float], None]]" = {
+    "retained": bench_retained,
+    "sizes": bench_sizes,
+    "adjusted": bench_adjusted,
+    "parse": bench_parse,
+    "cache": bench_cache,
+    "local-db": bench_local_db,
+    "incremental": bench_incremental,
+    "dot": bench_dot,
+    "formats": bench_formats,
+    "filters": bench_filters,
+    "colours": bench_colours,
+    "batch": bench_batch,
+    "server": bench_server,
+    "removal": bench_removal,
+    "profile": bench_profile,
+    "retained-cache": bench_retained_cache,
+    "top": bench_top,
+}
+
+
+# Quick checks on small installed sets, for `--check`
+CHECKS: "Dict[str, Callable[[], None]]" = {
+    "dot": check_dot,
+    "local-db": check_local_db,
+    "incremental": check_incremental,
+    "colours": check_colours,
+    "adjusted": check_adjusted,
+    "server": check_server,
+}
+
+
+SUITE_SIZE_KINDS = (
+    "own",
+    "retained",
+    "adjusted",
+    "uniquely-retained",
+    "retained-packages",
+)
+SUITE_FILTERS = (
+    "installed-as-dep and not no-revdeps",
+    "top-size-percentile or name:'0$'",
+    "neighbourhood:pkg000000:2",
+)
+
+
+def run_suite_pipeline(dump_path: str):
+    """
+    Run every stage of the suite once on a `pacman -Qi` dump, each stage in its own
+    profiler phase: parsing (including finalising dependency sets), every size type
+    from scratch, a few filters, and writing the graph in DOT format.
+    """
+    # As in a real run, the colour table is built from scratch
+    graph_colour_table.cache_clear()
+    installed_set = PacmanInstalledSet.from_pacman_qi_file(dump_path)
+
+    package_sizes: "Dict[str, int]" = {}
+    for kind in SUITE_SIZE_KINDS:
+        installed_set.retained_set_engine = None
+        installed_set.dominator_tree = None
+        with profile_phase(f"sizes: {kind}"):
+            sizes = installed_set.compute_all_sizes(kind)
+        if kind == "retained":
+            package_sizes = sizes
+
+    for expression in SUITE_FILTERS:
+        package_filter = parse_package_filter(expression)
+        with profile_phase(f"filter: {expression}"):
+            package_filter.evaluate(FilterContext(installed_set, package_sizes))
+
+    with open(os.devnull, "wb") as output_file:
+        make_graph(
+            installed_set,
+            package_sizes,
+            max(package_sizes.values()),
+            RetainedSizeFormatter(),
+            output_file,
+            include_optional=True,
+        )
+
+
+def run_suite(
+    sizes: "Iterable[int]", seed: int, repeats: int = 3, trace_memory: bool = True
+) -> "Dict[str, Any]":
+    """
+    Time every stage of `run_suite_pipeline` on scale-free installed sets of each size,
+    taking the best of a number of runs, then measure each stage's peak memory in one
+    more run with memory tracing on. Returns a JSON-serialisable report, which can be
+    saved as a baseline for `compare_suite_results`.
+    """
+    results: "Dict[str, Dict[str, Dict[str, Any]]]" = {}
+    for num_packages in sizes:
+        installed_set = timed(
+            f"generate {num_packages} packages",
+            lambda: make_scale_free_installed_set(num_packages, seed, finalise=False),
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            dump_path = os.path.join(directory, "pacman_qi.txt")
+            with open(dump_path, "w", encoding="utf-8") as dump:
+                dump.write(to_pacman_qi(installed_set))
+            del installed_set
+
+            best_times: "Dict[str, float]" = {}
+            peaks: "Dict[str, int]" = {}
+            for run in range(repeats + trace_memory):
+                profiler = PhaseProfiler(trace_memory=run == repeats)
+                profiler.start()
+                try:
+                    run_suite_pipeline(dump_path)
+                finally:
+                    profiler.stop()
+                for path, stats in profiler.phases.items():
+                    stage = "/".join(path)
+                    if profiler.trace_memory:
+                        peaks[stage] = stats.peak_memory
+                    else:
+                        best_times[stage] = min(
+                            best_times.get(stage, stats.wall_time), stats.wall_time
+                        )
+
+        results[str(num_packages)] = stages = {}
+        for stage, seconds in best_times.items():
+            stages[stage] = {
+                "seconds": seconds,
+                "packages_per_second": num_packages / seconds if seconds else None,
+                "peak_memory": peaks.get(stage),
+            }
+            peak = f"  peak {format_size(peaks[stage])}" if stage in peaks else ""
+            print(
+                f"  {stage:<66} {seconds:10.4f} s "
+                f"{num_packages / max(seconds, 1e-9):12.0f} packages/s{peak}",
+                file=sys.stderr,
+            )
+
+    return {
+        "meta": {
+            "seed": seed,
+            "repeats": repeats,
+            "python": platform.python_version(),
+            "numpy": numpy is not None,
+            "scipy": scipy_sparse is not None,
+        },
+        "results": results,
+    }
+
+
+def compare_suite_results(
+    results: "Dict[str, Any]",
+    baseline: "Dict[str, Any]",
+    threshold: float,
+    min_seconds: float = 0.005,
+) -> "List[str]":
+    """
+    Compare suite results with a baseline, printing the change in time of every stage
+    found in both. Returns a description of each stage which got slower by more than
+    `threshold` (a fraction of the baseline time) and by more than `min_seconds`, so
+    that tiny stages don't trip on timer noise.
+    """
+    for key in ("seed", "numpy", "scipy"):
+        if results["meta"].get(key) != baseline["meta"].get(key):
+            print(
+                f"Warning: {key} differs from the baseline "
+                f"({baseline['meta'].get(key)} vs {results['meta'].get(key)})",
+                file=sys.stderr,
+            )
+
+    regressions = []
+    for size, stages in results["results"].items():
+        baseline_stages = baseline["results"].get(size, {})
+        for stage, result in stages.items():
+            if stage not in baseline_stages:
+                continue
+            old = baseline_stages[stage]["seconds"]
+            new = result["seconds"]
+            change = (new - old) / old if old else float("inf")
+            regressed = new - old > min_seconds and change > threshold
+            label = f"{size} packages: {stage}"
+            print(
+                f"{label:<72} {old:9.4f} s -> {new:9.4f} s {change:+8.1%}"
+                + ("  REGRESSION" if regressed else ""),
+                file=sys.stderr,
+            )
+            if regressed:
+                regressions.append(f"{label} ({old:.4f} s -> {new:.4f} s)")
+    return regressions
+
+
+def main():
+    """Main entry point; runs the requested benchmarks."""
+    parser = argparse.ArgumentParser(description="Benchmark pacman_graph.py.")
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)}), or with "
+        f"--check, checks to run (default: all of {', '.join(CHECKS)})",
+    )
+    parser.add_argument(
+        "--packages",
+        type=int,
+        default=20000,
+        help="Number of packages in the synthetic installed set",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--time-limit",
+        type=float,
+        default=10.0,
+        help="Time limit in seconds for reference implementations that may not finish",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Run quick checks on small installed sets instead of the benchmarks, "
+        "exiting with an error if any fails",
+    )
+    parser.add_argument(
+        "--suite",
+        action="store_true",
+        help="Run the stage-by-stage benchmark suite on scale-free installed sets, "
+        "instead of the benchmarks",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="100,1000,10000",
+        help="Comma-separated numbers of packages for --suite (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of runs per size for --suite, of which the best is kept "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip the memory-tracing run of --suite",
+    )
+    parser.add_argument(
+        "--save",
+        metavar="PATH",
+        help="Save the --suite results as JSON, e.g. as a baseline for later runs",
+    )
+    parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="Compare the --suite results with a baseline saved by --save, exiting "
+        "with an error if any stage got slower than the threshold allows",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Slowdown relative to the baseline at which a stage counts as a "
+        "regression (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        checks: "List[str]" = args.benchmarks or list(CHECKS)
+        for name in checks:
+            if name not in CHECKS:
+                parser.error(f"Unknown check {name}")
+        failures = 0
+        for name in checks:
+            try:
+                CHECKS[name]()
+            except AssertionError as error:
+                failures += 1
+                print(f"{name:<40} FAILED: {error}", file=sys.stderr)
+            except Exception as error:  # pylint: disable=broad-except
+                failures += 1
+                print(f"{name:<40} FAILED: {error!r}", file=sys.stderr)
+            else:
+                print(f"{name:<40} ok", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+        return
+
+    if args.suite:
+        if args.benchmarks:
+            parser.error("Benchmarks cannot be named with --suite")
+        try:
+            sizes = [int(size) for size in args.sizes.split(",")]
+        except ValueError:
+            parser.error(f"Invalid sizes {args.sizes}")
+        results = run_suite(
+            sizes, args.seed, repeats=args.repeat, trace_memory=not args.no_memory
+        )
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as file:
+                json.dump(results, file, indent=2)
+                file.write("\n")
+        if args.baseline:
+            with open(args.baseline, "r", encoding="utf-8") as file:
+                baseline = json.load(file)
+            regressions = compare_suite_results(results, baseline, args.threshold)
+            if regressions:
+                print(f"{len(regressions)} stages regressed:", file=sys.stderr)
+                for regression in regressions:
+                    print(f"  {regression}", file=sys.stderr)
+                sys.exit(1)
+        return
+
+    benchmarks: "List[str]" = args.benchmarks or list(BENCHMARKS)
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name}")
+
+    for name in benchmarks:
+        print(f"== {name} ==", file=sys.stderr)
+        BENCHMARKS[name](args.packages, args.seed, args.time_limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,567 @@
-def fib():
+import asyncio
+import threading
+from itertools import islice
+import time
+import weakref
+
+
+def fib(n=None):
+    """
+    Get the nth Fibonacci number, or without an index, a generator of all of them.
+    """
+    if n is None:
+        return _fib_sequence()
+    return fib_pair(n)[0]
+
+
+def _fib_sequence():
     n, m = 1, 0
     while True:
         yield m
         n, m = n + m, n
 
+
+def fib_pair(n):
+    """
+    Get the nth and n+1th Fibonacci numbers by fast doubling, taking O(log n)
+    multiplications.
+    """
+    if n < 0:
+        raise IndexError("Index out of bounds")
+    # F(2k) = F(k) * (2 * F(k + 1) - F(k)), F(2k + 1) = F(k)^2 + F(k + 1)^2
+    a, b = 0, 1
+    for bit in bin(n)[2:]:
+        a, b = a * (2 * b - a), a * a + b * b
+        if bit == "1":
+            a, b = b, a + b
+    return a, b
+
+
+def _mat_mul(a, b):
+    return [
+        [sum(x * y for x, y in zip(row, column)) for column in zip(*b)] for row in a
+    ]
+
+
+class LinearRecurrence(object):
+    """
+    Sequence where each item is a sum of multiples of the previous `k`, such as
+    LinearRecurrence([1, 1], [0, 1]) for the Fibonacci numbers:
+    a(n) = coefficients[0] * a(n - 1) + ... + coefficients[k - 1] * a(n - k),
+    starting from the `k` items in `initial`.
+
+    Iterating over it gives every item in turn, and `nth` gets any item by raising
+    the companion matrix to a power, in O(k^3 log n) multiplications.
+    Pass both to an IteratorCache to have it jump ahead rather than iterate:
+    IteratorCache(iter(sequence), nth=sequence.nth)
+    """
+    __slots__ = 'coefficients', 'initial'
+
+    def __init__(self, coefficients, initial):
+        if not coefficients or len(coefficients) != len(initial):
+            raise ValueError("Need as many initial items as coefficients")
+        self.coefficients = tuple(coefficients)
+        self.initial = tuple(initial)
+
+    def __iter__(self):
+        coefficients = self.coefficients
+        window = list(self.initial)
+        for item in window:
+            yield item
+        while True:
+            item = sum(c * x for c, x in zip(coefficients, reversed(window)))
+            yield item
+            window.pop(0)
+            window.append(item)
+
+    def nth(self, n):
+        if n < 0:
+            raise IndexError("Index out of bounds")
+        k = len(self.coefficients)
+        if n < k:
+            return self.initial[n]
+
+        # The companion matrix takes (a(i + k - 1), ..., a(i)) to
+        # (a(i + k), ..., a(i + 1)); raise it to the power n - k + 1, squaring
+        # it and applying it to the state for each set bit
+        matrix = [list(self.coefficients)]
+        matrix.extend([int(i == j) for j in range(k)] for i in range(k - 1))
+        state = [[x] for x in reversed(self.initial)]
+        power = n - k + 1
+        while True:
+            if power & 1:
+                state = _mat_mul(matrix, state)
+            power >>= 1
+            if not power:
+                break
+            matrix = _mat_mul(matrix, matrix)
+        return state[0][0]
+
+
 class IteratorCache(object):
-    def __init__(self, iterator):
+    """
+    Indexable view of an iterator, fetching items from it as they are first needed.
+    Indexing from the end, and slicing from the end or up to it, fetch every item.
+
+    With a `window`, items more than `window` before the furthest fetched may be
+    dropped, keeping memory bounded when following an infinite iterator; indexing a
+    dropped item raises IndexError.
+
+    Given an `nth` function to get the item at any index, such as fib, indexing
+    far beyond the items fetched calls it instead of iterating up to the index.
+    The items it gets aren't cached.
+    """
+    __slots__ = '_iter', '_cache', '_offset', '_exhausted', '_window', '_nth'
+
+    # Most items to fetch or copy out at once when fetching the whole iterator, or
+    # when iterating over the cache
+    batch_size = 64
+
+    def __init__(self, iterator, window=None, nth=None):
+        if window is not None and window < 1:
+            raise ValueError("Window must hold at least one item")
         self._iter = iterator
         self._cache = []
+        self._offset = 0  # Number of items dropped from the start of the cache
+        self._exhausted = False
+        self._window = window
+        self._nth = nth
 
     def __getitem__(self, index):
-        if index < 0:
-            raise IndexError("Index out of bounds")
+        if self._jumps_to(index):
+            return self._nth(index)
+        stop, keep = self._needed(index)
+        self._ensure_cache(stop, keep)
+        return self._lookup(index)
+
+    def __len__(self):
+        """Number of items fetched so far, which is the length once exhausted."""
+        return self._offset + len(self._cache)
+
+    def __iter__(self):
+        index = 0
+        while True:
+            items = self._items_from(index)
+            if not items:
+                return
+            for item in items:
+                yield item
+            index += len(items)
+
+    def _needed(self, index):
+        # Get the (stop, keep) arguments for _ensure_cache to look up the index
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if (
+                (step is not None and step < 0)
+                or stop is None
+                or stop < 0
+                or (start is not None and start < 0)
+            ):
+                return None, None
+            return stop, start or 0
         if not isinstance(index, int):
             raise IndexError("Non-integral index")
-        self._ensure_cache(index)
-        return self._cache[index]
+        if index < 0:
+            return None, None
+        return index + 1, index
+
+    def _jumps_to(self, index):
+        # Whether to get the index from nth rather than by iterating up to it
+        return (
+            self._nth is not None
+            and isinstance(index, int)
+            and index >= self._offset + len(self._cache) + self.batch_size
+            and not self._exhausted
+        )
+
+    def _position(self, index):
+        position = index - self._offset
+        if position < 0:
+            raise IndexError("Index %d was dropped from the cache window" % index)
+        return position
+
+    def _lookup(self, index):
+        # Look up an index or slice, once the items for it have been fetched
+        length = self._offset + len(self._cache)
+        if isinstance(index, slice):
+            indices = range(*index.indices(length))
+            if not indices:
+                return []
+            self._position(min(indices[0], indices[-1]))
+            first = indices[0] - self._offset
+            last = indices[-1] - self._offset
+            if indices.step > 0:
+                return self._cache[first:last + 1:indices.step]
+            return self._cache[first:last - 1 if last else None:indices.step]
+
+        if index < 0:
+            index += length
+            if index < 0:
+                raise IndexError("Index out of bounds")
+        position = self._position(index)
+        if position >= len(self._cache):
+            raise IndexError("Index out of bounds")
+        return self._cache[position]
+
+    def _items_from(self, index):
+        # Copy out some cached items from the index on, fetching one if none are cached
+        self._ensure_cache(index + 1, index)
+        position = self._position(index)
+        return self._cache[position:position + self.batch_size]
+
+    def _wanted(self, stop):
+        # Number of items to fetch next towards the index `stop`, None for all
+        window = self._window
+        if stop is None:
+            return None if window is None else max(window, self.batch_size)
+        wanted = stop - self._offset - len(self._cache)
+        if window is not None:
+            wanted = min(wanted, window)
+        return wanted
+
+    def _trim(self, keep):
+        # Drop items outside the window, except those from the index `keep` on
+        cache = self._cache
+        window = self._window
+        if window is not None and len(cache) >= 2 * window:
+            drop = len(cache) - window
+            if keep is not None:
+                drop = min(drop, keep - self._offset)
+            if drop > 0:
+                del cache[:drop]
+                self._offset += drop
+
+    def _ensure_cache(self, stop, keep=None):
+        # Fetch items up to the index `stop`, or all of them if it is None, keeping
+        # those from the index `keep` on even if they fall outside the window
+        cache = self._cache
+        while not self._exhausted:
+            wanted = self._wanted(stop)
+            if wanted is not None and wanted <= 0:
+                break
+            fetched = len(cache)
+            cache.extend(islice(self._iter, wanted))
+            if wanted is None or len(cache) - fetched < wanted:
+                self._exhausted = True
+            self._trim(keep)
+
+
+class ThreadSafeIteratorCache(IteratorCache):
+    """
+    IteratorCache which can be shared between threads, only one of which fetches
+    from the iterator at a time.
+    """
+    __slots__ = '_lock',
+
+    def __init__(self, iterator, window=None, nth=None):
+        IteratorCache.__init__(self, iterator, window, nth)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, index):
+        with self._lock:
+            return IteratorCache.__getitem__(self, index)
+
+    def __len__(self):
+        with self._lock:
+            return IteratorCache.__len__(self)
+
+    def _items_from(self, index):
+        with self._lock:
+            return IteratorCache._items_from(self, index)
+
+
+def _prefetch(cache_ref, condition, iterator):
+    # Runs a PrefetchingIteratorCache's iterator, only holding a weak reference to the
+    # cache between items so that it can be collected without being closed
+    while True:
+        with condition:
+            while True:
+                cache = cache_ref()
+                if cache is None or cache._closed:
+                    return
+                wanted = (
+                    cache._demand is None
+                    or cache._offset + len(cache._cache) < cache._demand
+                )
+                del cache
+                if wanted:
+                    break
+                # The cache may have been collected on dropping the reference above
+                if cache_ref() is None:
+                    return
+                condition.wait()
 
-    def _ensure_cache(self, index):
         try:
-            while len(self._cache) <= index:
-                self._cache.append(next(self._iter))
-        except StopIteration:
-            pass
+            item = next(iterator)
+        except BaseException as e:
+            with condition:
+                cache = cache_ref()
+                if cache is not None:
+                    if not isinstance(e, StopIteration):
+                        cache._error = e
+                    cache._exhausted = True
+                    condition.notify_all()
+                del cache
+            return
+
+        with condition:
+            cache = cache_ref()
+            if cache is None:
+                return
+            cache._cache.append(item)
+            condition.notify_all()
+            del cache
+
+
+class PrefetchingIteratorCache(ThreadSafeIteratorCache):
+    """
+    ThreadSafeIteratorCache whose iterator runs in a background thread, staying
+    `prefetch` items ahead of the furthest index asked for, so that a slow iterator
+    has its items ready before they are needed.
+
+    An exception from the iterator is raised again on asking for items past it.
+    The thread stops once the iterator is exhausted, on `close()`, or once the cache
+    is garbage collected.
+    """
+    __slots__ = '_prefetch', '_demand', '_error', '_closed', '__weakref__'
+
+    def __init__(self, iterator, prefetch=16, window=None, nth=None):
+        if prefetch < 0:
+            raise ValueError("Can't prefetch a negative number of items")
+        ThreadSafeIteratorCache.__init__(self, iterator, window, nth)
+        self._lock = threading.Condition()
+        self._prefetch = prefetch
+        self._demand = prefetch  # Index to fetch up to, or None for all
+        self._error = None
+        self._closed = False
+
+        condition = self._lock
+
+        def wake(_):
+            with condition:
+                condition.notify_all()
+
+        threading.Thread(
+            target=_prefetch,
+            args=(weakref.ref(self, wake), condition, iterator),
+            name="Iterator prefetch",
+            daemon=True,
+        ).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def _ensure_cache(self, stop, keep=None):
+        # Called with the lock held, which waiting on it releases
+        condition = self._lock
+        if stop is None:
+            self._demand = None
+            condition.notify_all()
+        elif self._demand is not None and stop + self._prefetch > self._demand:
+            self._demand = stop + self._prefetch
+            condition.notify_all()
+
+        while not self._exhausted and (
+            stop is None or self._offset + len(self._cache) < stop
+        ):
+            if self._closed:
+                raise ValueError("Iterator cache is closed")
+            condition.wait()
+            self._trim(keep)
+
+        if self._error is not None and (
+            stop is None or self._offset + len(self._cache) < stop
+        ):
+            raise self._error
+        self._trim(keep)
+
+
+class AsyncIteratorCache(IteratorCache):
+    """
+    IteratorCache of an async iterator, indexed with `await cache[index]` and iterated
+    over with `async for`.
+
+    Coroutines waiting for items share a single task fetching them, which carries on
+    if they are cancelled, and which runs `prefetch` items ahead of the furthest
+    index asked for. An exception from the iterator is raised again on asking for
+    items past it.
+    """
+    __slots__ = '_prefetch', '_demand', '_error', '_task'
+
+    __iter__ = None
+
+    def __init__(self, iterator, prefetch=0, window=None, nth=None):
+        if prefetch < 0:
+            raise ValueError("Can't prefetch a negative number of items")
+        IteratorCache.__init__(self, iterator, window, nth)
+        self._prefetch = prefetch
+        self._demand = 0  # Index to fetch up to, or None for all
+        self._error = None
+        self._task = None
+
+    def __getitem__(self, index):
+        return self._get(index)
+
+    async def __aiter__(self):
+        index = 0
+        while True:
+            await self._fetch(index + 1, index)
+            position = self._position(index)
+            items = self._cache[position:position + self.batch_size]
+            if not items:
+                return
+            for item in items:
+                yield item
+            index += len(items)
+
+    async def _get(self, index):
+        if self._jumps_to(index):
+            return self._nth(index)
+        stop, keep = self._needed(index)
+        await self._fetch(stop, keep)
+        return self._lookup(index)
+
+    async def _produce(self):
+        try:
+            while (
+                self._demand is None or self._offset + len(self._cache) < self._demand
+            ):
+                try:
+                    item = await self._iter.__anext__()
+                except StopAsyncIteration:
+                    self._exhausted = True
+                    return
+                self._cache.append(item)
+                if self._demand is None:
+                    self._trim(None)
+        except Exception as e:
+            self._error = e
+            self._exhausted = True
+        finally:
+            self._task = None
+
+    async def _fetch(self, stop, keep=None):
+        if stop is None:
+            self._demand = None
+        elif self._demand is not None:
+            self._demand = max(self._demand, stop + self._prefetch)
+
+        # Even when the items are cached, the next ones may need prefetching
+        self._start_producing()
+        while not self._exhausted and (
+            stop is None or self._offset + len(self._cache) < stop
+        ):
+            # Shielded so that one waiter being cancelled doesn't cancel the fetch
+            await asyncio.shield(self._start_producing())
+
+        if self._error is not None and (
+            stop is None or self._offset + len(self._cache) < stop
+        ):
+            raise self._error
+        self._trim(keep)
+
+    def _start_producing(self):
+        if self._task is None and not self._exhausted and (
+            self._demand is None or self._offset + len(self._cache) < self._demand
+        ):
+            self._task = asyncio.ensure_future(self._produce())
+        return self._task
+
+
+def _slow_numbers(delay, produced):
+    n = 0
+    while True:
+        time.sleep(delay)
+        produced[0] += 1
+        yield n
+        n += 1
+
+
+async def _slow_async_numbers(delay, produced):
+    n = 0
+    while True:
+        await asyncio.sleep(delay)
+        produced[0] += 1
+        yield n
+        n += 1
+
+
+def _bench_sync(cache, count, work):
+    # Mean wait per item for a consumer spending `work` seconds on each
+    waited = 0
+    for i in range(count):
+        start = time.perf_counter()
+        cache[i]
+        waited += time.perf_counter() - start
+        time.sleep(work)
+    return waited / count
+
+
+async def _bench_async(cache, consumers, count, work):
+    async def consume():
+        waited = 0
+        for i in range(count):
+            start = time.perf_counter()
+            await cache[i]
+            waited += time.perf_counter() - start
+            await asyncio.sleep(work)
+        return waited / count
+
+    waits = await asyncio.gather(*[consume() for _ in range(consumers)])
+    return sum(waits) / consumers
+
+
+if __name__ == "__main__":
+    delay = work = 0.002
+    count = 200
+    print("Producer takes %.1f ms per item, consumer works %.1f ms per item" % (
+        delay * 1e3, work * 1e3))
+
+    produced = [0]
+    cache = IteratorCache(_slow_numbers(delay, produced))
+    print("IteratorCache: %.3f ms wait per item" % (
+        _bench_sync(cache, count, work) * 1e3))
+
+    for prefetch in (1, 16):
+        produced = [0]
+        with PrefetchingIteratorCache(_slow_numbers(delay, produced), prefetch) as cache:
+            print("PrefetchingIteratorCache, %d ahead: %.3f ms wait per item" % (
+                prefetch, _bench_sync(cache, count, work) * 1e3))
+
+    consumers = 10
+    for prefetch in (0, 16):
+        produced = [0]
+        cache = AsyncIteratorCache(_slow_async_numbers(delay, produced), prefetch)
+        wait = asyncio.run(_bench_async(cache, consumers, count, work))
+        print(
+            "AsyncIteratorCache, %d ahead: %.3f ms wait per item, "
+            "%d items produced for %d consumers of %d"
+            % (prefetch, wait * 1e3, produced[0], consumers, count)
+        )
+
+    print("\nnth Fibonacci number:")
+    fib_recurrence = LinearRecurrence([1, 1], [0, 1])
+    for n in (1000, 10000, 100000, 1000000):
+        timings = []
+        if n <= 100000:
+            start = time.perf_counter()
+            IteratorCache(fib())[n]
+            timings.append("generator %.3f ms" % ((time.perf_counter() - start) * 1e3))
+        for label, nth in (("fast doubling", fib), ("matrix", fib_recurrence.nth)):
+            start = time.perf_counter()
+            nth(n)
+            timings.append("%s %.3f ms" % (label, (time.perf_counter() - start) * 1e3))
+        start = time.perf_counter()
+        IteratorCache(fib(), nth=fib)[n]
+        timings.append("cache jumping %.3f ms" % ((time.perf_counter() - start) * 1e3))
+        print("  %d: %s" % (n, ", ".join(timings)))
@@ -1,33 +1,521 @@
-from time import time
+"""
+Hierarchical wall-clock profiler.
 
-class Timer(object):
-    __slots__ = 'path', 'path_starts', 'times'
+    t = Timer()
+    with t("load"):
+        with t("parse"):
+            ...
+
+    @t.timed()
+    def work():
+        ...
+
+    print(timer_to_tree(t))
+
+Spans are identified by their path of enclosing span names. Each thread keeps its own
+stack of open spans, and the threads' timings are merged when reported.
+
+For spans too hot to time every time, `Timer(sample_every=N)` times one span in N of
+each path, and `Timer(sample_interval=seconds)` times the first span of each path after
+every tick of a background thread. Every span is still counted, and totals are scaled
+up from the spans which were timed.
+
+Timings from other processes are added with `Timer.merge(snapshot)`, or collected
+automatically from the workers of a `TimerProcessPoolExecutor`.
+"""
 
-    def __init__(self):
-        self.path = ()
-        self.path_starts = ()
-        self.times = {}
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import wraps
+from itertools import count as count_from
+import json
+import os
+import threading
+from time import perf_counter_ns
+import weakref
 
-    def __call__(self, path):
-        self.path += path,
-        self.path_starts += time(),
-        return self
+
+class _Skip(object):
+    # Context manager for a span which is counted but not timed
+    __slots__ = 'stack',
+
+    def __init__(self, stack):
+        self.stack = stack
 
     def __enter__(self):
         pass
 
-    def __exit__(self, *exc):
-        end_time = time()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stack.pop()
+        return False
+
 
-        my_time = self.times.get(self.path, 0)
-        my_time += end_time - self.path_starts[-1]
-        self.times[self.path] = my_time
+class _Node(object):
+    # A path's timings in one thread, also used as the context manager for its spans.
+    # `calls` counts every span, `count` and `total` only those which were timed.
+    # Nodes made by merging have an `estimate` of the total over every call.
+    __slots__ = (
+        'name', 'stack', 'skip', 'children', 'calls', 'count', 'total', 'min', 'max',
+        'start', 'countdown', 'tick', 'estimate',
+    )
 
-        self.path = self.path[:-1]
-        self.path_starts = self.path_starts[:-1]
+    def __init__(self, name, stack=None):
+        self.name = name
+        self.stack = stack
+        self.skip = None
+        self.children = {}
+        self.calls = 0
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+        self.start = 0
+        self.countdown = 1
+        self.tick = -1
+        self.estimate = None
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_time = perf_counter_ns()
+        self.stack.pop()
+        elapsed = end_time - self.start
+
+        count = self.count = self.count + 1
+        self.total += elapsed
+        if count == 1:
+            self.min = self.max = elapsed
+        elif elapsed < self.min:
+            self.min = elapsed
+        elif elapsed > self.max:
+            self.max = elapsed
 
         return False
 
+    @property
+    def total_calls(self):
+        # Without sampling, calls aren't counted separately
+        return self.calls or self.count
+
+    @property
+    def estimated_total(self):
+        if self.estimate is not None:
+            return self.estimate
+        if not self.count:
+            return 0
+        return self.total * self.total_calls / self.count
+
+    @property
+    def self_time(self):
+        self_time = self.estimated_total - sum(
+            child.estimated_total for child in self.children.values()
+        )
+        # Sampling can make children's estimates add up to more than their parent's
+        return max(0, self_time)
+
+    def merge(self, other):
+        if other.count:
+            if not self.count or other.min < self.min:
+                self.min = other.min
+            if other.max > self.max:
+                self.max = other.max
+        self.estimate = (self.estimate or 0) + other.estimated_total
+        self.calls += other.total_calls
+        self.count += other.count
+        self.total += other.total
+        for name, other_child in other.children.items():
+            child = self.children.get(name)
+            if child is None:
+                child = self.children[name] = _Node(name)
+            child.merge(other_child)
+
+    def walk(self, path=()):
+        # Yields (path, node) for every node under this one, parents first
+        for name, child in self.children.items():
+            child_path = path + (name,)
+            yield child_path, child
+            for item in child.walk(child_path):
+                yield item
+
+    def to_snapshot(self):
+        return (
+            self.name, self.total_calls, self.count, self.total, self.estimated_total,
+            self.min, self.max,
+            [child.to_snapshot() for child in self.children.values()],
+        )
+
+    @staticmethod
+    def from_snapshot(snapshot):
+        name, calls, count, total, estimate, min_time, max_time, children = snapshot
+        node = _Node(name)
+        node.calls = calls
+        node.count = count
+        node.total = total
+        node.estimate = estimate
+        node.min = min_time
+        node.max = max_time
+        for child_snapshot in children:
+            child = _Node.from_snapshot(child_snapshot)
+            node.children[child.name] = child
+        return node
+
+
+# Every timer by key, so that a timer sent to another process is the copy of it there
+_timers = weakref.WeakValueDictionary()
+_timer_keys = count_from()
+
+
+def _timer_for_key(key, sample_every, sample_interval):
+    timer = _timers.get(key)
+    if timer is None:
+        timer = Timer(sample_every, sample_interval, key)
+    return timer
+
+
+def _tick(timer_ref, interval, stop):
+    while not stop.wait(interval):
+        timer = timer_ref()
+        if timer is None:
+            break
+        timer._tick += 1
+        del timer
+
+
+class Timer(object):
+    __slots__ = (
+        '_local', '_roots', '_lock', '_sampled', '_sample_every', '_sample_interval',
+        '_tick', '_ticker_stop', 'key', '__weakref__',
+    )
+
+    def __init__(self, sample_every=None, sample_interval=None, key=None):
+        """
+        Time one span in `sample_every` of each path, or the first span of each path
+        every `sample_interval` seconds, or by default every span.
+        Give a `key` that is the same in every process to have the timer's spans
+        collected from workers started by spawning rather than forking.
+        """
+        # Set first, so that __del__ works on a timer whose arguments were rejected
+        self._ticker_stop = None
+        if sample_every is not None and sample_interval is not None:
+            raise ValueError("Can't sample both by count and by time")
+        if sample_every is not None and sample_every < 1:
+            raise ValueError("Sampling must be 1 in at least 1 span")
+        if sample_interval is not None and sample_interval <= 0:
+            raise ValueError("Sampling interval must be positive")
+
+        self._local = threading.local()
+        self._roots = []
+        self._lock = threading.Lock()
+        self._sampled = sample_every is not None or sample_interval is not None
+        self._sample_every = sample_every
+        self._sample_interval = sample_interval
+        self._tick = 0
+        self.key = key if key is not None else "timer-%d" % next(_timer_keys)
+        _timers[self.key] = self
+        if sample_interval is not None:
+            self._start_ticker()
+
+    def _start_ticker(self):
+        self._ticker_stop = threading.Event()
+        threading.Thread(
+            target=_tick,
+            args=(weakref.ref(self), self._sample_interval, self._ticker_stop),
+            name="Timer ticker",
+            daemon=True,
+        ).start()
+
+    def __del__(self):
+        if self._ticker_stop is not None:
+            self._ticker_stop.set()
+
+    def __reduce__(self):
+        return _timer_for_key, (self.key, self._sample_every, self._sample_interval)
+
+    def _new_stack(self):
+        stack = []
+        root = _Node(None, stack)
+        stack.append(root)
+        with self._lock:
+            self._roots.append(root)
+        self._local.stack = stack
+        return stack
+
+    def __call__(self, name):
+        try:
+            stack = self._local.stack
+        except AttributeError:
+            stack = self._new_stack()
+        children = stack[-1].children
+        node = children.get(name)
+        if node is None:
+            node = _Node(name, stack)
+            # Added under the lock so that reports never see the tree change size
+            with self._lock:
+                children[name] = node
+        stack.append(node)
+
+        if self._sampled:
+            node.calls += 1
+            if self._sample_interval is None:
+                countdown = node.countdown - 1
+                if countdown:
+                    node.countdown = countdown
+                    return node.skip or self._make_skip(node)
+                node.countdown = self._sample_every
+            elif node.tick == self._tick:
+                return node.skip or self._make_skip(node)
+            else:
+                node.tick = self._tick
+
+        node.start = perf_counter_ns()
+        return node
+
+    @staticmethod
+    def _make_skip(node):
+        node.skip = _Skip(node.stack)
+        return node.skip
+
+    def timed(self, name=None):
+        """
+        Decorator timing each call of a function as a span, named after the function
+        unless a name is given.
+        """
+        def decorate(func):
+            span_name = name if name is not None else func.__qualname__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self(span_name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def merged(self):
+        """
+        Merge the timings of every thread into a single tree, returning its root.
+        Spans still open are not counted.
+        """
+        root = _Node(None)
+        with self._lock:
+            for thread_root in self._roots:
+                root.merge(thread_root)
+        return root
+
+    def snapshot(self):
+        """
+        Get the timings so far as plain data, which can be pickled or sent as JSON to
+        be added to another timer with `merge`.
+        """
+        return self.merged().to_snapshot()
+
+    def merge(self, other):
+        """
+        Add the timings of another timer, or a snapshot of one, to this timer's.
+        Paths are matched up by name, so timings from many threads or processes
+        running the same code add up into one tree.
+        """
+        if isinstance(other, Timer):
+            root = other.merged()
+        else:
+            root = _Node.from_snapshot(other)
+        with self._lock:
+            self._roots.append(root)
+
+    def clear(self):
+        """
+        Forget every timing. Spans open in other threads are left out of the new
+        timings when they end.
+        """
+        with self._lock:
+            self._roots = []
+            self._local = threading.local()
+
+    def take(self):
+        """
+        Get a snapshot of the timings so far, and forget them.
+        """
+        root = _Node(None)
+        with self._lock:
+            for thread_root in self._roots:
+                root.merge(thread_root)
+            self._roots = []
+            self._local = threading.local()
+        return root.to_snapshot()
+
+    @property
+    def times(self):
+        """Total seconds spent in each path."""
+        return {
+            path: node.estimated_total / 1e9 for path, node in self.merged().walk()
+        }
+
+    def stats(self):
+        """
+        Get (calls, total, self, min, max) for each path, in nanoseconds.
+        With sampling, the total and self times are estimates, and the minimum and
+        maximum are of the spans which were timed.
+        """
+        return {
+            path: (
+                node.calls, round(node.estimated_total), round(node.self_time),
+                node.min, node.max,
+            )
+            for path, node in self.merged().walk()
+        }
+
+    def to_json(self, **kwargs):
+        """
+        Serialise the merged timings as nested JSON objects, in nanoseconds.
+        """
+        def convert(node):
+            return {
+                "name": node.name,
+                "count": node.calls,
+                "sampled": node.count,
+                "total_ns": round(node.estimated_total),
+                "self_ns": round(node.self_time),
+                "min_ns": node.min,
+                "max_ns": node.max,
+                "children": [convert(child) for child in node.children.values()],
+            }
+
+        root = self.merged()
+        return json.dumps(
+            [convert(child) for child in root.children.values()], **kwargs
+        )
+
+    def to_folded(self):
+        """
+        Export the merged self times in the folded stack format read by flamegraph.pl
+        and speedscope, one "a;b;c nanoseconds" line per path.
+        """
+        lines = []
+        for path, node in self.merged().walk():
+            self_time = round(node.self_time)
+            if self_time > 0:
+                names = ";".join(str(name).replace(";", ":") for name in path)
+                lines.append("%s %d\n" % (names, self_time))
+        return "".join(lines)
+
+
+def _restart_tickers():
+    # Threads don't survive a fork, so time-based sampling would stop in the child
+    for timer in list(_timers.values()):
+        if timer._sample_interval is not None:
+            timer._start_ticker()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_tickers)
+
+
+def _init_worker(timer, initializer, initargs):
+    # A forked worker starts with a copy of the parent's timings, which aren't its own
+    timer.clear()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _call_collecting(timer, fn, *args, **kwargs):
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        e._timer_snapshot = timer.take()
+        raise
+    return result, timer.take()
+
+
+class TimerProcessPoolExecutor(ProcessPoolExecutor):
+    """
+    Process pool which collects the spans of a timer recorded in its workers, adding
+    them to the timer in this process as each task finishes. Paths in the workers
+    start from the root, as they do in new threads.
+    """
+
+    def __init__(
+        self, timer, max_workers=None, mp_context=None, initializer=None, initargs=()
+    ):
+        super(TimerProcessPoolExecutor, self).__init__(
+            max_workers, mp_context, _init_worker, (timer, initializer, initargs)
+        )
+        self._timer = timer
+
+    def submit(self, fn, *args, **kwargs):
+        timer = self._timer
+        inner = super(TimerProcessPoolExecutor, self).submit(
+            _call_collecting, timer, fn, *args, **kwargs
+        )
+        outer = Future()
+
+        def forward(inner):
+            if inner.cancelled():
+                outer.cancel()
+                outer.set_running_or_notify_cancel()
+                return
+            exception = inner.exception()
+            if exception is not None:
+                snapshot = getattr(exception, "_timer_snapshot", None)
+                if snapshot is not None:
+                    del exception._timer_snapshot
+                    timer.merge(snapshot)
+                if outer.set_running_or_notify_cancel():
+                    outer.set_exception(exception)
+                return
+            result, snapshot = inner.result()
+            timer.merge(snapshot)
+            if outer.set_running_or_notify_cancel():
+                outer.set_result(result)
+
+        def cancel_inner(outer):
+            if outer.cancelled():
+                inner.cancel()
+
+        inner.add_done_callback(forward)
+        outer.add_done_callback(cancel_inner)
+        return outer
+
+
+def format_ns(ns):
+    if ns < 1000:
+        return "%d ns" % ns
+    elif ns < 1000000:
+        return "%.2f us" % (ns / 1e3)
+    elif ns < 1000000000:
+        return "%.2f ms" % (ns / 1e6)
+    else:
+        return "%.3f s" % (ns / 1e9)
+
+
+def measure_overhead(spans=100000, repeat=5, **timer_options):
+    """
+    Estimate the time a span adds to the code it times, in nanoseconds, from the
+    fastest of a few runs. Options are passed on to `Timer`, e.g. to sample.
+    """
+    timer = Timer(**timer_options)
+    loop = range(spans)
+    best = None
+
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        for _ in loop:
+            pass
+        empty = perf_counter_ns() - start
+
+        with timer("outer"):
+            start = perf_counter_ns()
+            for _ in loop:
+                with timer("span"):
+                    pass
+            timed = perf_counter_ns() - start
+
+        overhead = (timed - empty) / spans
+        if best is None or overhead < best:
+            best = overhead
+
+    return best
+
 
 class StringTree(object):
     __slots__ = 'string', 'children'
@@ -41,7 +529,7 @@ class StringTree(object):
             return ""
 
         result = ""
-        for line in indent:
+        for line in indent[:-1]:
             if line:
                 result += "│   "
             else:
@@ -55,45 +543,83 @@ class StringTree(object):
         return result
 
     def to_indented_str(self, indent):
-        result = self.string + "\n"
+        result = self._make_indent(indent) + self.string + "\n"
         if self.children:
-            next_indent = indent + (True,)
             for child in self.children[:-1]:
-                result += child.to_indented_str(next_indent)
-            result += children[-1].to_indented_str(indent + (False,))
+                result += child.to_indented_str(indent + (True,))
+            result += self.children[-1].to_indented_str(indent + (False,))
         return result
 
     def __str__(self):
-        return to_indented_str(indent=())
+        return self.to_indented_str(indent=())
 
 
 def timer_to_tree(timer, root_label="Root"):
-    times = sorted(timer.times.items())
+    def convert(node):
+        estimated = node.count < node.calls
+        label = "%s (%s%s" % (
+            node.name, "~" if estimated else "", format_ns(node.estimated_total))
+        if node.calls > 1:
+            label += " in %d calls" % node.calls
+            if estimated:
+                label += " (%d timed)" % node.count
+            label += ", %s to %s" % (format_ns(node.min), format_ns(node.max))
+        if node.children:
+            label += ", %s self" % format_ns(node.self_time)
+        label += ")"
+        return StringTree(label, [convert(child) for child in node.children.values()])
 
-    last_depth = 0
-    children = []
+    root = timer.merged()
+    return StringTree(root_label, [convert(child) for child in root.children.values()])
 
-    for name, time in times:
-        label = "%s (%s)" % (name[-1], time)
 
-        depth = len(name)
-        if depth > last_depth:
-            children.append(label)
-            assert(depth == last_depth + 1)
-        else:
-            # TODO 
-            pass
+def _demo_job(timer, n):
+    with timer("job"):
+        for _ in range(n):
+            with timer("step"):
+                sum(range(100))
+    return n
 
 
-t = Timer()
-with t("Test one"):
-    with t("Test two"):
-        pass
-    with t("Test three"):
-        with t("Test four"):
+if __name__ == "__main__":
+    t = Timer()
+    with t("Test one"):
+        with t("Test two"):
             pass
-with t("Test five"):
-    pass
+        with t("Test three"):
+            with t("Test four"):
+                pass
+    with t("Test five"):
+        pass
+
+    @t.timed()
+    def work(n):
+        return sum(range(n))
+
+    def worker():
+        for _ in range(3):
+            work(10000)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(t.times)
+    print(timer_to_tree(t))
+    print(t.to_folded())
+    print(t.to_json(indent=2))
+
+    sampled = Timer(sample_every=10)
+    with sampled("parallel"):
+        with TimerProcessPoolExecutor(sampled, max_workers=4) as executor:
+            jobs = executor.map(_demo_job, [sampled] * 8, [20000] * 8)
+            print("Jobs done: %d" % sum(jobs))
+    print(timer_to_tree(sampled, "Sampled 1 in 10, over 4 processes"))
 
-print(t.times)
-print(timer_to_tree(t.times))
+    print("Overhead per span: %s" % format_ns(measure_overhead()))
+    print("Overhead per span, sampling 1 in 100: %s" % format_ns(
+        measure_overhead(sample_every=100)))
+    print("Overhead per span, sampling every 1 ms: %s" % format_ns(
+        measure_overhead(sample_interval=0.001)))